@@ -0,0 +1,418 @@
+"""
+Apply a file of operations without the interactive portal, e.g. to load
+group bookings or check in a tour party:
+    python3 batch.py operations.csv
+    python3 batch.py operations.jsonl
+
+Each operation is a CSV row (with a heading row) or a JSON object on its
+own line, with an "operation" of "book", "update", "check in" or
+"add luggage" and these fields, named as in the spreadsheet:
+- book: flight no, first name(s), last name, date of birth, passport no,
+  nationality and luggage
+- update: booking no and the passenger details to change
+- check in: booking no
+- add luggage: booking no and luggage (the number of pieces to add)
+Details are validated as they are in the portal, and the changes to each
+flight are saved together rather than one operation at a time.
+"""
+import argparse
+import csv
+import json
+from collections import Counter, defaultdict
+from time import monotonic
+
+from gspread.exceptions import APIError
+
+from instrumentation import STATS
+from service import BOOKING_DETAILS, MAX_LUGGAGE, PortalService
+from storage import ConflictError
+
+
+OPERATIONS = ["book", "update", "check in", "add luggage"]
+
+# Longest wait in seconds for queued writes to be saved before exiting
+SAVE_TIMEOUT = 300
+
+
+def read_json_line(line):
+    """
+    Parse a JSONL line into a dict, or return a ValueError if it isn't a
+    JSON object
+    """
+    try:
+        record = json.loads(line)
+    except json.JSONDecodeError as e:
+        return ValueError(f"not valid JSON ({e.msg} at column {e.colno})")
+
+    if not isinstance(record, dict):
+        return ValueError("not a JSON object")
+
+    return record
+
+
+def read_operations(path):
+    """
+    Read the operations in a CSV or JSONL (.jsonl) file. Returns a list of
+    (line no, operation) pairs, where each operation is a dict of field ->
+    value, with field names in lower case and empty fields left out. A
+    JSONL line that isn't a JSON object is returned as a ValueError saying
+    why, so that it fails on its own instead of stopping the batch.
+    """
+    with open(path, newline="") as f:
+        if path.endswith(".jsonl"):
+            records = [(line_no, read_json_line(line))
+                       for line_no, line in enumerate(f, start=1)
+                       if line.strip()]
+        else:
+            reader = csv.DictReader(f)
+            records = [(reader.line_num, row) for row in reader]
+
+    operations = []
+
+    for line_no, record in records:
+        if isinstance(record, ValueError):
+            operations.append((line_no, record))
+            continue
+
+        # Cells past the last heading of a CSV row have no field name
+        operation = {
+            field.strip().lower(): str(value).strip()
+            for field, value in record.items()
+            if field is not None and value is not None
+            and str(value).strip()
+        }
+        operations.append((line_no, operation))
+
+    return operations
+
+
+class BatchReport:
+    """
+    What happened to each operation of a batch, and how long it took
+    """
+
+    def __init__(self):
+        self.done = Counter()
+        self.failed = Counter()
+
+        # (line no, message) for every operation
+        self.messages = []
+
+        self.started_at = monotonic()
+        self.finished_at = None
+
+    def succeed(self, line_no, operation, message):
+        """
+        Record an operation that was applied
+        """
+        self.done[operation] += 1
+        self.messages.append((line_no, message))
+
+    def fail(self, line_no, operation, error):
+        """
+        Record an operation that couldn't be applied, and why
+        """
+        self.failed[operation] += 1
+        self.messages.append((line_no, f"failed ({operation}): {error}"))
+
+    def fail_after_all(self, line_no, operation, error):
+        """
+        Record that an operation reported as done failed after all, e.g.
+        when its queued write could not be saved
+        """
+        self.done[operation] -= 1
+        self.messages = [(message_line_no, message)
+                         for message_line_no, message in self.messages
+                         if message_line_no != line_no]
+        self.fail(line_no, operation, error)
+
+    def finish(self):
+        """
+        Stop timing the batch
+        """
+        self.finished_at = monotonic()
+
+    def summary(self):
+        """
+        Return a printable report of every operation, followed by totals
+        """
+        lines = [f"Line {line_no}: {message}"
+                 for line_no, message in sorted(self.messages)]
+
+        total = sum(self.done.values()) + sum(self.failed.values())
+        seconds = (self.finished_at or monotonic()) - self.started_at
+        per_minute = total / seconds * 60 if seconds else total
+
+        lines.append(f"\n{total} operations in {seconds:.1f} seconds \
+({per_minute:.0f} per minute)")
+
+        for operation in OPERATIONS:
+            if self.done[operation] or self.failed[operation]:
+                lines.append(f"   {operation}: {self.done[operation]} done, \
+{self.failed[operation]} failed")
+
+        # Lines that couldn't be read, or named no known operation
+        invalid = sum(count for operation, count in self.failed.items()
+                      if operation not in OPERATIONS)
+
+        if invalid:
+            lines.append(f"   invalid lines: {invalid} failed")
+
+        return "\n".join(lines)
+
+
+class BatchRunner:
+    """
+    Validates a batch of operations, then applies them with as few writes
+    as possible: new passengers are added with one add_bookings() call per
+    flight, and every other change with one update_passengers() call per
+    flight.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.storage = service.storage
+
+        # (storage write, flight no) -> (line no, operation) pairs reported
+        # as done when the write was made, which may still fail if it was
+        # queued
+        self._written = defaultdict(list)
+
+    def _validated_details(self, line, operation):
+        """
+        Return a dict of the validated and formatted passenger details in
+        the operation, raising ValueError if any is missing or invalid
+        """
+        # Details that can be given, and those that must be
+        if operation == "book":
+            detail_types = required = BOOKING_DETAILS
+        elif operation == "update":
+            detail_types = BOOKING_DETAILS
+            required = []
+        elif operation == "add luggage":
+            # The number of pieces to add
+            detail_types = required = ["luggage"]
+        else:
+            detail_types = required = []
+
+        details = self.service.validate_details(
+            {detail_type: line[detail_type] for detail_type in detail_types
+             if detail_type in line},
+            required
+        )
+
+        if operation == "update" and not details:
+            raise ValueError("no passenger details to change")
+
+        return details
+
+    def run(self, operations):
+        """
+        Apply a list of (line no, operation) pairs as returned by
+        read_operations() and return a BatchReport
+        """
+        report = BatchReport()
+        flight_nos = {flight.flight_no for flight in self.service.flights()}
+
+        # Validate every operation before anything is written
+        bookings = []
+        changes = []
+
+        for line_no, line in operations:
+            # A line that couldn't be read
+            if isinstance(line, ValueError):
+                report.fail(line_no, "unknown", line)
+                continue
+
+            operation = line.get("operation", "").lower()
+
+            try:
+                if operation not in OPERATIONS:
+                    raise ValueError(f"operation must be one of \
+{', '.join(OPERATIONS)}")
+
+                details = self._validated_details(line, operation)
+
+                if operation == "book":
+                    flight_no = line.get("flight no", "").upper()
+
+                    if flight_no not in flight_nos:
+                        raise ValueError(f"no flight {flight_no}")
+
+                    bookings.append((line_no, flight_no, details))
+                elif "booking no" not in line:
+                    raise ValueError("booking no missing")
+                else:
+                    changes.append((line_no, operation,
+                                    line["booking no"].upper(), details))
+            except ValueError as e:
+                report.fail(line_no, operation or "unknown", e)
+
+        self._book(bookings, report)
+        self._change(changes, report)
+
+        return report
+
+    def _book(self, bookings, report):
+        """
+        Add new passengers, with one write per flight
+        """
+        by_flight = defaultdict(list)
+
+        for line_no, flight_no, details in bookings:
+            # Giving out a booking number can read the spreadsheet
+            try:
+                passenger = self.service.new_passenger(details)
+            except (ValueError, APIError) as e:
+                report.fail(line_no, "book", e)
+                continue
+
+            by_flight[flight_no].append((line_no, passenger))
+
+        for flight_no, flight_bookings in by_flight.items():
+            passengers = [passenger for line_no, passenger in flight_bookings]
+
+            try:
+                self.storage.add_bookings(flight_no, passengers)
+            except Exception as e:
+                for line_no, passenger in flight_bookings:
+                    report.fail(line_no, "book", e)
+                continue
+
+            for line_no, passenger in flight_bookings:
+                report.succeed(line_no, "book", f"booked \
+{passenger.booking_no} for {passenger.name} on {flight_no}")
+                self._written[("add_bookings", flight_no)].append(
+                    (line_no, "book")
+                )
+
+    def _change(self, changes, report):
+        """
+        Apply updates, check ins and added luggage, with one write per
+        flight. Each passenger is looked up and read once, and all changes
+        to them are saved together.
+        """
+        # Booking no -> (BookingLocation, passenger as read, changes)
+        passengers = {}
+
+        # Flight no -> operations to report once the flight is saved
+        applied = defaultdict(list)
+
+        for line_no, operation, booking_no, details in changes:
+            try:
+                if booking_no not in passengers:
+                    location = self.service.find_booking(booking_no)
+                    passenger = self.storage.get_passenger(
+                        location.flight_no, location.row, fresh=True
+                    )
+                    passengers[booking_no] = (location, passenger, {})
+
+                location, passenger, passenger_changes = \
+                    passengers[booking_no]
+
+                # The passenger with the changes made earlier in the batch
+                current = passenger.replace(passenger_changes)
+
+                # As in the portal, details can't change after check in,
+                # but luggage can still be added
+                if operation != "add luggage" and current.checked_in:
+                    raise ValueError(f"{booking_no} is already checked in")
+
+                if operation == "update":
+                    passenger_changes.update(details)
+                elif operation == "check in":
+                    passenger_changes["checked in"] = True
+                else:
+                    luggage = int(current.luggage or 0) + details["luggage"]
+
+                    if luggage > MAX_LUGGAGE:
+                        raise ValueError(f"{booking_no} would have \
+{luggage} pieces of luggage (max. {MAX_LUGGAGE})")
+
+                    passenger_changes["luggage"] = luggage
+            except (ValueError, APIError, ConflictError) as e:
+                # e.g. the booking wasn't found, the passenger kept moving
+                # or the spreadsheet couldn't be read: the others go ahead
+                report.fail(line_no, operation, e)
+            else:
+                applied[location.flight_no].append(
+                    (line_no, operation, booking_no)
+                )
+
+        for flight_no, flight_operations in applied.items():
+            changes_by_row = {
+                location.row: passenger_changes
+                for location, passenger, passenger_changes
+                in passengers.values()
+                if location.flight_no == flight_no and passenger_changes
+            }
+
+            try:
+                self.storage.update_passengers(flight_no, changes_by_row)
+            except Exception as e:
+                for line_no, operation, booking_no in flight_operations:
+                    report.fail(line_no, operation, e)
+                continue
+
+            for line_no, operation, booking_no in flight_operations:
+                report.succeed(line_no, operation,
+                               f"{operation} {booking_no}")
+                self._written[("update_passengers", flight_no)].append(
+                    (line_no, operation)
+                )
+
+    def report_failed_writes(self, report, failed_writes):
+        """
+        Mark the operations whose queued writes could not be saved as
+        failed, where failed_writes is a list of (operation, flight no,
+        error) as returned by PortalService.failed_writes()
+        """
+        for write, flight_no, error in failed_writes:
+            for line_no, operation in self._written.pop((write, flight_no),
+                                                        []):
+                report.fail_after_all(line_no, operation,
+                                      f"not saved ({error})")
+
+
+def main():
+    """
+    Apply the operations in the file passed on the command line
+    """
+    parser = argparse.ArgumentParser(
+        description="Apply a CSV or JSONL file of bookings, detail updates, \
+check ins and added luggage"
+    )
+    parser.add_argument("file", help="path of the CSV or JSONL file")
+    parser.add_argument("--stats", action="store_true",
+                        help="print the number and times of spreadsheet \
+requests and operations")
+    args = parser.parse_args()
+
+    service = PortalService()
+
+    # Writes that failed before this batch aren't reported again
+    failed_before = len(service.failed_writes())
+
+    runner = BatchRunner(service)
+    report = runner.run(read_operations(args.file))
+
+    # Wait for queued writes, so the time taken includes saving them, then
+    # report any that could not be saved
+    unsaved_changes = service.close(timeout=SAVE_TIMEOUT)
+    runner.report_failed_writes(report,
+                                service.failed_writes()[failed_before:])
+    report.finish()
+
+    print(report.summary())
+
+    if args.stats:
+        print(f"\n{STATS.summary()}\n")
+        print(service.quota_report())
+
+    if unsaved_changes:
+        print(f"{unsaved_changes} changes not yet saved. They will be saved \
+the next time the portal is started.")
+
+
+if __name__ == "__main__":
+    main()
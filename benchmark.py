@@ -0,0 +1,728 @@
+"""
+Benchmark the portal offline, against an in-memory stand-in for the Google
+Sheets and Drive APIs, so that every performance change can be measured
+reproducibly without creds.json or a live spreadsheet:
+    python3 benchmark.py
+    python3 benchmark.py --scenario "check in" --latency 0.2 --quota 60
+    python3 benchmark.py --flights 30 --passengers 300 --mode prefetch
+
+The real gspread client, request scheduler, storage and terminal portal
+functions (display_all_flights, find_booking, book_ticket, check_in,
+add_luggage and search_passengers) are used. Only the HTTP session is
+replaced: FakeSheetsSession answers each request from an in-memory
+spreadsheet after a configurable latency, and rejects requests over the
+per-minute quota with 429 errors as the Sheets API does. Scripted
+scenarios answer the portal's questions like a desk agent would, and the
+number of requests, latency and throughput of each scenario are reported.
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import re
+import tempfile
+import threading
+from collections import deque
+from datetime import date, datetime, timedelta, timezone
+from time import monotonic, perf_counter, sleep
+from urllib.parse import unquote
+
+from gspread.exceptions import APIError
+from gspread.urls import (DRIVE_FILES_API_V3_URL,
+                          SPREADSHEETS_API_V4_BASE_URL)
+from gspread.utils import absolute_range_name, rowcol_to_a1
+
+from connection import SheetsConnection
+from instrumentation import STATS, Histogram
+from parallel import SlidingWindowLimiter
+from records import Flight, Passenger
+from scheduler import RATE_LIMITED, RequestScheduler, ScheduledClient, \
+    is_read
+from worksheet_schema import clear_schemas
+
+
+SPREADSHEET_ID = "benchmark"
+SPREADSHEET_NAME = "magnolia_airport"
+
+DESTINATIONS = ["Atlanta", "Miami", "Charlotte", "Nashville", "Orlando",
+                "Dallas", "Houston", "New Orleans"]
+FIRST_NAMES = ["Jane", "John", "Ann", "Bob", "Maria", "Luis", "Mei", "Omar",
+               "Sara", "Tom", "Aisha", "Ivan"]
+LAST_NAMES = ["Smith", "Lee", "Garcia", "Brown", "Nguyen", "Khan", "Miller",
+              "Lopez", "Wilson", "Moore", "Young", "King"]
+NATIONALITIES = ["UNITED STATES", "UNITED KINGDOM", "FRANCE", "MEXICO",
+                 "CANADA", "GERMANY"]
+
+# Requests per minute allowed when no quota is set
+UNLIMITED = 10 ** 9
+
+# Scenarios that run one portal program, and how often each is picked in
+# the "mixed" scenario, which imitates a busy check in desk
+SCENARIO_WEIGHTS = {
+    "view flights": 1,
+    "find booking": 3,
+    "book": 2,
+    "check in": 3,
+    "add luggage": 1,
+    "search": 2
+}
+
+# Longest wait in seconds for queued writes to be saved after a scenario
+SAVE_TIMEOUT = 600
+
+
+def booking_number(rng):
+    """
+    Return a random booking number, e.g. TF78RE32
+    """
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+    return "".join([rng.choice(letters), rng.choice(letters),
+                    str(rng.randint(10, 99)), rng.choice(letters),
+                    rng.choice(letters), str(rng.randint(10, 99))])
+
+
+def make_dataset(flights, passengers, seed=1):
+    """
+    Return the worksheets of a spreadsheet with the passed number of
+    flights, each with the passed number of passengers, as a list of
+    (title, rows of values) pairs in spreadsheet order. The same seed
+    always makes the same spreadsheet.
+    """
+    rng = random.Random(seed)
+    first_date = date(2023, 7, 1)
+
+    flight_rows = [list(Flight.FIELDS)]
+    for i in range(flights):
+        departure = 6 + i % 14
+        flight_rows.append([
+            f"MA{100 + i}",
+            DESTINATIONS[i % len(DESTINATIONS)],
+            (first_date + timedelta(days=i // 4)).isoformat(),
+            f"{departure:02}:00",
+            f"{departure + 2:02}:30"
+        ])
+
+    booking_nos = set()
+    flight_worksheets = []
+
+    for flight in flight_rows[1:]:
+        rows = [list(Passenger.FIELDS)]
+
+        for i in range(passengers):
+            booking_no = booking_number(rng)
+            while booking_no in booking_nos:
+                booking_no = booking_number(rng)
+            booking_nos.add(booking_no)
+
+            rows.append([
+                rng.choice(FIRST_NAMES),
+                rng.choice(LAST_NAMES),
+                f"{rng.randint(1940, 2010)}-{rng.randint(1, 12):02}-\
+{rng.randint(1, 28):02}",
+                f"P{rng.randint(1000000, 9999999)}",
+                rng.choice(NATIONALITIES),
+                str(rng.randint(0, 2)),
+                booking_no,
+                "TRUE" if rng.random() < 0.3 else ""
+            ])
+
+        flight_worksheets.append((flight[0], rows))
+
+    return [("flights", flight_rows),
+            ("booking nos", [[booking_no] for booking_no in booking_nos])] \
+        + flight_worksheets
+
+
+class FakeResponse:
+    """
+    The parts of a requests.Response that gspread uses
+    """
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self._body = body
+        self.text = str(body)
+
+    def json(self):
+        return self._body
+
+
+def column_number(letters):
+    """
+    Column number (starting at 1) of column letters, e.g. "AB" -> 28
+    """
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - ord("A") + 1
+
+    return number
+
+
+def cell_value(value):
+    """
+    Return a value as the spreadsheet shows it
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+
+    return str(value)
+
+
+class FakeSheetsSession:
+    """
+    Stand-in for the HTTP session of a gspread client, answering Sheets
+    API v4 and Drive API v3 requests from an in-memory spreadsheet.
+    Every request waits latency seconds (give or take jitter, a share of
+    the latency). Sheets reads and writes over quota per minute each are
+    rejected with a 429 error.
+    """
+
+    def __init__(self, worksheets, latency=0, jitter=0, quota=None,
+                 seed=1):
+        self.titles = [title for title, rows in worksheets]
+        self.values = {title: [[cell_value(value) for value in row]
+                               for row in rows]
+                       for title, rows in worksheets}
+        self.latency = latency
+        self.jitter = jitter
+        self.quota = quota
+        self.revision = 0
+
+        # Times of the Sheets reads and writes of the last minute
+        self._sent = {"read": deque(), "write": deque()}
+
+        # Kind -> number of requests, and those rejected
+        self.requests = {"read": 0, "write": 0, "drive": 0}
+        self.rejected = 0
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def get(self, url, params=None, json=None, **kwargs):
+        return self._request("get", url, params or {}, json)
+
+    def post(self, url, params=None, json=None, **kwargs):
+        return self._request("post", url, params or {}, json)
+
+    def put(self, url, params=None, json=None, **kwargs):
+        return self._request("put", url, params or {}, json)
+
+    def _request(self, method, url, params, body):
+        """
+        Wait for the latency, then answer the request
+        """
+        if self.latency:
+            sleep(self.latency * self._rng.uniform(1 - self.jitter,
+                                                   1 + self.jitter))
+
+        with self._lock:
+            if url.startswith(DRIVE_FILES_API_V3_URL):
+                self.requests["drive"] += 1
+                return FakeResponse(200, self._drive(url))
+
+            kind = "read" if is_read(method, url) else "write"
+            self.requests[kind] += 1
+
+            if self._over_quota(kind):
+                self.rejected += 1
+                return FakeResponse(RATE_LIMITED, {"error": {
+                    "code": RATE_LIMITED,
+                    "message": f"Quota exceeded for {kind} requests per \
+minute",
+                    "status": "RESOURCE_EXHAUSTED"
+                }})
+
+            path = url[len(f"{SPREADSHEETS_API_V4_BASE_URL}/\
+{SPREADSHEET_ID}"):]
+
+            if path == "":
+                return FakeResponse(200, self._metadata())
+            if path == "/values:batchGet":
+                ranges = params["ranges"]
+                if isinstance(ranges, str):
+                    ranges = [ranges]
+
+                return FakeResponse(200, {
+                    "spreadsheetId": SPREADSHEET_ID,
+                    "valueRanges": [self._get(range_name, params)
+                                    for range_name in ranges]
+                })
+            if path == "/values:batchUpdate":
+                for value_range in body["data"]:
+                    self._update(value_range["range"], value_range["values"])
+                self.revision += 1
+
+                return FakeResponse(200, {"spreadsheetId": SPREADSHEET_ID})
+
+            range_name = unquote(path[len("/values/"):])
+
+            if method == "get":
+                return FakeResponse(200, self._get(range_name, params))
+            if range_name.endswith(":append"):
+                response = self._append(range_name[:-len(":append")],
+                                        body["values"])
+            else:
+                response = self._update(range_name, body["values"])
+            self.revision += 1
+
+            return FakeResponse(200, response)
+
+    def _over_quota(self, kind):
+        """
+        Count a request towards the quota, returning True if it is over
+        """
+        if self.quota is None:
+            return False
+
+        sent = self._sent[kind]
+        now = monotonic()
+
+        while sent and sent[0] < now - 60:
+            sent.popleft()
+
+        if len(sent) >= self.quota:
+            return True
+
+        sent.append(now)
+        return False
+
+    def _modified_time(self):
+        """
+        Modified time of the spreadsheet, which changes with every write
+        """
+        modified = datetime(2023, 7, 1, tzinfo=timezone.utc) + \
+            timedelta(seconds=self.revision)
+
+        return modified.isoformat().replace("+00:00", ".000Z")
+
+    def _drive(self, url):
+        """
+        Answer a Drive request: the list of spreadsheet files, or the
+        metadata of one file
+        """
+        spreadsheet_file = {
+            "id": SPREADSHEET_ID,
+            "name": SPREADSHEET_NAME,
+            "createdTime": "2023-07-01T00:00:00.000Z",
+            "modifiedTime": self._modified_time()
+        }
+
+        if url == DRIVE_FILES_API_V3_URL:
+            return {"kind": "drive#fileList", "files": [spreadsheet_file]}
+
+        return spreadsheet_file
+
+    def _metadata(self):
+        """
+        The spreadsheet's properties and the properties of every worksheet
+        """
+        return {
+            "spreadsheetId": SPREADSHEET_ID,
+            "properties": {"title": SPREADSHEET_NAME, "locale": "en_US"},
+            "sheets": [{"properties": {
+                "sheetId": index,
+                "title": title,
+                "index": index,
+                "sheetType": "GRID",
+                "gridProperties": {
+                    "rowCount": max(1000, len(self.values[title])),
+                    "columnCount": 26
+                }
+            }} for index, title in enumerate(self.titles)]
+        }
+
+    def _parse_range(self, range_name):
+        """
+        Return the title, first row, first column, last row and last column
+        (None where open ended) of a range in A1 notation
+        """
+        if "!" in range_name:
+            title, cells = range_name.rsplit("!", 1)
+        elif range_name.strip("'") in self.values:
+            title, cells = range_name, ""
+        else:
+            title, cells = self.titles[0], range_name
+
+        if title.startswith("'"):
+            title = title[1:-1].replace("''", "'")
+
+        match = re.fullmatch(r"([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?", cells)
+        start_col, start_row, end_col, end_row = match.groups()
+
+        # A single cell (e.g. "B3") ends where it starts
+        if end_col is None:
+            end_col, end_row = start_col, start_row
+
+        return (title,
+                int(start_row) if start_row else 1,
+                column_number(start_col) if start_col else 1,
+                int(end_row) if end_row else None,
+                column_number(end_col) if end_col else None)
+
+    def _get(self, range_name, params):
+        """
+        Read a range, leaving out empty cells at the end of each row and
+        empty rows at the end, as the Sheets API does
+        """
+        title, first_row, first_col, last_row, last_col = \
+            self._parse_range(range_name)
+
+        rows = [row[first_col - 1:last_col]
+                for row in self.values[title][first_row - 1:last_row]]
+        rows = [row[:max([0] + [i + 1 for i, value in enumerate(row)
+                                if value != ""])]
+                for row in rows]
+
+        while rows and not rows[-1]:
+            rows.pop()
+
+        value_range = {"range": range_name, "majorDimension": "ROWS"}
+
+        if params.get("majorDimension") == "COLUMNS":
+            value_range["majorDimension"] = "COLUMNS"
+            width = max([0] + [len(row) for row in rows])
+            rows = [[row[i] if i < len(row) else "" for row in rows]
+                    for i in range(width)]
+
+        if rows:
+            value_range["values"] = rows
+
+        return value_range
+
+    def _update(self, range_name, values):
+        """
+        Write values into a range, starting at its first cell
+        """
+        title, first_row, first_col, last_row, last_col = \
+            self._parse_range(range_name)
+        rows = self.values[title]
+
+        for i, new_row in enumerate(values):
+            while len(rows) < first_row + i:
+                rows.append([])
+
+            row = rows[first_row + i - 1]
+            row.extend([""] * (first_col - 1 + len(new_row) - len(row)))
+
+            for j, value in enumerate(new_row):
+                row[first_col - 1 + j] = cell_value(value)
+
+        updated_range = absolute_range_name(
+            title, f"{rowcol_to_a1(first_row, first_col)}:\
+{rowcol_to_a1(first_row + len(values) - 1, first_col + len(values[0]) - 1)}"
+        )
+
+        return {"spreadsheetId": SPREADSHEET_ID,
+                "updatedRange": updated_range,
+                "updatedRows": len(values)}
+
+    def _append(self, range_name, values):
+        """
+        Add rows after the last row with values in the worksheet
+        """
+        title = self._parse_range(range_name)[0]
+        rows = self.values[title]
+
+        while rows and not any(rows[-1]):
+            rows.pop()
+
+        updates = self._update(absolute_range_name(title,
+                                                   f"A{len(rows) + 1}"),
+                               values)
+
+        return {"spreadsheetId": SPREADSHEET_ID,
+                "tableRange": absolute_range_name(title),
+                "updates": updates}
+
+
+class Desk:
+    """
+    Answers the portal's questions like a desk agent, by matching each
+    question against a list of (words in the question, answer) pairs
+    """
+
+    def __init__(self):
+        self.answers = []
+
+    def __call__(self, prompt=""):
+        question = prompt.lower()
+
+        for words, answer in self.answers:
+            if words in question:
+                return str(answer)
+
+        raise RuntimeError(f"No scripted answer to: {prompt.strip()}")
+
+
+class Benchmark:
+    """
+    One run of a scenario: a fresh copy of the dataset behind a
+    FakeSheetsSession, the real storage and service on top of it, and the
+    terminal portal using that service
+    """
+
+    def __init__(self, ui, args):
+        self.ui = ui
+        self.rng = random.Random(args.seed)
+        worksheets = make_dataset(args.flights, args.passengers, args.seed)
+
+        self.session = FakeSheetsSession(worksheets, args.latency,
+                                         args.jitter, args.quota, args.seed)
+
+        # The portal's own limits, which match the server's by default
+        client_quota = args.client_quota or args.quota or UNLIMITED
+        self.scheduler = RequestScheduler(
+            SlidingWindowLimiter(client_quota),
+            SlidingWindowLimiter(client_quota)
+        )
+        client = ScheduledClient(None, self.session, self.scheduler)
+
+        # Imported here, as the storage mode is read from the environment
+        from service import PortalService
+        from storage import open_storage
+
+        clear_schemas()
+        STATS.reset()
+        self.service = PortalService(
+            open_storage(SheetsConnection(spreadsheet_name=SPREADSHEET_NAME,
+                                          client=client))
+        )
+        ui.SERVICE = self.service
+
+        # The portal's questions are answered by the desk
+        self.desk = Desk()
+        ui.input = self.desk
+
+        # Passengers that scenarios can find, as (booking no, last name)
+        self.bookings = []
+        # Those not yet checked in
+        self.waiting = []
+
+        flights = [rows for title, rows in worksheets[2:]]
+        for rows in flights:
+            for row in rows[1:]:
+                self.bookings.append((row[6], row[1]))
+
+                if not row[7]:
+                    self.waiting.append((row[6], row[1]))
+
+        self.destinations = {}
+        for flight in worksheets[0][1][1:]:
+            self.destinations.setdefault(flight[1], []).append(flight[0])
+
+    def view_flights(self):
+        self.ui.display_all_flights()
+
+    def find_booking(self):
+        booking_no, last_name = self.rng.choice(self.bookings)
+        self.desk.answers = [("last name", last_name),
+                             ("booking number", booking_no),
+                             ("is this correct", "yes")]
+
+        self.ui.find_booking()
+
+    def book(self):
+        destination = self.rng.choice(sorted(self.destinations))
+        option = self.rng.randint(1, len(self.destinations[destination]))
+        last_name = self.rng.choice(LAST_NAMES)
+
+        self.desk.answers = [
+            ("choose a destination", destination),
+            ("ok? (yes/no)", "yes"),
+            ("number of the flight", option),
+            ("first name(s)", self.rng.choice(FIRST_NAMES)),
+            ("last name", last_name),
+            ("date of birth", "1985-05-17"),
+            ("passport no", f"P{self.rng.randint(1000000, 9999999)}"),
+            ("nationality", self.rng.choice(NATIONALITIES)),
+            ("checked luggage", self.rng.randint(0, 2)),
+            ("type 'yes' to continue", "yes")
+        ]
+
+        self.ui.book_ticket()
+
+    def check_in(self):
+        if not self.waiting:
+            return self.find_booking()
+
+        booking_no, last_name = self.waiting.pop(
+            self.rng.randrange(len(self.waiting))
+        )
+        self.desk.answers = [("last name", last_name),
+                             ("booking number", booking_no),
+                             ("is this correct", "yes"),
+                             ("change any details", "no")]
+
+        self.ui.check_in()
+
+    def add_luggage(self):
+        booking_no, last_name = self.rng.choice(self.bookings)
+        self.desk.answers = [("last name", last_name),
+                             ("booking number", booking_no),
+                             ("is this correct", "yes"),
+                             ("add 1 more", "yes"),
+                             ("how many pieces", 1)]
+
+        self.ui.add_luggage()
+
+    def search(self):
+        booking_no, last_name = self.rng.choice(self.bookings)
+        self.desk.answers = [("start of a name", last_name)]
+
+        self.ui.search_passengers()
+
+    def run(self, scenario, iterations):
+        """
+        Run the scenario the passed number of times, then wait for queued
+        writes. Returns a dict of the results.
+        """
+        programs = {name: getattr(self, name.replace(" ", "_"))
+                    for name in SCENARIO_WEIGHTS}
+        latencies = Histogram()
+        failed = 0
+        started_at = perf_counter()
+
+        for i in range(iterations):
+            if scenario == "mixed":
+                name = self.rng.choices(list(SCENARIO_WEIGHTS),
+                                        list(SCENARIO_WEIGHTS.values()))[0]
+            else:
+                name = scenario
+
+            iteration_started_at = perf_counter()
+
+            # The portal's printing is left out of the report. Requests
+            # still rejected after every retry fail the run, as they would
+            # at the desk.
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    programs[name]()
+            except APIError:
+                failed += 1
+
+            latencies.add((perf_counter() - iteration_started_at) * 1000)
+
+        unsaved = self.service.close(timeout=SAVE_TIMEOUT)
+        seconds = perf_counter() - started_at
+
+        return {
+            "scenario": scenario,
+            "iterations": iterations,
+            "failed": failed,
+            "seconds": seconds,
+            "per second": iterations / seconds if seconds else 0,
+            "latency": latencies.as_dict(),
+            "reads": self.session.requests["read"],
+            "writes": self.session.requests["write"],
+            "drive": self.session.requests["drive"],
+            "rejected": self.session.rejected,
+            "retries": self.scheduler.retries,
+            "unsaved": unsaved
+        }
+
+
+def print_results(results):
+    """
+    Print a table of the results of every scenario
+    """
+    print(f"{'scenario':<14}{'runs':>5}{'secs':>8}{'runs/s':>8}\
+{'mean ms':>9}{'p95 ms':>8}{'reads':>7}{'writes':>7}{'drive':>6}{'429s':>6}\
+{'retries':>8}")
+
+    for result in results:
+        latency = result["latency"]
+        print(f"{result['scenario']:<14}{result['iterations']:>5}\
+{result['seconds']:>8.2f}{result['per second']:>8.2f}\
+{latency['mean ms'] or 0:>9.0f}{latency['p95 ms'] or 0:>8.0f}\
+{result['reads']:>7}{result['writes']:>7}{result['drive']:>6}\
+{result['rejected']:>6}{result['retries']:>8}")
+
+        if result["failed"]:
+            print(f"   {result['failed']} runs failed after every retry")
+        if result["unsaved"]:
+            print(f"   {result['unsaved']} writes not saved")
+
+
+def main():
+    """
+    Run the scenarios chosen on the command line and print the results
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the portal against an in-memory spreadsheet"
+    )
+    parser.add_argument("--scenario", default="all",
+                        choices=["all", "mixed"] + list(SCENARIO_WEIGHTS))
+    parser.add_argument("--iterations", type=int, default=20,
+                        help="runs of each scenario (default 20)")
+    parser.add_argument("--flights", type=int, default=10,
+                        help="number of flights (default 10)")
+    parser.add_argument("--passengers", type=int, default=100,
+                        help="passengers per flight (default 100)")
+    parser.add_argument("--latency", type=float, default=0.1,
+                        help="seconds each request takes (default 0.1)")
+    parser.add_argument("--jitter", type=float, default=0.2,
+                        help="share of the latency that each request can \
+be faster or slower by (default 0.2)")
+    parser.add_argument("--quota", type=int,
+                        help="Sheets reads and writes allowed per minute \
+each (default no limit)")
+    parser.add_argument("--client-quota", type=int,
+                        help="requests per minute the portal limits itself \
+to (default the same as --quota)")
+    parser.add_argument("--mode", default="direct",
+                        choices=["direct", "queue", "prefetch"],
+                        help="write directly, through the write queue, or \
+with the spreadsheet prefetched (default direct)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--stats", action="store_true",
+                        help="print the requests and operations of each \
+scenario")
+    args = parser.parse_args()
+
+    # Storage options are read when the storage is opened, and desk mode
+    # when the portal is imported
+    os.environ["PORTAL_STORAGE"] = "sheets"
+    os.environ["PORTAL_FAST"] = "on"
+    os.environ["PORTAL_WRITE_QUEUE"] = "on" if args.mode == "queue" else "off"
+    os.environ["PORTAL_PREFETCH"] = "on" if args.mode == "prefetch" \
+        else "off"
+
+    # Every scenario starts cold, from its own copy of the dataset
+    os.environ["PORTAL_WARM_CACHE"] = "off"
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["PORTAL_WRITE_QUEUE_PATH"] = \
+            os.path.join(directory, "write_queue.db")
+
+        import run
+
+        if args.scenario == "all":
+            scenarios = list(SCENARIO_WEIGHTS) + ["mixed"]
+        else:
+            scenarios = [args.scenario]
+
+        results = []
+
+        for scenario in scenarios:
+            # Each scenario gets its own write queue journal
+            os.environ["PORTAL_WRITE_QUEUE_PATH"] = \
+                os.path.join(directory, f"{scenario}.db")
+
+            benchmark = Benchmark(run, args)
+            results.append(benchmark.run(scenario, args.iterations))
+
+            if args.stats:
+                print(f"\n{scenario}:\n{STATS.summary()}")
+
+        print(f"\n{args.flights} flights x {args.passengers} passengers, \
+{args.latency}s latency, mode {args.mode}\n")
+        print_results(results)
+
+
+if __name__ == "__main__":
+    main()
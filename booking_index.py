@@ -0,0 +1,458 @@
+import functools
+import os
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import namedtuple
+from time import monotonic
+
+from gspread.utils import a1_to_rowcol
+
+from records import Passenger
+
+
+# Number of seconds the values of an indexed row are used to show a
+# passenger, before the row is read again (another terminal may have
+# changed it). Can be set with the PORTAL_HELD_ROW_TTL environment variable.
+HELD_ROW_TTL = float(os.environ.get("PORTAL_HELD_ROW_TTL", 60))
+
+# Location of a booking in the spreadsheet, plus the names needed to confirm
+# the passenger without reading the row again
+BookingLocation = namedtuple(
+    "BookingLocation", ["flight_no", "row", "last_name", "first_name"]
+)
+
+
+def row_from_append_response(response):
+    """
+    Get the row number that append_row() wrote to, taken from the
+    "updatedRange" (e.g. 'LA123'!A5:H5) in the API response
+    """
+    updated_range = response["updates"]["updatedRange"]
+    first_cell = re.split("[!:]", updated_range)[1]
+
+    return a1_to_rowcol(first_cell)[0]
+
+
+def locked(method):
+    """
+    Decorator that runs a method of an index while holding its lock, as the
+    index is updated by background threads (e.g. the write queue's) while
+    the portal reads it
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def name_key(text):
+    """
+    Put a name in the form used as a key of the search index: case-folded
+    (so "Smith", "SMITH" and "smith" are the same) with single spaces
+    """
+    return " ".join(str(text).casefold().split())
+
+
+def passport_key(text):
+    """
+    Put a passport number in the form used as a key of the search index:
+    upper case without spaces, as passport numbers are saved
+    """
+    return "".join(str(text).upper().split())
+
+
+class SearchIndex:
+    """
+    Secondary indexes of booking numbers for finding passengers without a
+    booking number:
+    - passport no -> booking numbers
+    - case-folded last name -> booking numbers
+    - a sorted array of case-folded "last name first names" and "first
+      names last name" keys, searched by binary search for every key
+      starting with a prefix of a name
+    """
+
+    def __init__(self):
+        self._by_passport = {}
+        self._by_last_name = {}
+        self._names = []
+
+        # Booking number -> its passport key, last name key and name keys,
+        # to remove its entries when the passenger changes or moves
+        self._keys = {}
+
+    def add(self, booking_no, last_name, first_names, passport_no):
+        """
+        Index a booking, replacing any entries it had
+        """
+        self.remove(booking_no)
+
+        passport = passport_key(passport_no)
+        last = name_key(last_name)
+        first = name_key(first_names)
+        names = sorted({name_key(f"{last} {first}"),
+                        name_key(f"{first} {last}")})
+
+        if passport:
+            self._by_passport.setdefault(passport, set()).add(booking_no)
+        if last:
+            self._by_last_name.setdefault(last, set()).add(booking_no)
+        for name in names:
+            insort(self._names, (name, booking_no))
+
+        self._keys[booking_no] = (passport, last, names)
+
+    def remove(self, booking_no):
+        """
+        Drop every entry of a booking
+        """
+        keys = self._keys.pop(booking_no, None)
+
+        if keys is None:
+            return
+
+        passport, last, names = keys
+
+        for index, key in [(self._by_passport, passport),
+                           (self._by_last_name, last)]:
+            booking_nos = index.get(key)
+
+            if booking_nos is not None:
+                booking_nos.discard(booking_no)
+
+                if not booking_nos:
+                    del index[key]
+
+        for name in names:
+            i = bisect_left(self._names, (name, booking_no))
+
+            if i < len(self._names) and self._names[i] == (name, booking_no):
+                del self._names[i]
+
+    def passport_of(self, booking_no):
+        """
+        Passport number the booking is indexed under, or None if it isn't
+        indexed
+        """
+        keys = self._keys.get(booking_no)
+
+        return keys[0] if keys else None
+
+    def passport(self, passport_no):
+        """
+        Set of booking numbers of passengers with the passport number
+        """
+        return set(self._by_passport.get(passport_key(passport_no), ()))
+
+    def last_name(self, last_name):
+        """
+        Set of booking numbers of passengers with the last name, whatever
+        its case
+        """
+        return set(self._by_last_name.get(name_key(last_name), ()))
+
+    def name_prefix(self, prefix):
+        """
+        Set of booking numbers of passengers with a last name or first
+        names (followed by the other) starting with the prefix, whatever
+        its case
+        """
+        prefix = name_key(prefix)
+        found = set()
+
+        if not prefix:
+            return found
+
+        # Keys starting with the prefix are next to each other in the
+        # sorted array, from the first key not before the prefix
+        for name, booking_no in self._names[bisect_left(self._names,
+                                                        (prefix,)):]:
+            if not name.startswith(prefix):
+                break
+
+            found.add(booking_no)
+
+        return found
+
+
+class BookingIndex:
+    """
+    In-memory index of booking number -> BookingLocation for every flight
+    worksheet.
+    Built from the values of every flight worksheet the first time it is
+    used, then kept up to date by add() whenever a booking is appended, so
+    that finding a booking does not need a search of every flight worksheet.
+    A booking that isn't found may have been made from another terminal, so
+    the rows added since are indexed and the booking looked for again.
+    The values of each indexed row are kept as well, so that a passenger
+    found through the index can be shown without reading their row again,
+    and a SearchIndex of passport numbers and names is kept alongside, so
+    passengers can be searched for without reading any worksheet.
+    Its methods hold a lock, so background threads (the write queue's, or
+    a warm cache check) can update it while the portal reads it.
+    """
+
+    def __init__(self, read_flight_worksheets, read_appended_rows=None,
+                 held_row_ttl=HELD_ROW_TTL):
+        # Function returning a (flight no, rows of values) pair for every
+        # flight worksheet
+        self._read_flight_worksheets = read_flight_worksheets
+
+        # Function taking a dict of flight no -> number of rows indexed and
+        # returning a (flight no, first row no, rows of values) triple for
+        # every flight worksheet with rows added since. Without it, the
+        # index is rebuilt instead.
+        self._read_appended_rows = read_appended_rows
+        self.held_row_ttl = held_row_ttl
+        self._locations = None
+
+        # Flight no -> heading row, flight no -> number of rows indexed,
+        # and (flight no, row) -> (time read, row values)
+        self._headings = {}
+        self._row_counts = {}
+        self._rows = {}
+
+        # (flight no, row) -> booking number in the row
+        self._booking_nos = {}
+
+        # Secondary indexes, only used while holding the lock
+        self.search_index = SearchIndex()
+
+        # Held while the index is read or changed
+        self._lock = threading.RLock()
+
+    @locked
+    def build(self):
+        """
+        (Re)build the index from the values of every flight worksheet
+        """
+        locations = {}
+        self._headings = {}
+        self._row_counts = {}
+        self._rows = {}
+        self._booking_nos = {}
+        self.search_index = SearchIndex()
+
+        for flight_no, rows in self._read_flight_worksheets():
+            self._index_rows(locations, flight_no, rows)
+
+        self._locations = locations
+
+    @locked
+    def reindex_flight(self, flight_no, rows):
+        """
+        Replace the index entries of one flight with its current rows, e.g.
+        after another terminal has moved them
+        """
+        if self._locations is None:
+            self.build()
+            return
+
+        for booking_no, location in self._locations.items():
+            if location.flight_no == flight_no:
+                self.search_index.remove(booking_no)
+
+        self._locations = {
+            booking_no: location
+            for booking_no, location in self._locations.items()
+            if location.flight_no != flight_no
+        }
+        self._rows = {
+            key: values for key, values in self._rows.items()
+            if key[0] != flight_no
+        }
+        self._booking_nos = {
+            key: booking_no for key, booking_no in self._booking_nos.items()
+            if key[0] != flight_no
+        }
+        self._index_rows(self._locations, flight_no, rows)
+
+    @locked
+    def reindex_flights(self, rows_by_flight):
+        """
+        Replace the index entries of several flights (a dict of flight no
+        -> current rows) together, so the index is never read with only
+        some of them replaced
+        """
+        for flight_no, rows in rows_by_flight.items():
+            self.reindex_flight(flight_no, rows)
+
+    def _index_rows(self, locations, flight_no, rows, first_row=1):
+        """
+        Add the passenger rows of a flight worksheet to locations, where
+        rows starts at row first_row of the worksheet.
+        Column positions are taken from the heading row (row 1).
+        """
+        # Row 1 is the heading row, so passengers start at row 2
+        if first_row == 1:
+            if not rows:
+                return
+
+            self._headings[flight_no] = rows[0]
+            rows = rows[1:]
+            first_row = 2
+
+        headings = self._headings[flight_no]
+        booking_no_i = headings.index("booking no")
+        last_name_i = headings.index("last name")
+        first_name_i = headings.index("first name(s)")
+        passport_no_i = headings.index("passport no")
+        self._row_counts[flight_no] = first_row - 1 + len(rows)
+        read_at = monotonic()
+
+        for row_no, row in enumerate(rows, start=first_row):
+            if len(row) <= booking_no_i or not row[booking_no_i]:
+                continue
+
+            booking_no = row[booking_no_i]
+            locations[booking_no] = BookingLocation(
+                flight_no, row_no, row[last_name_i], row[first_name_i]
+            )
+            self._rows[(flight_no, row_no)] = (read_at, row)
+            self._booking_nos[(flight_no, row_no)] = booking_no
+            self.search_index.add(booking_no, row[last_name_i],
+                                  row[first_name_i], row[passport_no_i])
+
+    @locked
+    def lookup(self, booking_no):
+        """
+        Return the BookingLocation of the passed booking number, or None.
+        A miss refreshes the index once, in case the booking was made from
+        another terminal since the index was built.
+        """
+        if self._locations is None:
+            self.build()
+            return self._locations.get(booking_no)
+
+        location = self._locations.get(booking_no)
+
+        if location is None:
+            self.refresh()
+            location = self._locations.get(booking_no)
+
+        return location
+
+    @locked
+    def refresh(self):
+        """
+        Index the rows added to the flight worksheets since they were
+        indexed, or rebuild the index if added rows can't be read alone
+        """
+        if self._read_appended_rows is None:
+            self.build()
+            return
+
+        row_counts = dict(self._row_counts)
+
+        for flight_no, first_row, rows in self._read_appended_rows(
+                row_counts):
+            self._index_rows(self._locations, flight_no, rows, first_row)
+
+    @locked
+    def add(self, booking_no, flight_no, row, last_name, first_name,
+            passport_no=""):
+        """
+        Record a newly appended booking.
+        Does nothing if the index hasn't been built yet, as the booking
+        will be picked up when it is.
+        """
+        if self._locations is None:
+            return
+
+        self._locations[booking_no] = BookingLocation(
+            flight_no, row, last_name, first_name
+        )
+        self._booking_nos[(flight_no, row)] = booking_no
+        self.search_index.add(booking_no, last_name, first_name, passport_no)
+
+        # Only counted as indexed if it directly follows the rows indexed,
+        # so rows added by other terminals before it are read by refresh()
+        if row == self._row_counts.get(flight_no, 0) + 1:
+            self._row_counts[flight_no] = row
+
+    @locked
+    def passenger(self, flight_no, row):
+        """
+        Return the Passenger record of the passed row as it was when
+        indexed (numbers converted as get_all_records() does), or None if
+        the row isn't held or was read longer than held_row_ttl seconds ago
+        """
+        held = self._rows.get((flight_no, row))
+
+        if held is None or monotonic() - held[0] > self.held_row_ttl:
+            return None
+
+        values = held[1]
+        decode = Passenger.decoder(self._headings[flight_no], numericise=True)
+
+        return decode(values)
+
+    @locked
+    def forget(self, flight_no, row, changes=None):
+        """
+        Drop the held values of a row that has been written to, so that it
+        is read again next time. changes (a dict of heading -> new value)
+        to the names or passport number are applied to the index.
+        """
+        self._rows.pop((flight_no, row), None)
+        booking_no = self._booking_nos.get((flight_no, row))
+
+        if not changes or booking_no is None:
+            return
+
+        passport_no = self.search_index.passport_of(booking_no)
+
+        if passport_no is None:
+            return
+
+        location = self._locations[booking_no]
+        last_name = changes.get("last name", location.last_name)
+        first_name = changes.get("first name(s)", location.first_name)
+
+        self._locations[booking_no] = location._replace(
+            last_name=last_name, first_name=first_name
+        )
+        self.search_index.add(booking_no, last_name, first_name,
+                              changes.get("passport no", passport_no))
+
+    @locked
+    def search(self, query, limit=None):
+        """
+        Return a list of (booking no, BookingLocation) pairs, in name
+        order, of passengers whose passport number or last name is the
+        query, or whose name starts with it, whatever its case. Nothing
+        found refreshes the index once, in case the passenger was booked
+        from another terminal since the index was built.
+        """
+        if self._locations is None:
+            self.build()
+
+        found = self._search(query, limit)
+
+        if not found:
+            self.refresh()
+            found = self._search(query, limit)
+
+        return found
+
+    def _search(self, query, limit):
+        """
+        Search the index without refreshing it. Every match is sorted
+        before the first limit are taken, as the name keys are in the
+        order of whichever name starts with the query, not by last name.
+        """
+        booking_nos = self.search_index.passport(query) \
+            | self.search_index.last_name(query) \
+            | self.search_index.name_prefix(query)
+
+        matches = sorted(
+            [(booking_no, self._locations[booking_no])
+             for booking_no in booking_nos if booking_no in self._locations],
+            key=lambda match: (name_key(match[1].last_name),
+                               name_key(match[1].first_name), match[0])
+        )
+
+        return matches[:limit]
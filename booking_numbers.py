@@ -0,0 +1,153 @@
+import os
+import random
+import string
+import threading
+
+
+# Two letters that every booking number made by this terminal starts with.
+# When several terminals share a spreadsheet, each one needs a different
+# block so that they can never generate the same booking number. One can
+# be given (e.g. PORTAL_TERMINAL_BLOCK=KD); otherwise a free block is
+# reserved for the terminal when it first makes a booking.
+TERMINAL_BLOCK = os.environ.get("PORTAL_TERMINAL_BLOCK")
+
+# File the block reserved for this terminal is kept in, so that it is
+# reused when the portal is started again. Can be set with the
+# PORTAL_TERMINAL_BLOCK_PATH environment variable.
+BLOCK_PATH = os.environ.get("PORTAL_TERMINAL_BLOCK_PATH",
+                            "terminal_block.txt")
+
+
+def block_marker(block):
+    """
+    Return the value recorded with the used booking numbers to reserve a
+    block. It can't be mistaken for a booking number.
+    """
+    return f"block {block}"
+
+
+def is_block(block):
+    """
+    Return True if the passed value can be a terminal block: 2 uppercase
+    letters
+    """
+    return len(block) == 2 and block.isalpha() and block.isupper()
+
+
+def random_letters():
+    """
+    Return 2 random uppercase letters
+    """
+    return "".join(random.choices(string.ascii_uppercase, k=2))
+
+
+def random_digits():
+    """
+    Return 2 random digits from 1 to 9
+    """
+    return "".join(str(random.randint(1, 9)) for i in range(2))
+
+
+class BookingNumberAllocator:
+    """
+    Generates unused booking numbers: 2 letters, 2 numbers, 2 letters,
+    2 numbers (e.g. TF78RE32), starting with the terminal's block.
+    Used booking numbers are read from storage once and kept in a set, so
+    checking a new number for a collision doesn't depend on how many
+    bookings there are. Numbers this allocator gives out are added to the
+    set. Numbers from other terminals can't collide, as each terminal has
+    its own block: without one given, a block no other terminal has
+    reserved is claimed in storage, and kept in block_path for the next
+    run.
+    """
+
+    def __init__(self, storage, block=TERMINAL_BLOCK, block_path=BLOCK_PATH):
+        if block is not None and not is_block(block):
+            raise ValueError("Terminal block must be 2 uppercase letters")
+
+        self.storage = storage
+        self.block = block
+        self.block_path = block_path
+        self._used = None
+        self._lock = threading.Lock()
+
+    def _used_booking_nos(self):
+        """
+        Set of used booking numbers, read from storage the first time, when
+        the terminal's block is recorded or reserved too
+        """
+        if self._used is None:
+            self._used = set(self.storage.used_booking_nos())
+
+            if self.block is None:
+                self.block = self._reserve_block()
+            elif block_marker(self.block) not in self._used:
+                # Recorded so that no other terminal reserves it
+                self.storage.claim_booking_no(block_marker(self.block))
+                self._used.add(block_marker(self.block))
+
+        return self._used
+
+    def _saved_block(self):
+        """
+        Block reserved by this terminal on an earlier run, or None
+        """
+        try:
+            with open(self.block_path, encoding="utf-8") as block_file:
+                block = block_file.read().strip()
+        except OSError:
+            return None
+
+        return block if is_block(block) else None
+
+    def _reserve_block(self):
+        """
+        Reserve a block that no other terminal has reserved, preferring the
+        one this terminal reserved before, and save it to block_path
+        """
+        saved = self._saved_block()
+
+        # Reserved by this terminal on an earlier run
+        if saved is not None and block_marker(saved) in self._used:
+            return saved
+
+        free_blocks = [a + b for a in string.ascii_uppercase
+                       for b in string.ascii_uppercase
+                       if block_marker(a + b) not in self._used]
+        random.shuffle(free_blocks)
+
+        if saved in free_blocks:
+            free_blocks.insert(0, saved)
+
+        for block in free_blocks:
+            marker = block_marker(block)
+            self._used.add(marker)
+
+            # Another terminal may have reserved it since the numbers were
+            # read, in which case the next one is tried
+            if self.storage.claim_booking_no(marker):
+                with open(self.block_path, "w",
+                          encoding="utf-8") as block_file:
+                    block_file.write(block)
+
+                return block
+
+        raise ValueError("Every terminal block is taken. Set \
+PORTAL_TERMINAL_BLOCK to a block this terminal can share.")
+
+    def allocate(self):
+        """
+        Generate a booking number that hasn't been used and mark it as used
+        """
+        with self._lock:
+            used = self._used_booking_nos()
+
+            while True:
+                booking_no = (self.block + random_digits()
+                              + random_letters() + random_digits())
+
+                # Check that booking number has not already been used
+                # If it has, generate a new one
+                if booking_no not in used:
+                    used.add(booking_no)
+                    return booking_no
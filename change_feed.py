@@ -0,0 +1,84 @@
+from gspread.utils import absolute_range_name
+
+
+# Last column read for appended rows, well past any column the portal uses
+LAST_COLUMN = "ZZ"
+
+
+class ChangeFeed:
+    """
+    Finds the rows added to the spreadsheet since the last sync, so that a
+    local copy can be brought up to date without reading it all again.
+    The spreadsheet's modified time is its revision marker: while it is
+    unchanged nothing more is read. Once it has changed, the rows after the
+    last row held of every worksheet are read with one batch request, so
+    the cost depends on how many rows were added, not on how many there are.
+    Rows changed in place by another terminal are not found, so copies are
+    still read in full now and then.
+    """
+
+    def __init__(self, get_spreadsheet, list_worksheets=None):
+        # Function returning the opened spreadsheet
+        self._get_spreadsheet = get_spreadsheet
+
+        # Function reading the spreadsheet's worksheets, in order, from its
+        # metadata (e.g. to keep a worksheet registry up to date)
+        self._list_worksheets = list_worksheets or \
+            (lambda: self._get_spreadsheet().worksheets())
+        self._revision = None
+
+    @property
+    def revision(self):
+        """
+        The spreadsheet's modified time at the last mark or sync
+        """
+        return self._revision
+
+    def current_revision(self):
+        """
+        Read the spreadsheet's modified time
+        """
+        spreadsheet = self._get_spreadsheet()
+        spreadsheet.refresh_lastUpdateTime()
+
+        return spreadsheet.lastUpdateTime
+
+    def mark(self, revision=None):
+        """
+        Record the current revision before the whole spreadsheet is read,
+        so that changes made while reading are found by the next sync. A
+        revision already read (e.g. that of a copy saved to disk) can be
+        passed instead.
+        """
+        self._revision = revision or self.current_revision()
+
+    def changes(self, row_counts, start=0):
+        """
+        Return a (title, first row no, rows) triple for every worksheet,
+        in spreadsheet order, with the rows after the row_counts[title]
+        rows already held. A worksheet that isn't in row_counts (e.g. a new
+        flight) is read from row 1. Worksheets before position start are
+        left out. Returns an empty list if nothing has changed since the
+        last sync.
+        """
+        revision = self.current_revision()
+
+        if revision == self._revision:
+            return []
+
+        spreadsheet = self._get_spreadsheet()
+        titles = [ws.title for ws in self._list_worksheets()[start:]]
+        first_rows = [row_counts.get(title, 0) + 1 for title in titles]
+
+        # Read the end of every worksheet with one request
+        response = spreadsheet.values_batch_get([
+            absolute_range_name(title, f"A{first_row}:{LAST_COLUMN}")
+            for title, first_row in zip(titles, first_rows)
+        ])
+        self._revision = revision
+
+        return [
+            (title, first_row, value_range.get("values", []))
+            for title, first_row, value_range
+            in zip(titles, first_rows, response["valueRanges"])
+        ]
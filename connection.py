@@ -0,0 +1,126 @@
+import threading
+
+# To read and update Google Sheets spreadsheet
+import gspread
+from google.oauth2.service_account import Credentials
+
+# To keep requests within the Sheets API quotas
+from scheduler import ScheduledClient
+
+
+SCOPE = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive.file",
+    "https://www.googleapis.com/auth/drive"
+    ]
+
+
+class SheetsConnection:
+    """
+    Connection to the project spreadsheet that only authorizes and opens
+    the spreadsheet the first time it is used.
+    connect_in_background() starts this in another thread, so the network
+    handshake can happen while the program does something else.
+    Worksheets are looked up in a registry of title -> worksheet, loaded
+    from the spreadsheet's metadata once rather than on every
+    spreadsheet.worksheet() call, and loaded again only when a title isn't
+    in it (e.g. a flight added since).
+    """
+
+    def __init__(self, creds_file="creds.json",
+                 spreadsheet_name="magnolia_airport", client=None):
+        self.creds_file = creds_file
+        self.spreadsheet_name = spreadsheet_name
+        self._spreadsheet = None
+
+        # gspread client to open the spreadsheet with, instead of one
+        # authorized with the credentials (e.g. one talking to a fake
+        # spreadsheet in benchmarks)
+        self.client = client
+
+        # Held while connecting, so a second caller waits for the first
+        # connection instead of starting another
+        self._lock = threading.Lock()
+
+        # Worksheet title -> worksheet, in spreadsheet order, or None if
+        # not yet loaded
+        self._worksheets = None
+        self._worksheets_lock = threading.Lock()
+
+    def _connect(self):
+        """
+        Authorize with the service account credentials and open the
+        spreadsheet
+        """
+        if self.client is None:
+            creds = Credentials.from_service_account_file(self.creds_file)
+            scoped_creds = creds.with_scopes(SCOPE)
+            self.client = gspread.authorize(scoped_creds,
+                                            client_factory=ScheduledClient)
+
+        self._spreadsheet = self.client.open(self.spreadsheet_name)
+
+    @property
+    def spreadsheet(self):
+        """
+        The opened spreadsheet, connecting first if not yet connected
+        """
+        with self._lock:
+            if self._spreadsheet is None:
+                self._connect()
+
+        return self._spreadsheet
+
+    def refresh_worksheets(self):
+        """
+        Load the spreadsheet's worksheets into the registry, with one
+        metadata request, and return them in spreadsheet order
+        """
+        worksheets = self.spreadsheet.worksheets()
+
+        with self._worksheets_lock:
+            self._worksheets = {ws.title: ws for ws in worksheets}
+
+        return worksheets
+
+    def worksheets(self):
+        """
+        Return every worksheet in spreadsheet order, from the registry
+        """
+        if self._worksheets is None:
+            return self.refresh_worksheets()
+
+        return list(self._worksheets.values())
+
+    def worksheet(self, title):
+        """
+        Return the worksheet with the passed title, from the registry if it
+        is there. Otherwise the registry is loaded again, and
+        gspread.exceptions.WorksheetNotFound raised if it still isn't.
+        """
+        worksheets = self._worksheets
+
+        if worksheets is None or title not in worksheets:
+            worksheets = {ws.title: ws for ws in self.refresh_worksheets()}
+
+            if title not in worksheets:
+                raise gspread.exceptions.WorksheetNotFound(title)
+
+        return worksheets[title]
+
+    def connect_in_background(self):
+        """
+        Start connecting in a background thread and return straight away
+        """
+        def connect():
+            # Errors are not raised here: the next use of the spreadsheet
+            # will try to connect again and raise them in the main thread
+            try:
+                self.spreadsheet
+
+                if self._worksheets is None:
+                    self.refresh_worksheets()
+            except Exception:
+                pass
+
+        threading.Thread(target=connect, daemon=True).start()
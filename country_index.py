@@ -0,0 +1,130 @@
+import difflib
+import unicodedata
+
+# To get a list of the world's countries
+from pycountry import countries
+
+
+# Common names that aren't in pycountry, with the alpha-2 code of the
+# country they mean
+ALIASES = {
+    "UK": "GB",
+    "GREAT BRITAIN": "GB",
+    "BRITAIN": "GB",
+    "ENGLAND": "GB",
+    "SCOTLAND": "GB",
+    "WALES": "GB",
+    "NORTHERN IRELAND": "GB",
+    "USA": "US",
+    "AMERICA": "US",
+    "HOLLAND": "NL",
+    "RUSSIA": "RU",
+    "IRAN": "IR",
+    "SYRIA": "SY",
+    "LAOS": "LA",
+    "IVORY COAST": "CI",
+    "BURMA": "MM",
+    "UAE": "AE",
+    "VATICAN": "VA",
+    "VATICAN CITY": "VA",
+    "MACEDONIA": "MK",
+    "SWAZILAND": "SZ",
+    "CAPE VERDE": "CV",
+    "TURKIYE": "TR",
+    "PALESTINE": "PS",
+    "DRC": "CD",
+    "DR CONGO": "CD",
+    "DEMOCRATIC REPUBLIC OF THE CONGO": "CD",
+    "REPUBLIC OF THE CONGO": "CG",
+    "BRUNEI": "BN",
+    "MICRONESIA": "FM",
+    "FALKLAND ISLANDS": "FK",
+}
+
+# Most suggestions offered for a name that isn't recognised
+MAX_SUGGESTIONS = 3
+
+
+def normalise(text):
+    """
+    Put a country name in the form used as a key of the index: upper case,
+    accents and full stops removed (e.g. "U.K." -> "UK") and single spaces
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+
+    return " ".join(text.replace(".", "").upper().split())
+
+
+class CountryIndex:
+    """
+    Hash map of every accepted way of writing a country (name, official
+    name, common name, alpha-2 and alpha-3 codes and the aliases above) to
+    the country's name in upper case, as saved in the spreadsheet.
+    Built the first time it is used rather than at start up.
+    """
+
+    def __init__(self, aliases=ALIASES):
+        self.aliases = aliases
+        self._names = None
+
+    def _build(self):
+        """
+        Build the index from the pycountry countries object
+        """
+        names = {}
+
+        for country in countries:
+            name = country.name.upper()
+
+            for key in (country.name, getattr(country, "official_name", None),
+                        getattr(country, "common_name", None),
+                        country.alpha_2, country.alpha_3):
+                if key:
+                    names[normalise(key)] = name
+
+        for alias, alpha_2 in self.aliases.items():
+            names[normalise(alias)] = \
+                countries.get(alpha_2=alpha_2).name.upper()
+
+        self._names = names
+
+    @property
+    def names(self):
+        """
+        Dict of normalised key -> country name, built if not yet built
+        """
+        if self._names is None:
+            self._build()
+
+        return self._names
+
+    def lookup(self, text):
+        """
+        Return the country name for the passed text, or None if it isn't a
+        recognised way of writing a country
+        """
+        return self.names.get(normalise(text))
+
+    def suggest(self, text, limit=MAX_SUGGESTIONS):
+        """
+        Return up to limit country names that the passed text is most
+        likely a misspelling of, best match first
+        """
+        # Codes are left out, as any 2 or 3 letters are close to some code
+        keys = [key for key in self.names if len(key) > 3]
+        matches = difflib.get_close_matches(normalise(text), keys,
+                                            n=limit * 3, cutoff=0.75)
+
+        suggestions = []
+        for key in matches:
+            name = self.names[key]
+
+            if name not in suggestions:
+                suggestions.append(name)
+
+        return suggestions[:limit]
+
+
+# Shared by every nationality check
+COUNTRY_INDEX = CountryIndex()
@@ -0,0 +1,88 @@
+import os
+from time import monotonic
+
+from records import Flight
+
+
+# Number of seconds the flights worksheet is kept in memory before it is
+# read again. Can be set with the FLIGHTS_CACHE_TTL environment variable.
+FLIGHTS_CACHE_TTL = float(os.environ.get("FLIGHTS_CACHE_TTL", 300))
+
+
+class FlightsCache:
+    """
+    In-memory copy of the flights worksheet.
+    The whole worksheet is read with a single request, then every read is
+    served from memory until the copy is older than the TTL or a write made
+    through the cache invalidates it.
+    """
+
+    def __init__(self, worksheet, ttl=FLIGHTS_CACHE_TTL):
+        self.worksheet = worksheet
+        self.ttl = ttl
+        self._headings = None
+        self._rows = None
+        self._loaded_at = None
+
+    def load(self):
+        """
+        Read the whole flights worksheet into memory
+        """
+        values = self.worksheet.get_all_values()
+
+        self._headings = values[0] if values else []
+        # Pad short rows so every row has a value for every heading
+        self._rows = [
+            row + [""] * (len(self._headings) - len(row))
+            for row in values[1:]
+        ]
+        self._loaded_at = monotonic()
+
+    def invalidate(self):
+        """
+        Drop the in-memory copy so that the next read loads the worksheet
+        """
+        self._loaded_at = None
+
+    def _ensure_fresh(self):
+        """
+        Load the worksheet if it has never been loaded, was invalidated or
+        is older than the TTL
+        """
+        if (self._loaded_at is None
+                or monotonic() - self._loaded_at > self.ttl):
+            self.load()
+
+    @property
+    def headings(self):
+        """
+        List of the worksheet's column headings (row 1)
+        """
+        self._ensure_fresh()
+        return self._headings
+
+    def snapshot(self):
+        """
+        Return every flight as a Flight record, with values left as the
+        strings read from the worksheet
+        """
+        self._ensure_fresh()
+        decode = Flight.decoder(self._headings)
+
+        return [decode(row) for row in self._rows]
+
+    def update_cell(self, row, col, value):
+        """
+        Write a cell to the flights worksheet and invalidate the cache
+        """
+        self.worksheet.update_cell(row, col, value)
+        self.invalidate()
+
+    def append_row(self, values):
+        """
+        Append a flight to the flights worksheet and invalidate the cache
+        """
+        response = self.worksheet.append_row(values)
+        self.invalidate()
+
+        return response
@@ -0,0 +1,291 @@
+import functools
+import json
+import os
+import sys
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from time import perf_counter
+
+
+# Upper bounds in milliseconds of the latency histogram buckets. Slower
+# calls go in a last bucket with no upper bound.
+LATENCY_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+# File that every API call and operation is appended to as a line of JSON,
+# if set with the PORTAL_STATS_LOG environment variable
+STATS_LOG = os.environ.get("PORTAL_STATS_LOG")
+
+# Operations running in the current thread (or the thread that started a
+# parallel read), innermost last, each a list holding its API call count
+_active_operations = ContextVar("active_operations", default=())
+
+
+class Histogram:
+    """
+    Count of values in each latency bucket, with their total, minimum and
+    maximum, so percentiles can be estimated without keeping every value
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, ms):
+        """
+        Add a latency in milliseconds
+        """
+        self.counts[bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+
+    def percentile(self, share):
+        """
+        Return the upper bound of the bucket holding the passed share (e.g.
+        0.95) of values, or the maximum if that is in the last bucket
+        """
+        if not self.count:
+            return None
+
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+
+            if seen >= share * self.count:
+                return min(bound, self.max)
+
+        return self.max
+
+    def as_dict(self):
+        """
+        The histogram as a dict, with "le <bound>" keys for the buckets
+        """
+        bounds = [f"le {bound}" for bound in self.buckets] + ["le inf"]
+
+        return {
+            "count": self.count,
+            "mean ms": round(self.total / self.count, 1) if self.count
+            else None,
+            "min ms": self.min,
+            "p50 ms": self.percentile(0.5),
+            "p95 ms": self.percentile(0.95),
+            "max ms": self.max,
+            "buckets": dict(zip(bounds, self.counts))
+        }
+
+
+class Stats:
+    """
+    In-process counters and latency histograms of:
+    - API calls, by the gspread method that made them (e.g.
+      "Worksheet.get_all_values")
+    - portal operations (e.g. "book" or "check in"), with the number of API
+      calls each one made
+    Every call and operation can also be appended to a JSON lines log.
+    """
+
+    def __init__(self, log_path=STATS_LOG):
+        self.log_path = log_path
+        self._log = None
+
+        # (kind, name) -> Histogram, where kind is "api" or "operation"
+        self.latencies = {}
+
+        # (kind, name) -> number of calls that raised an error
+        self.errors = {}
+
+        # Operation name -> API calls made by all its runs
+        self.operation_calls = {}
+
+        self._lock = threading.Lock()
+
+    def _record(self, kind, name, ms, error, api_calls=None):
+        """
+        Add a call or operation to the histograms and the log
+        """
+        key = (kind, name)
+
+        with self._lock:
+            if key not in self.latencies:
+                self.latencies[key] = Histogram()
+                self.errors[key] = 0
+
+            self.latencies[key].add(ms)
+            self.errors[key] += error
+
+            if api_calls is not None:
+                self.operation_calls[name] = \
+                    self.operation_calls.get(name, 0) + api_calls
+
+            if self.log_path:
+                self._write_log({
+                    "time": datetime.now(timezone.utc).isoformat(),
+                    "kind": kind,
+                    "name": name,
+                    "ms": round(ms, 1),
+                    "error": bool(error),
+                    "api calls": api_calls
+                })
+
+    def _write_log(self, entry):
+        """
+        Append an entry to the JSON lines log, opening it the first time
+        """
+        if self._log is None:
+            self._log = open(self.log_path, "a", buffering=1)
+
+        self._log.write(json.dumps(entry) + "\n")
+
+    @contextmanager
+    def api_call(self, name):
+        """
+        Time an API call made inside the with block, and count it towards
+        every operation running
+        """
+        with self._lock:
+            for calls in _active_operations.get():
+                calls[0] += 1
+
+        started_at = perf_counter()
+        error = False
+
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self._record("api", name, (perf_counter() - started_at) * 1000,
+                         error)
+
+    @contextmanager
+    def operation(self, name):
+        """
+        Time a portal operation run inside the with block, and count the
+        API calls it makes
+        """
+        calls = [0]
+        token = _active_operations.set(_active_operations.get() + (calls,))
+        started_at = perf_counter()
+        error = False
+
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            _active_operations.reset(token)
+            self._record("operation", name,
+                         (perf_counter() - started_at) * 1000, error,
+                         calls[0])
+
+    def reset(self):
+        """
+        Forget every call and operation recorded so far
+        """
+        with self._lock:
+            self.latencies = {}
+            self.errors = {}
+            self.operation_calls = {}
+
+    def as_dict(self):
+        """
+        Every histogram as a dict of "api" and "operation" -> name -> stats
+        """
+        stats = {"api": {}, "operation": {}}
+
+        with self._lock:
+            for (kind, name), histogram in sorted(self.latencies.items()):
+                entry = histogram.as_dict()
+                entry["errors"] = self.errors[(kind, name)]
+
+                if kind == "operation":
+                    entry["api calls"] = self.operation_calls[name]
+
+                stats[kind][name] = entry
+
+        return stats
+
+    def summary(self):
+        """
+        Return a printable table of the calls and operations recorded
+        """
+        stats = self.as_dict()
+        lines = []
+
+        for kind, title in [("operation", "Portal operations"),
+                            ("api", "API calls")]:
+            if not stats[kind]:
+                continue
+
+            lines.append(f"{title}:")
+            lines.append(f"   {'name':<32}{'count':>6}{'errors':>7}\
+{'calls':>6}{'mean':>8}{'p50':>7}{'p95':>7}{'max':>8}")
+
+            for name, entry in stats[kind].items():
+                calls = entry.get("api calls", "")
+                lines.append(f"   {name:<32}{entry['count']:>6}\
+{entry['errors']:>7}{calls:>6}{entry['mean ms']:>8.0f}\
+{entry['p50 ms']:>7.0f}{entry['p95 ms']:>7.0f}{entry['max ms']:>8.0f}")
+
+        if not lines:
+            return "No API calls or operations recorded."
+
+        lines.append("(times in milliseconds)")
+
+        return "\n".join(lines)
+
+
+# Shared by the whole program
+STATS = Stats()
+
+
+def timed(name):
+    """
+    Decorator that records each call of the function as the named
+    operation
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with STATS.operation(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def gspread_method_name():
+    """
+    Return the name of the public gspread method (e.g.
+    "Worksheet.get_all_values") that the portal called to make the current
+    API request, found from the call stack
+    """
+    frame = sys._getframe(1)
+    name = "unknown"
+
+    # The outermost gspread frame is the method the portal called. Wrapper
+    # functions of decorators are skipped.
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+
+        if module == "gspread" or module.startswith("gspread."):
+            code = frame.f_code
+            qualname = getattr(code, "co_qualname", code.co_name)
+
+            if "<locals>" not in qualname:
+                name = qualname
+
+        frame = frame.f_back
+
+    return name
@@ -0,0 +1,115 @@
+import contextvars
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+
+
+# Most requests run at the same time by run_in_parallel()
+MAX_PARALLEL_REQUESTS = int(os.environ.get("PORTAL_MAX_PARALLEL", 8))
+
+# Sheets API read requests allowed per minute (the default quota per user)
+READS_PER_MINUTE = int(os.environ.get("PORTAL_READS_PER_MINUTE", 60))
+
+# Seconds over which requests are counted towards a per-minute quota: a
+# second more than a minute, as a request reaches the API a little after
+# it is sent, and not always in the order sent
+QUOTA_WINDOW = 61
+
+
+class SlidingWindowLimiter:
+    """
+    Rate limiter that allows at most `limit` requests in any `window`
+    seconds, counting the times of the requests made in the last window.
+    It never allows more than the limit in a window, as the Sheets API
+    quotas are counted per minute.
+    """
+
+    def __init__(self, limit, window=QUOTA_WINDOW):
+        self.limit = limit
+        self.window = window
+
+        # Requests per second allowed on average, over a minute
+        self.rate = limit / 60
+        self._times = deque()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def _forget_old(self, now):
+        """
+        Drop the times of requests made before the current window
+        """
+        while self._times and self._times[0] <= now - self.window:
+            self._times.popleft()
+
+    def acquire(self):
+        """
+        Count a request, waiting until it is within the limit
+        """
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._forget_old(now)
+
+                if now >= self._paused_until and \
+                        len(self._times) < self.limit:
+                    self._times.append(now)
+                    return
+
+                # Wait for the pause to end and the oldest request to
+                # leave the window
+                wait = self._paused_until - now
+
+                if len(self._times) >= self.limit:
+                    wait = max(wait, self._times[0] + self.window - now)
+
+            sleep(wait)
+
+    def empty(self):
+        """
+        Pause requests for one request's share of the window, e.g. after a
+        request was rejected for exceeding the quota, so that the next
+        requests slow down
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until,
+                                     monotonic() + 1 / self.rate)
+
+    @property
+    def available(self):
+        """
+        Number of requests that can be made now without waiting
+        """
+        with self._lock:
+            now = monotonic()
+            self._forget_old(now)
+
+            if now < self._paused_until:
+                return 0
+
+            return self.limit - len(self._times)
+
+
+# Shared by all Sheets reads, so together they stay within the quota in any
+# minute. The request scheduler counts each read it sends.
+READ_LIMITER = SlidingWindowLimiter(READS_PER_MINUTE)
+
+
+def run_in_parallel(calls, max_workers=MAX_PARALLEL_REQUESTS):
+    """
+    Call every function in calls, at most max_workers at the same time.
+    Returns their results in the same order as calls. The first error
+    raised by a call is raised again.
+    Each call runs in a copy of the caller's context, so requests made in
+    the worker threads still count towards the caller's operation. The
+    reads they make are limited by the request scheduler.
+    """
+    contexts = [contextvars.copy_context() for call in calls]
+
+    if len(calls) <= 1:
+        return [context.run(call) for context, call in zip(contexts, calls)]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda context, call: context.run(call),
+                                 contexts, calls))
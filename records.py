@@ -0,0 +1,134 @@
+from gspread.utils import numericise_all
+
+
+class Record:
+    """
+    Base of the flight and passenger records. Each record holds one value
+    per worksheet heading in attributes declared in __slots__, so it needs
+    much less memory than a dict of heading -> value, and large listings
+    stay small.
+    """
+
+    __slots__ = ()
+
+    # Worksheet heading -> attribute name, in column order
+    FIELDS = {}
+
+    def __init__(self, *values):
+        # Values left out at the end (e.g. an empty "checked in" cell) are
+        # empty strings, as they are in the worksheet
+        values += ("",) * (len(self.__slots__) - len(values))
+
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def decoder(cls, headings, numericise=False):
+        """
+        Return a function that turns a row of worksheet values into a
+        record. Column positions are found from the heading row once, so
+        decoding each row is only a few list lookups. If numericise is
+        True, numbers are converted as get_all_records() does.
+        """
+        columns = [headings.index(heading) for heading in cls.FIELDS]
+
+        def decode(row):
+            values = [row[i] if i < len(row) else "" for i in columns]
+
+            if numericise:
+                values = numericise_all(values)
+
+            return cls(*values)
+
+        return decode
+
+    @classmethod
+    def from_dict(cls, record):
+        """
+        Make a record from a dict of heading -> value
+        """
+        return cls(*[record.get(heading, "") for heading in cls.FIELDS])
+
+    def get(self, heading):
+        """
+        Return the value under the passed worksheet heading
+        """
+        return getattr(self, self.FIELDS[heading])
+
+    def values(self):
+        """
+        List of the record's values, in column order
+        """
+        return [getattr(self, name) for name in self.__slots__]
+
+    def items(self):
+        """
+        List of (heading, value) pairs, in column order
+        """
+        return list(zip(self.FIELDS, self.values()))
+
+    def as_dict(self):
+        """
+        The record as a dict of heading -> value
+        """
+        return dict(self.items())
+
+    def replace(self, changes):
+        """
+        Return a copy of the record with the values in changes, a dict of
+        heading -> new value
+        """
+        values = [changes.get(heading, value)
+                  for heading, value in self.items()]
+
+        return type(self)(*values)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.values() == other.values()
+
+    def __repr__(self):
+        values = ", ".join(repr(value) for value in self.values())
+
+        return f"{type(self).__name__}({values})"
+
+
+class Flight(Record):
+    """
+    A row of the flights worksheet
+    """
+
+    FIELDS = {
+        "flight no": "flight_no",
+        "destination": "destination",
+        "date": "date",
+        "departure time": "departure_time",
+        "arrival time": "arrival_time"
+    }
+
+    __slots__ = tuple(FIELDS.values())
+
+
+class Passenger(Record):
+    """
+    A row of a flight worksheet
+    """
+
+    FIELDS = {
+        "first name(s)": "first_names",
+        "last name": "last_name",
+        "date of birth": "date_of_birth",
+        "passport no": "passport_no",
+        "nationality": "nationality",
+        "luggage": "luggage",
+        "booking no": "booking_no",
+        "checked in": "checked_in"
+    }
+
+    __slots__ = tuple(FIELDS.values())
+
+    @property
+    def name(self):
+        """
+        First name(s) and last name
+        """
+        return f"{self.first_names} {self.last_name}"
@@ -1,15 +1,5 @@
-# To read and update Google Sheets spreadsheet
-import gspread
-from google.oauth2.service_account import Credentials
-
-import random
-import string
-
 from datetime import datetime
 
-# To get a list of the world's countries
-from pycountry import countries
-
 # To print to the terminal in color
 from termcolor import colored, cprint
 
@@ -21,50 +11,81 @@ from halo import Halo
 # To create tables of data
 from tabulate import tabulate
 
+# Raised when a spreadsheet request fails, even after retries
+from gspread.exceptions import APIError
+
 # Modules for slow_print and creating time delay
 import sys
 from time import sleep
 
+# The portal's operations, which read and update flights and passengers
+# in the spreadsheet (or a SQLite database)
+from service import (BOOKING_DETAILS, MAX_SEARCH_RESULTS, BookingNotFound,
+                     PortalError, PortalService)
 
-SCOPE = [
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive.file",
-    "https://www.googleapis.com/auth/drive"
-    ]
+# Raised when another terminal keeps moving the passenger being changed
+from storage import ConflictError
 
-CREDS = Credentials.from_service_account_file('creds.json')
-SCOPED_CREDS = CREDS.with_scopes(SCOPE)
-GSPREAD_CLIENT = gspread.authorize(SCOPED_CREDS)
-SHEET = GSPREAD_CLIENT.open('magnolia_airport')
+# To check passenger details entered by the user
+from validation import validate_passenger_detail
 
+# Counts and times of spreadsheet requests and portal operations
+from instrumentation import STATS
 
-# Flights worksheet in project spreadsheet
-FLIGHTS_WS = SHEET.worksheet("flights")
 
-# List of countries, taken from pycountry countries object
-# Note that this list is not perfect - includes some subdivisions of countries,
-# e.g. individual islands
-COUNTRIES = [country.name.upper() for country in countries]
+# Operations on the storage chosen with PORTAL_STORAGE, created by
+# start_program() so that importing this module opens no storage (or set
+# directly, e.g. by the benchmark, to run the UI functions on another one)
+SERVICE = None
+
+# Desk mode, for busy check in desks: no slow printing, pauses, spinner
+# animations or clearing of the terminal. Turned on with
+# "python3 run.py --fast" or the PORTAL_FAST environment variable.
+FAST_MODE = "--fast" in sys.argv[1:] or \
+    os.environ.get("PORTAL_FAST", "off") == "on"
+
+# Print the number and times of spreadsheet requests and portal operations
+# on exit. Turned on with "python3 run.py --stats" or PORTAL_STATS.
+SHOW_STATS = "--stats" in sys.argv[1:] or \
+    os.environ.get("PORTAL_STATS", "off") == "on"
+
 
 # Add a symbol ("Question Symbol") in front of every user input request
 Q_S = "▹▹▹▹▸ "
 
+# Number of passengers printed before asking to show more
+MANIFEST_PAGE_SIZE = 10
+
 # Spinner for run time consuming code
-LOADING_SPINNER = Halo(text="Loading...", spinner="earth")
+LOADING_SPINNER = Halo(text="Loading...", spinner="earth",
+                       enabled=not FAST_MODE)
+
+
+# Spinners made by the program running, stopped if it ends with an error
+SPINNERS = []
+
+# Number of changes that could not be saved that the user has been told of
+FAILED_WRITES_SHOWN = 0
 
 
 def spinner(text):
     """
     Returns a spinner with passed text
     """
-    return Halo(text=text, spinner="earth")
+    new_spinner = Halo(text=text, spinner="earth", enabled=not FAST_MODE)
+    SPINNERS.append(new_spinner)
+
+    return new_spinner
 
 
 def clear():
     """
-    Clears terminal
+    Clears terminal, or prints a blank line in desk mode
     """
-    print("\033c")
+    if FAST_MODE:
+        print()
+    else:
+        print("\033c")
 
 
 def print_red(text):
@@ -83,8 +104,12 @@ def print_green(text):
 
 def print_slow(text):
     """
-    Print text slowly (one letter at a time)
+    Print text slowly (one letter at a time), or all at once in desk mode
     """
+    if FAST_MODE:
+        print(text)
+        return ""
+
     for letter in text:
         sys.stdout.write(letter)
         sys.stdout.flush()
@@ -93,39 +118,48 @@ def print_slow(text):
     return ""
 
 
-def type_yes_no():
+def pause(seconds):
     """
-    Micro function to tell user to input 'yes' or 'no' only
+    Wait for the passed number of seconds, unless in desk mode
     """
-    print_red(f"Please type 'yes' or 'no' only.\n")
+    if not FAST_MODE:
+        sleep(seconds)
 
 
-def get_flights_ws_column_no(heading):
+def print_banner():
+    """
+    Print the colored airport banner
+    """
+    with open("banner.txt") as f:
+        banner = f.read()
+
+    print(colored(banner, "black", "on_light_cyan"))
+
+
+def type_yes_no():
     """
-    Get the column number of the passed heading in the flights worksheet.
-    Column order can be changed or new columns added without breaking the
-    program
+    Micro function to tell user to input 'yes' or 'no' only
     """
-    return FLIGHTS_WS.find(heading).col
+    print_red(f"Please type 'yes' or 'no' only.\n")
 
 
 def readable_passenger_details(passenger):
     """
     Create a string with the details for the passed passenger, printed
     in a human-readable format.
-    Passenger to be passed as a dictionary.
+    Passenger to be passed as a Passenger record.
     """
-    name = f"{passenger['first name(s)']} {passenger['last name']}"
-    readable_details = name
+    name = passenger.name
+    lines = [name]
 
-    # Add line for each detail except first and last name to string
+    # Add line for each detail except first and last name
     for key, value in passenger.items():
         if key == "first name(s)" or key == "last name" or key == "checked in":
             continue
 
-        readable_details += (f"\n   {key.capitalize()}: {value}")
+        lines.append(f"   {key.capitalize()}: {value}")
 
-    readable_details += f"\n"
+    readable_details = "\n".join(lines) + "\n"
 
     passenger_info = {
         "name": name,
@@ -200,41 +234,26 @@ def display_all_flights():
     finding_flights_spinner = spinner("Retrieving flights...")
     finding_flights_spinner.start()
 
-    # Get all flights info as a list of dicts
-    all_flights = FLIGHTS_WS.get_all_records()
-
-    # Remove keys and data that doesn't need to be printed to terminal,
-    # and format flight date
-    for flight in all_flights:
-        # Get a set of the keys to be removed
-        all_keys = set(flight.keys())
-        desired_keys = {
-            "flight no",
-            "destination",
-            "date",
-            "departure time",
-            "arrival time"
-        }
-        other_keys = all_keys - desired_keys
-
-        for key in other_keys:
-            del flight[key]
-
-        # Format flight date
-        flight["date"] = format_flight_date(flight["date"], True)
+    # Get all flights as a list of Flight records
+    all_flights = SERVICE.flights()
 
-        # Rename departure and arrival time keys so they will fit
-        # in table heading
-        flight["departure"] = flight["departure time"]
-        flight["arrival"] = flight["arrival time"]
-        del flight["departure time"]
-        del flight["arrival time"]
+    # Make a table row of the details to be printed for each flight, with
+    # the flight date formatted
+    flight_rows = [
+        [flight.flight_no, flight.destination,
+         format_flight_date(flight.date, True),
+         flight.departure_time, flight.arrival_time]
+        for flight in all_flights
+    ]
 
     # Stop loading spinner
     finding_flights_spinner.stop()
 
-    # Create a table of all flights
-    flights_table = tabulate(all_flights, headers="keys",
+    # Create a table of all flights, with departure and arrival time
+    # headings shortened so they will fit
+    flights_table = tabulate(flight_rows,
+                             headers=["flight no", "destination", "date",
+                                      "departure", "arrival"],
                              tablefmt="fancy_grid")
 
     return flights_table
@@ -252,8 +271,7 @@ def view_all_passengers_of_flight():
     LOADING_SPINNER.start()
 
     # Get all flight nos
-    flight_nos_column = get_flights_ws_column_no("flight no")
-    flight_nos = FLIGHTS_WS.col_values(flight_nos_column)
+    flight_nos = [flight.flight_no for flight in SERVICE.flights()]
 
     # Stop loading spinner
     LOADING_SPINNER.stop()
@@ -270,7 +288,7 @@ def view_all_passengers_of_flight():
                 print(display_all_flights())
             elif flight in flight_nos:
                 # Print each passenger as a formatted string
-                print(f"\n", get_all_passengers_of_flight(flight))
+                print_passenger_manifest(flight)
                 break
             else:
                 raise ValueError("Invalid flight number")
@@ -280,34 +298,68 @@ def view_all_passengers_of_flight():
 or 'flights' to view all flights.\n")
 
 
-def get_all_passengers_of_flight(flight_number):
+def print_passenger_manifest(flight_number):
     """
-    View all passengers and their details on the flight with the
-    provided number
+    Print all passengers and their details on the flight with the provided
+    number as they are read, asking before each new page of passengers
     """
+    # Ask whether passengers who have checked in should be left out
+    while True:
+        waiting_only = input(f"\n{Q_S}Show only passengers not yet checked \
+in? (yes/no)\n").lower()
+
+        if waiting_only == "yes" or waiting_only == "no":
+            break
+        else:
+            type_yes_no()
+
     print()
     passenger_details_spinner = spinner("Retrieving passenger details...")
     passenger_details_spinner.start()
 
-    worksheet_to_view = SHEET.worksheet(flight_number)
+    passengers = get_all_passengers_of_flight(flight_number,
+                                              waiting_only == "yes")
+    shown = 0
 
-    # Get passenger info as a list of dictionaries
-    passengers = worksheet_to_view.get_all_records()
+    for details in passengers:
+        if shown == 0:
+            passenger_details_spinner.stop()
+            print()
+        # After each full page, check if the user wants to see more
+        elif shown % MANIFEST_PAGE_SIZE == 0:
+            more = input(f"{Q_S}Press enter to see more passengers, or type \
+'main' to return to the main program:\n").lower()
+
+            if more == "main":
+                # Stop reading the rest of the passengers
+                passengers.close()
+                return
 
-    # If no passengers on flight, state this in a message
-    if len(passengers) == 0:
-        passengers_display_string = f"No passengers on flight {flight_number}."
-    # Otherwise, create readable string of all passengers' details
-    else:
-        passengers_display_string = ""
+            print()
+
+        print(details)
+        shown += 1
 
-        for passenger in passengers:
-            details = readable_passenger_details(passenger)["readable_details"]
-            passengers_display_string += f"{details}\n"
+    # If no passengers to show, state this in a message
+    if shown == 0:
+        passenger_details_spinner.stop()
 
-    passenger_details_spinner.stop()
+        if waiting_only == "yes":
+            print(f"\nNo passengers waiting to check in on flight \
+{flight_number}.")
+        else:
+            print(f"\nNo passengers on flight {flight_number}.")
 
-    return passengers_display_string
+
+def get_all_passengers_of_flight(flight_number, waiting_only=False):
+    """
+    Yield the details of each passenger on the flight with the provided
+    number as a printable string, as the passengers are read.
+    If waiting_only is True, passengers who have checked in are left out.
+    """
+    # Passengers are read from storage a page at a time
+    for passenger in SERVICE.passengers(flight_number, waiting_only):
+        yield readable_passenger_details(passenger)["readable_details"]
 
 
 def ticket_booking_program():
@@ -330,10 +382,12 @@ def book_ticket():
     loading_destinations_spinner = spinner("Loading destinations...")
     loading_destinations_spinner.start()
 
-    # From spreadsheet, pull all flight destinations
-    destinations_column = get_flights_ws_column_no("destination")
-    destinations_list = FLIGHTS_WS.col_values(destinations_column)[1:]
-    destinations_set = set(destinations_list)
+    # Take one snapshot of all flights, used for every flight detail shown
+    # and saved during this booking
+    all_flights = SERVICE.flights()
+
+    # From the snapshot, pull all flight destinations
+    destinations_set = {flight.destination for flight in all_flights}
 
     # Make destinations readable
     destinations_alphabetized = sorted(destinations_set)
@@ -375,17 +429,16 @@ the main program.\n")
     date_search_spinner.start()
 
     # Get all flights to chosen destination and number of flights
-    flights_to_destination = FLIGHTS_WS.findall(destination)
+    flights_to_destination = [flight for flight in all_flights
+                              if flight.destination == destination]
     no_of_flights = len(flights_to_destination)
 
-    def get_date_and_time(flight_row):
+    def get_date_and_time(flight):
         """
-        Retrieve the date and time of flight in passed row
+        Retrieve the date and time of the passed flight
         """
-        flight_times_column = get_flights_ws_column_no("departure time")
-        flight_dates_column = get_flights_ws_column_no("date")
-        flight_time = FLIGHTS_WS.cell(flight_row, flight_times_column).value
-        flight_date = FLIGHTS_WS.cell(flight_row, flight_dates_column).value
+        flight_time = flight.departure_time
+        flight_date = flight.date
         readable_flight_date = format_flight_date(flight_date, False)
 
         flight_details = {
@@ -395,15 +448,16 @@ the main program.\n")
 
         return flight_details
 
-    # Variable "flight_row" determines which flight the passenger gets added to
+    # Variable "chosen_flight" determines which flight the passenger gets
+    # added to
     # Based on number of available flights to destination:
-    # - if only one flight, assign flight_row to the row of that flight
+    # - if only one flight, assign chosen_flight to that flight
     # - if multiple available flights, show the available flights,
-    #   and later will ask user to choose, and assigns that to flight_row
+    #   and later will ask user to choose, and assigns that to chosen_flight
     # In either case, ask the user if the flight options are ok
     if no_of_flights == 1:
-        flight_row = flights_to_destination[0].row
-        flight_details = get_date_and_time(flight_row)
+        chosen_flight = flights_to_destination[0]
+        flight_details = get_date_and_time(chosen_flight)
         time = flight_details["time"]
         date = flight_details["date"]
 
@@ -411,8 +465,8 @@ the main program.\n")
 on {date} at {time}."
         continue_booking_q = "Is that ok? (yes/no) "
     else:
-        flight_rows = [flight.row for flight in flights_to_destination]
-        flights_details = [get_date_and_time(row) for row in flight_rows]
+        flights_details = [get_date_and_time(flight)
+                           for flight in flights_to_destination]
 
         report_flight_info = f"We have flights to {destination} on:"
 
@@ -449,7 +503,8 @@ flight to be booked:\n")
 
                     try:
                         flight_option_index = int(flight_option) - 1
-                        flight_row = flight_rows[flight_option_index]
+                        chosen_flight = flights_to_destination[
+                            flight_option_index]
                     except ValueError:
                         print_red("Please type one of the numbers above.")
                     except IndexError:
@@ -481,7 +536,7 @@ different flight? (yes/no)\n").lower()
             type_yes_no()
 
     # Create a message to display flight info on passenger details page
-    chosen_flight_details = get_date_and_time(flight_row)
+    chosen_flight_details = get_date_and_time(chosen_flight)
     chosen_date = chosen_flight_details["date"]
     chosen_time = chosen_flight_details["time"]
     get_details_message = f"Booking a ticket bound for {destination}: \
@@ -491,7 +546,7 @@ different flight? (yes/no)\n").lower()
     passenger_details = get_all_passenger_details(get_details_message)
 
     # Pause before final question
-    sleep(1)
+    pause(1)
 
     # Check that passenger wants to book before completing
     while True:
@@ -506,46 +561,17 @@ to exit ticket booking:\n").lower()
         else:
             print_red(f"Please type 'yes' or 'main' only.\n")
 
-    # Pull flight number from "flights" worksheet
-    flight_number = FLIGHTS_WS.cell(flight_row, 1).value
-
-    # Get list of used booking numbers to ensure there is no repetition
-    booking_nos_worksheet = SHEET.worksheet("booking nos")
-    used_booking_nos = booking_nos_worksheet.col_values(1)
-
-    while True:
-        # Generate a sequence of 2 letters, 2 numbers, 2 letters, 2 numbers
-        # for a booking reference
-        # Example booking no: TF78RE32
-        characters_list = []
-        for i in range(2):
-            characters_list.extend(random.choices(string.ascii_uppercase, k=2))
-            characters_list.extend([random.randint(1, 9) for i in range(2)])
-
-        # Join booking number characters into a single string
-        booking_no = ""
-        for character in characters_list:
-            booking_no += (str(character))
-
-        # Check that booking number has not already been used
-        # If it has, generate a new one
-        if booking_no not in used_booking_nos:
-            break
-
-    # Add generated booking number for this passenger to worksheet
-    # of used numbers
-    booking_nos_worksheet.append_row([booking_no])
-
-    # Add booking number to passenger details
-    passenger_details.append(booking_no)
+    # Take flight number from the same snapshot as the details shown above
+    flight_number = chosen_flight.flight_no
 
     print()
     adding_passenger_spinner = spinner("Adding passenger to flight...")
     adding_passenger_spinner.start()
 
-    # Add the passenger details to a new row in the flight's worksheet
-    flight_worksheet = SHEET.worksheet(flight_number)
-    flight_worksheet.append_row(passenger_details)
+    # Give the passenger a booking number that has not already been used
+    # and add their details to a new row of the flight
+    passenger = SERVICE.book(flight_number,
+                             dict(zip(BOOKING_DETAILS, passenger_details)))
 
     adding_passenger_spinner.stop()
 
@@ -553,12 +579,12 @@ to exit ticket booking:\n").lower()
 
     print(create_heading("Booking Confirmation"))
 
-    print_green(f"Passenger {passenger_details[0]} {passenger_details[1]} \
-successfully added to flight {flight_number}")
+    print_green(f"Passenger {passenger.name} successfully added to flight \
+{flight_number}")
 
     # 's' suffix for 0 or 2 luggage pieces
     suffix = "s"
-    if passenger_details[5] == 1:
+    if passenger.luggage == 1:
         suffix = ""
 
     booking_confirmation_message = f"""
@@ -568,9 +594,9 @@ BOOKING DETAILS
 Flight no. {flight_number} to {destination} on {chosen_date} \
 at {chosen_time}
 
-Name: {passenger_details[0]} {passenger_details[1]}
-Booking no: {passenger_details[6]}
-Luggage: {passenger_details[5]} piece{suffix}
+Name: {passenger.name}
+Booking no: {passenger.booking_no}
+Luggage: {passenger.luggage} piece{suffix}
 ----------------------------------------
     """
 
@@ -615,9 +641,9 @@ def get_passenger_detail(detail_type):
             info = input(f"\n{Q_S}Please enter {detail_type} (YYYY-MM-DD):\n")
         elif detail_type == "nationality":
             print(f"\nNationality:")
-            print("   If input country name doesn't work, please try \
-writing it")
-            print("   a different way (e.g. for UK type United Kingdom).")
+            print("   Country names, common names (e.g. UK) and 2 or 3 \
+letter")
+            print("   country codes (e.g. GB or GBR) are accepted.")
             info = input(f"\n{Q_S}Please enter {detail_type}:\n")
         elif detail_type == "luggage":
             info = input(f"\n{Q_S}How many items of checked luggage would \
@@ -632,88 +658,14 @@ you like to book? (max. 2)\n")
         if data_is_valid:
             break
 
+        error = validated_info["error"]
+        print_red(f"Invalid data: {error}.\nPlease try again.")
+
     validated_data = validated_info["data"]
 
     return validated_data
 
 
-def validate_passenger_detail(detail_type, data):
-    """
-    Formats input data and then checks that it is of the expected type
-    """
-
-    # Create a dictionary with values to return to where function was called
-    # Validity of data and formatted data are returned at the same time
-    validated_info = {"validity": False, "data": None}
-
-    # For each detail type, check that the input matches the expected data type
-    try:
-        if detail_type == "first name(s)" or detail_type == "last name":
-            formatted_info = data.title().strip()
-
-            # Check that names contain at least one letter
-            contains_letter = False
-            for i in formatted_info:
-                if i.isalpha():
-                    contains_letter = True
-
-            if not contains_letter:
-                raise ValueError("name must contain at least one letter")
-            # Check that names only include allowed characters
-            elif not all(ch.isalpha() or ch.isspace() or ch == "-"
-                         or ch == "'" for ch in formatted_info):
-                raise ValueError("name must consist of letters, spaces, \
-apostrophes (') or dashes (-) only")
-
-        elif detail_type == "date of birth":
-            # Check that the input can be parsed to a datetime object
-            input_date = datetime.strptime(data, '%Y-%m-%d').date()
-
-            # Check that birth date is in the past
-            today = datetime.now().date()
-            if today <= input_date:
-                raise ValueError("date of birth must be in the past")
-
-            formatted_info = data
-
-        elif detail_type == "passport no":
-            formatted_info = data.upper()
-
-            if not formatted_info.isalnum():
-                raise ValueError("passport number must be letters and \
-numbers only")
-
-        elif detail_type == "nationality":
-            formatted_info = data.upper()
-
-            if formatted_info not in COUNTRIES:
-                raise ValueError("must be a country name")
-
-        elif detail_type == "luggage":
-            formatted_info = int(data)
-
-            if not (0 <= formatted_info <= 2):
-                raise ValueError("number of luggage items must be between \
-0 and 2")
-
-        # In case a new passenger detail type gets added in future,
-        # this will run before validation added
-        else:
-            print("Validation not yet available. Returning original value.")
-            formatted_info = data
-
-    except ValueError as e:
-        print_red(f"Invalid data: {e}.\nPlease try again.")
-
-    else:
-        # If not errors, set validity to True and add formatted data
-        # to return value
-        validated_info["validity"] = True
-        validated_info["data"] = formatted_info
-
-    return validated_info
-
-
 def find_booking():
     """
     Ask user for last name and booking no and return flight no,
@@ -727,10 +679,7 @@ def find_booking():
 
     entered_last_name = input(f"{Q_S}Please enter last name:\n")
 
-    # Get a list of all flight worksheets
-    all_flight_worksheets = SHEET.worksheets()[2:]
-
-    # Ask user for booking number and search for it in all flight worksheets
+    # Ask user for booking number and look it up in the booking index
     while True:
         booking_no = input(f"{Q_S}Please enter the booking number:\n")
 
@@ -742,28 +691,18 @@ def find_booking():
         booking_searching_spinner = spinner(f"Searching for booking...")
         booking_searching_spinner.start()
 
-        flight_no = None
-
-        # Search for booking number. If found, assign the flight number
-        # to flight_no
-        for flight_ws in all_flight_worksheets:
-            found = bool(flight_ws.find(booking_no))
-
-            if found:
-                flight_no = flight_ws.title
-
-        if flight_no:
+        # Get the flight, row and names of the booking, or None if not found
+        try:
+            booking = SERVICE.find_booking(booking_no)
             break
-        else:
+        except BookingNotFound:
             booking_searching_spinner.stop()
             print_red(f"Booking number not found. Please try again, or \
 type 'main' to exit and return to the main program.\n")
 
-    ws = SHEET.worksheet(flight_no)
-
-    # Get the last name entered in the booking (last name in column 2)
-    row = ws.find(booking_no).row
-    booking_last_name = ws.cell(row, 2).value
+    flight_no = booking.flight_no
+    row = booking.row
+    booking_last_name = booking.last_name
 
     # Check if last name input matches last name in booking
     if entered_last_name != booking_last_name:
@@ -793,8 +732,7 @@ to main page:\n")
     details["row"] = row
 
     # Get name details to print message
-    booking_first_name = ws.cell(row, 1).value
-    name = f"{booking_first_name} {booking_last_name}"
+    name = f"{booking.first_name} {booking_last_name}"
 
     booking_searching_spinner.stop()
 
@@ -817,6 +755,61 @@ to main page:\n")
     return details
 
 
+def search_passengers():
+    """
+    Find passengers by passport number, last name or the start of their
+    name, and print a table of their bookings
+    """
+    clear()
+    print(create_heading("Search Passengers"))
+
+    # Ask for a search until a passenger is found
+    while True:
+        query = input(f"{Q_S}Please enter a passport number, last name or \
+the start of a name:\n")
+
+        if query == "main":
+            return
+
+        print()
+        search_spinner = spinner("Searching...")
+        search_spinner.start()
+
+        # Matches are found in the portal's indexes, without reading the
+        # flight worksheets. One more than are shown is asked for, to find
+        # out whether any are left out.
+        try:
+            matches = SERVICE.search(query, MAX_SEARCH_RESULTS + 1)
+        except PortalError as e:
+            search_spinner.stop()
+            print_red(f"{e}. Please try again, or type 'main' to return to \
+the main program.\n")
+            continue
+
+        search_spinner.stop()
+
+        if matches:
+            break
+
+        print_red(f"No passengers found. Please try again, or type 'main' \
+to return to the main program.\n")
+
+    match_rows = [
+        [booking_no, location.last_name, location.first_name,
+         location.flight_no]
+        for booking_no, location in matches[:MAX_SEARCH_RESULTS]
+    ]
+
+    print(tabulate(match_rows,
+                   headers=["booking no", "last name", "first name(s)",
+                            "flight no"],
+                   tablefmt="fancy_grid"))
+
+    if len(matches) > MAX_SEARCH_RESULTS:
+        print(f"\nOnly the first {MAX_SEARCH_RESULTS} passengers found are \
+shown. Search for more of the name to narrow them down.")
+
+
 def view_passenger_details():
     """
     View a passenger's booking details and ask if anything needs to be changed
@@ -840,16 +833,10 @@ def view_passenger_details():
         else:
             break
 
-    ws = SHEET.worksheet(booking["flight_no"])
-    row = booking["row"]
+    booking_no = booking["booking_no"]
 
-    # Get passenger details as dict
-    # Subtract 2 from row number because:
-    # - When retrieving ws data as dict, row 1 is used as keys, i.e. one
-    #   less item in returned list
-    # - Rows start at 1, need to subtract a further unit for list indices
-    #   starting at 0
-    passenger = ws.get_all_records()[row - 2]
+    # Get passenger record, reading only the passenger's row
+    passenger = SERVICE.passenger(booking_no, fresh=True)
 
     formatted_passenger_info = readable_passenger_details(passenger)
     name = formatted_passenger_info["name"]
@@ -860,7 +847,7 @@ def view_passenger_details():
     print(printable_passenger_info)
 
     # See if passenger already checked in
-    checked_in = see_if_checked_in(ws, row)
+    checked_in = see_if_checked_in(passenger)
 
     # If already checked in, details cannot be changed, and program ends
     if checked_in:
@@ -875,8 +862,11 @@ no longer be changed.\n")
 (yes/no)\n").lower()
 
             if update_details == "yes":
-                update_passenger_details_program(ws, row, name,
+                # Collect changes, then save them all at once
+                session = SERVICE.edit(booking_no, passenger)
+                update_passenger_details_program(session, name,
                                                  printable_passenger_info)
+                save_passenger_changes(session, name)
                 return
             elif update_details == "no":
                 return
@@ -884,18 +874,18 @@ no longer be changed.\n")
                 type_yes_no()
 
 
-def update_passenger_details_program(ws, row, name, passenger_info):
+def update_passenger_details_program(session, name, passenger_info):
     """
     Starts the program to update passenger details
     """
     clear()
     print(create_heading("Update Passenger Details"))
 
-    # Ask the user what to change and update detail in ws
-    get_new_passenger_detail(ws, row, name, passenger_info)
+    # Ask the user what to change and add each change to the edit session
+    get_new_passenger_detail(session, name, passenger_info)
 
 
-def get_new_passenger_detail(ws, row, name, passenger_info):
+def get_new_passenger_detail(session, name, passenger_info):
     """
     Change passenger details
     """
@@ -903,7 +893,7 @@ def get_new_passenger_detail(ws, row, name, passenger_info):
 
     # Get list of all column heading detail types that can be updated
     # (excludes booking no and checked in cells)
-    detail_types = ws.row_values(1)[:6]
+    detail_types = BOOKING_DETAILS
 
     # Ask user to choose a detail type to be changed
     while True:
@@ -926,10 +916,9 @@ the main program.\n")
     # Get and validate user input for updated passenger data
     new_passenger_detail = get_passenger_detail(detail_type_to_update)
 
-    # Update detail in ws
-    detail_column = ws.find(detail_type_to_update).col
-    update_passenger_detail_in_ws(ws, row, detail_column,
-                                  new_passenger_detail, name)
+    # Add change to the edit session, saved when all changes are made
+    session.set(detail_type_to_update, new_passenger_detail)
+    print(f"\nNew {detail_type_to_update}: {new_passenger_detail}\n")
 
     # See if user wants to change another detail
     while True:
@@ -938,7 +927,7 @@ the main program.\n")
 
         if another_detail == "yes":
             print()
-            get_new_passenger_detail(ws, row, name, passenger_info)
+            get_new_passenger_detail(session, name, passenger_info)
             return
         elif another_detail == "no":
             return
@@ -946,41 +935,45 @@ the main program.\n")
             type_yes_no()
 
 
-def update_passenger_detail_in_ws(ws, row, column, data, name):
+def save_passenger_changes(session, name):
     """
-    Update a passenger's booking detail in flight ws
+    Save all passenger detail changes in an edit session at once
     """
     print()
     updating_passenger_spinner = spinner("Updating passenger data...")
     updating_passenger_spinner.start()
 
-    # Get the original value to show user the change
-    original_value = ws.cell(row, column).value
+    saved_changes = SERVICE.save(session)
 
-    # Update detail in ws
-    ws.update_cell(row, column, data)
+    updating_passenger_spinner.stop()
 
-    # Get detail type from heading
-    detail_type = ws.cell(1, column).value
+    print_saved_changes(saved_changes, name)
 
-    updating_passenger_spinner.stop()
 
-    print_green(f"{detail_type.capitalize()} successfully updated for {name}.")
+def print_saved_changes(saved_changes, name):
+    """
+    Show the original and new value of each saved passenger detail change
+    """
+    for detail_type, original_value, data in saved_changes:
+        # Check in is reported separately
+        if detail_type == "checked in":
+            continue
+
+        print_green(f"{detail_type.capitalize()} successfully updated for \
+{name}.")
 
-    print(f"\nOriginal input: {original_value}")
-    print(f"New value: {data}\n")
+        print(f"\nOriginal input: {original_value}")
+        print(f"New value: {data}\n")
 
 
-def see_if_checked_in(ws, row):
+def see_if_checked_in(passenger):
     """
-    Checks if a passenger has already checked in
+    Checks if a passenger (passed as a Passenger record) has already
+    checked in
     """
-    checked_in_column = ws.find("checked in").col
-    checked_in_cell = ws.cell(row, checked_in_column)
-
     # See if passenger is checked in by getting the boolean value of their
     # "checked in" cell
-    checked_in = bool(checked_in_cell.value)
+    checked_in = bool(passenger.checked_in)
 
     if checked_in:
         return True
@@ -1008,20 +1001,19 @@ def check_in():
         else:
             break
 
-    # Store ws and booking info in variables
-    ws = SHEET.worksheet(passenger_details["flight_no"])
-    row = passenger_details["row"]
+    # Store booking info in variables
     booking_no = passenger_details["booking_no"]
 
+    # Read the passenger's row once. Detail changes and check in are
+    # collected in the edit session and saved together.
+    session = SERVICE.edit(booking_no)
+    passenger = session.original
+
     # Get passenger name and store as a string
-    first_name_column = ws.find("first name(s)").col
-    last_name_column = ws.find("last name").col
-    first_name = ws.cell(row, first_name_column).value
-    last_name = ws.cell(row, last_name_column).value
-    name = f"{first_name} {last_name}"
+    name = passenger.name
 
     # See if passenger is already checked in
-    checked_in = see_if_checked_in(ws, row)
+    checked_in = see_if_checked_in(passenger)
 
     if checked_in:
         print_green(f"\n{name} is already checked in.")
@@ -1031,14 +1023,6 @@ def check_in():
     print_red(f"\n" + u"\u2757" + " WARNING " + u"\u2757")
     print_red("Once checked in, passenger details can no longer be updated.")
 
-    # Get passenger details as dict
-    # Subtract 2 from row number because:
-    # - When retrieving ws data as dict, row 1 is used as keys, i.e. one
-    #   less item in returned list
-    # - Rows start at 1, need to subtract a further unit for list indices
-    #   starting at 0
-    passenger = ws.get_all_records()[row - 2]
-
     # Convert passenger into printable format
     formatted_passenger_info = readable_passenger_details(passenger)
     name = formatted_passenger_info["name"]
@@ -1061,13 +1045,13 @@ Current details:
 in? (yes/no)\n").lower()
 
         if change_details == "yes":
-            update_passenger_details_program(ws, row, name,
+            update_passenger_details_program(session, name,
                                              printable_passenger_info)
 
             # After details update, return to check in program
             clear()
             print(create_heading("Finish Check In"))
-            print_green("Details successfully changed.")
+            print_green("Detail changes will be saved with check in.")
 
             # Ask if user wants to complete check in
             while True:
@@ -1077,6 +1061,8 @@ in? (yes/no)\n").lower()
                 if continue_check_in == "yes":
                     break
                 elif continue_check_in == "no":
+                    # Save detail changes without checking in
+                    save_passenger_changes(session, name)
                     return
                 else:
                     type_yes_no()
@@ -1090,11 +1076,12 @@ in? (yes/no)\n").lower()
     checking_in_spinner = spinner("Checking in...")
     checking_in_spinner.start()
 
-    # Update checked in cell value to True
-    checked_in_column = ws.find("checked in").col
-    ws.update_cell(row, checked_in_column, True)
+    # Save detail changes and set checked in cell value to True together
+    session.check_in()
+    saved_changes = SERVICE.save(session)
 
     checking_in_spinner.stop()
+    print_saved_changes(saved_changes, name)
     print_green(f"{name} successfully checked in.")
 
 
@@ -1120,11 +1107,9 @@ def add_luggage():
         else:
             break
 
-    flight_ws = SHEET.worksheet(passenger_details["flight_no"])
-    passenger_row = passenger_details["row"]
+    booking_no = passenger_details["booking_no"]
 
-    # Lugagge = column 6
-    current_luggage = int(flight_ws.cell(passenger_row, 6).value)
+    current_luggage = int(SERVICE.passenger(booking_no, fresh=True).luggage)
 
     print()
     adding_luggage_spinner = spinner("Adding luggage to booking...")
@@ -1146,7 +1131,7 @@ is the maximum.")
                 adding_luggage_spinner.start()
 
                 # Update worksheet with 2 as data
-                flight_ws.update_cell(passenger_row, 6, 2)
+                SERVICE.add_luggage(booking_no, 1)
 
                 adding_luggage_spinner.stop()
                 print_green(f"1 piece of luggage successfully added.")
@@ -1173,7 +1158,7 @@ should be added?\n")
                 adding_luggage_spinner.start()
 
                 # Update worksheet with input amount of luggage
-                flight_ws.update_cell(passenger_row, 6, more_luggage)
+                SERVICE.add_luggage(booking_no, int(more_luggage))
 
                 adding_luggage_spinner.stop()
                 print_green(f"Luggage successfully added.")
@@ -1182,19 +1167,22 @@ should be added?\n")
                 type_yes_no()
 
 
-def start_program():
+def start_program(service=None):
     """
-    Program start up. Print banner and call main() function.
+    Program start up. Create the service (unless one is passed), print
+    banner and call main() function.
     """
-    clear()
+    global SERVICE
 
-    # Open the start-up banner
-    with open("banner.txt") as f:
-        banner = f.read()
+    SERVICE = service or PortalService()
+
+    # Connect to the spreadsheet while the banner is shown
+    SERVICE.start()
+
+    clear()
 
     # Print colored start-up banner
-    colored_banner = colored(banner, "black", "on_light_cyan")
-    print(colored_banner)
+    print_banner()
 
     input("(Press enter) ")
 
@@ -1211,15 +1199,55 @@ def welcome_message():
     # displaying main menu
     print_slow(f"\nWelcome to Magnolia Airport's passenger \
 management portal.\n")
-    sleep(1)
+    pause(1)
 
     main()
 
 
+def run_program(program):
+    """
+    Run the passed program. If a spreadsheet request fails even after being
+    retried (e.g. the quota is used up for longer than the retries wait),
+    the passenger was changed from another terminal at the same time, or
+    the request can't be carried out, tell the user instead of ending the
+    portal.
+    """
+    SPINNERS.clear()
+
+    try:
+        program()
+    except (APIError, ConflictError, PortalError) as e:
+        for running_spinner in SPINNERS + [LOADING_SPINNER]:
+            running_spinner.stop()
+
+        if isinstance(e, APIError):
+            print_red(f"\nThe spreadsheet is too busy to answer right now. \
+Please try again in a minute.")
+        elif isinstance(e, ConflictError):
+            print_red(f"\nThe passenger was changed from another terminal \
+at the same time. Please try again.")
+        else:
+            print_red(f"\n{e}\nPlease try again.")
+
+
 def main():
     """
     Main program. Allow user to choose which function(s) to run.
     """
+    global FAILED_WRITES_SHOWN
+
+    # Tell the user about changes that could not be saved since last time
+    failed_writes = SERVICE.failed_writes()
+    for operation, flight_no, error in failed_writes[FAILED_WRITES_SHOWN:]:
+        print_red(f"\nA change to flight {flight_no} \
+({operation.replace('_', ' ')}) could not be saved: {error}")
+    FAILED_WRITES_SHOWN = len(failed_writes)
+
+    # Warn when requests may be slowed down to stay within the quota
+    if SERVICE.near_quota():
+        print_red(f"\nThe portal is busy: {SERVICE.quota_report()}")
+        print_red("Requests may be slower than usual.")
+
     print(f"\nChoose a program:\n")
 
     # Options menus
@@ -1229,7 +1257,8 @@ def main():
         (3, "Book a ticket"),
         (4, "View and update passenger details"),
         (5, "Check in"),
-        (6, "Add luggage")
+        (6, "Add luggage"),
+        (7, "Search passengers")
     ]
 
     exit_option = [
@@ -1252,36 +1281,52 @@ def main():
             control_choice = int(control_choice)
 
             if control_choice == 1:
-                view_all_flights()
+                run_program(view_all_flights)
                 break
             elif control_choice == 2:
-                view_all_passengers_of_flight()
+                run_program(view_all_passengers_of_flight)
                 break
             elif control_choice == 3:
-                ticket_booking_program()
+                run_program(ticket_booking_program)
                 break
             elif control_choice == 4:
-                view_passenger_details()
+                run_program(view_passenger_details)
                 break
             elif control_choice == 5:
-                check_in()
+                run_program(check_in)
                 break
             elif control_choice == 6:
-                add_luggage()
+                run_program(add_luggage)
+                break
+            elif control_choice == 7:
+                run_program(search_passengers)
                 break
             elif control_choice == 100:
+                # Wait for queued changes to be saved before exiting
+                print()
+                saving_spinner = spinner("Saving changes...")
+                saving_spinner.start()
+                unsaved_changes = SERVICE.close(timeout=30)
+                saving_spinner.stop()
+
+                if unsaved_changes:
+                    print_red(f"{unsaved_changes} changes not yet saved. \
+They will be saved the next time the portal is started.")
+                    pause(3)
+
                 # Show a goodbye message, pause, then clear terminal
                 clear()
                 print_slow(f"\nGoodbye, have a nice day!")
-                sleep(1)
-                clear()
+                pause(1)
 
-                with open("banner.txt") as f:
-                    banner = f.read()
+                # Print the airport banner, except in desk mode
+                if not FAST_MODE:
+                    clear()
+                    print_banner()
 
-                # Print the airport banner
-                colored_banner = colored(banner, "black", "on_light_cyan")
-                print(colored_banner)
+                if SHOW_STATS:
+                    print(f"\n{STATS.summary()}\n")
+                    print(SERVICE.quota_report())
 
                 # End the program
                 exit()
@@ -1297,4 +1342,6 @@ an option from the list above")
     main()
 
 
-start_program()
+# Only start the portal when run, not when imported
+if __name__ == "__main__":
+    start_program()
@@ -0,0 +1,272 @@
+import json
+import os
+import random
+import threading
+from collections import deque
+from concurrent.futures import Future
+from time import monotonic, sleep
+
+# To send requests to the Google Sheets and Drive APIs
+import gspread
+import requests
+from gspread.urls import SPREADSHEETS_API_V4_BASE_URL
+
+# Rate limiter shared with the parallel reads
+from parallel import READ_LIMITER, SlidingWindowLimiter
+
+# To count and time each request
+from instrumentation import STATS, gspread_method_name
+
+
+# Sheets API write requests allowed per minute (the default quota per user)
+WRITES_PER_MINUTE = int(os.environ.get("PORTAL_WRITES_PER_MINUTE", 60))
+
+# Most times a request is sent before its error is raised
+MAX_ATTEMPTS = int(os.environ.get("PORTAL_MAX_ATTEMPTS", 6))
+
+# Wait in seconds before the first retry, doubled before each retry after
+# it, up to MAX_BACKOFF
+BASE_BACKOFF = 1
+MAX_BACKOFF = 32
+
+# Share of the quota used in the last minute above which the portal warns
+# that requests may be slowed down
+QUOTA_WARNING = 0.8
+
+# Response codes of requests that can be sent again: the rate limit was
+# exceeded, or (for reads only) the server had a temporary problem
+RATE_LIMITED = 429
+SERVER_ERRORS = {500, 502, 503, 504}
+
+# Sheets API requests that read values, although sent with POST
+READ_ENDPOINTS = (":batchGet", ":batchGetByDataFilter", ":getByDataFilter")
+
+
+def is_read(method, endpoint):
+    """
+    Return True if the request reads from the spreadsheet without changing
+    it
+    """
+    return method == "get" or endpoint.endswith(READ_ENDPOINTS)
+
+
+class RequestScheduler:
+    """
+    Sends requests to the Sheets API within the per-minute quotas:
+    - reads and writes each wait for their own limiter, which allows no
+      more than the quota in any minute
+    - a request rejected for exceeding the quota (429) is sent again after
+      a jittered exponential backoff, and the limiter is paused so other
+      requests slow down too, instead of the error ending the program
+    - a read identical to one already being sent waits for that read's
+      response instead of being sent again
+    and keeps count of the requests sent in the last minute, to report how
+    close the portal is to the quota.
+    Requests to the Drive API (e.g. the spreadsheet's modified time) have a
+    separate, much larger quota, so are only retried.
+    """
+
+    def __init__(self, read_limiter=READ_LIMITER,
+                 write_limiter=None, max_attempts=MAX_ATTEMPTS):
+        self.read_limiter = read_limiter
+        self.write_limiter = write_limiter or \
+            SlidingWindowLimiter(WRITES_PER_MINUTE)
+        self.max_attempts = max_attempts
+
+        # Request key -> Future of the response, for reads being sent
+        self._in_flight = {}
+
+        # Times at which Sheets reads and writes were sent, in the last
+        # minute
+        self._reads = deque()
+        self._writes = deque()
+
+        self.retries = 0
+        self.rate_limited = 0
+        self.coalesced = 0
+        self.throttled_seconds = 0
+        self._lock = threading.Lock()
+
+    def send(self, send_request, method, endpoint, params=None, json=None):
+        """
+        Send a request with send_request(), a function taking no arguments
+        and returning the response, and return the response. Identical
+        reads sent at the same time share one response.
+        """
+        if not endpoint.startswith(SPREADSHEETS_API_V4_BASE_URL):
+            return self._send_with_retries(send_request, None, False)
+
+        if not is_read(method, endpoint):
+            return self._send_with_retries(send_request, self.write_limiter,
+                                           False)
+
+        key = self._request_key(method, endpoint, params, json)
+
+        with self._lock:
+            future = self._in_flight.get(key)
+
+            if future is None:
+                future = self._in_flight[key] = Future()
+                sender = True
+            else:
+                self.coalesced += 1
+                sender = False
+
+        if not sender:
+            return future.result()
+
+        try:
+            response = self._send_with_retries(send_request,
+                                               self.read_limiter, True)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(response)
+            return response
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def _request_key(self, method, endpoint, params, body):
+        """
+        Return a key that is the same for identical requests
+        """
+        return (method, endpoint,
+                json.dumps(params, sort_keys=True, default=str),
+                json.dumps(body, sort_keys=True, default=str))
+
+    def _send_with_retries(self, send_request, limiter, read):
+        """
+        Send the request once the limiter allows it, sending it again after
+        a backoff if it can be retried. Writes are only retried when
+        rejected for the rate limit, as any other failure may have happened
+        after the write was made.
+        """
+        for attempt in range(self.max_attempts):
+            if limiter is not None:
+                self._wait_for_limiter(limiter, read)
+
+            try:
+                return send_request()
+            except gspread.exceptions.APIError as e:
+                status = e.response.status_code
+
+                if status == RATE_LIMITED:
+                    with self._lock:
+                        self.rate_limited += 1
+
+                    # Slow down every request sharing the quota
+                    if limiter is not None:
+                        limiter.empty()
+                elif not (read and status in SERVER_ERRORS):
+                    raise
+
+                error = e
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                if not read:
+                    raise
+
+                error = e
+
+            if attempt + 1 == self.max_attempts:
+                raise error
+
+            with self._lock:
+                self.retries += 1
+
+            # Wait before trying again, doubling the wait after each
+            # failure, with jitter so terminals don't retry together
+            delay = min(BASE_BACKOFF * 2 ** attempt, MAX_BACKOFF)
+            sleep(delay * random.uniform(0.5, 1))
+
+    def _wait_for_limiter(self, limiter, read):
+        """
+        Wait for the limiter to allow the request and count it as sent
+        """
+        started_at = monotonic()
+        limiter.acquire()
+        now = monotonic()
+
+        with self._lock:
+            self.throttled_seconds += now - started_at
+            (self._reads if read else self._writes).append(now)
+
+    def _last_minute(self, times):
+        """
+        Number of the passed request times in the last minute
+        """
+        with self._lock:
+            while times and times[0] < monotonic() - 60:
+                times.popleft()
+
+            return len(times)
+
+    def usage(self):
+        """
+        Return a dict of the Sheets requests sent in the last minute and
+        the quotas they count towards, with the number of retries,
+        requests rejected for the rate limit and reads coalesced since the
+        program started, and the seconds spent waiting for the limiters
+        """
+        return {
+            "reads": self._last_minute(self._reads),
+            "read quota": round(self.read_limiter.rate * 60),
+            "writes": self._last_minute(self._writes),
+            "write quota": round(self.write_limiter.rate * 60),
+            "retries": self.retries,
+            "rate limited": self.rate_limited,
+            "coalesced": self.coalesced,
+            "throttled seconds": round(self.throttled_seconds, 1)
+        }
+
+    def near_quota(self, share=QUOTA_WARNING):
+        """
+        Return True if the reads or writes of the last minute have used at
+        least the passed share of their quota
+        """
+        usage = self.usage()
+
+        return usage["reads"] >= share * usage["read quota"] or \
+            usage["writes"] >= share * usage["write quota"]
+
+    def report(self):
+        """
+        Return a printable summary of usage()
+        """
+        usage = self.usage()
+
+        return f"Sheets requests in the last minute: {usage['reads']}/\
+{usage['read quota']} reads, {usage['writes']}/{usage['write quota']} \
+writes. {usage['rate limited']} rate limited, {usage['retries']} retried, \
+{usage['coalesced']} coalesced, {usage['throttled seconds']}s waiting for \
+quota."
+
+
+# Shared by every client, so all requests count towards the same quotas
+SCHEDULER = RequestScheduler()
+
+
+class ScheduledClient(gspread.Client):
+    """
+    gspread client that sends every request through a RequestScheduler,
+    recording it in STATS under the gspread method that made it.
+    Pass it to gspread.authorize() as the client_factory.
+    """
+
+    def __init__(self, auth, session=None, scheduler=SCHEDULER):
+        super().__init__(auth, session)
+        self.scheduler = scheduler
+
+    def request(self, method, endpoint, params=None, data=None, json=None,
+                files=None, headers=None):
+        def send_request():
+            return super(ScheduledClient, self).request(
+                method, endpoint, params=params, data=data, json=json,
+                files=files, headers=headers
+            )
+
+        with STATS.api_call(gspread_method_name()):
+            return self.scheduler.send(send_request, method, endpoint,
+                                       params, json)
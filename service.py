@@ -0,0 +1,348 @@
+"""
+Every operation of the portal as methods that take plain values and return
+records or results, without asking for input or printing anything. The
+terminal portal (run.py) and batch mode (batch.py) are built on it, and
+another front-end, a worker or a load test can use it directly:
+
+    from service import PortalService
+
+    portal = PortalService()
+    passenger = portal.book("MA100", {"first name(s)": "Jane", ...})
+    portal.check_in(passenger.booking_no)
+    portal.close()
+
+Requests that can't be carried out raise a PortalError, whose message can
+be shown to the user. Each operation is timed in instrumentation.STATS.
+"""
+from booking_numbers import BookingNumberAllocator
+from instrumentation import STATS, timed
+from records import Passenger
+from scheduler import SCHEDULER
+from storage import EditSession, open_storage
+from validation import validate_passenger_detail
+
+
+# Passenger details given when booking, in column order
+BOOKING_DETAILS = list(Passenger.FIELDS)[:6]
+
+# Most pieces of checked luggage a passenger can have
+MAX_LUGGAGE = 2
+
+# Most passengers a search returns
+MAX_SEARCH_RESULTS = 20
+
+# Fewest characters a search needs, so that it can't match everyone
+MIN_SEARCH_LENGTH = 2
+
+
+class PortalError(ValueError):
+    """
+    A request that the portal can't carry out
+    """
+
+
+class FlightNotFound(PortalError):
+    """
+    No flight has the flight number asked for
+    """
+
+
+class BookingNotFound(PortalError):
+    """
+    No passenger has the booking number asked for
+    """
+
+
+class LastNameMismatch(PortalError):
+    """
+    The last name given doesn't match the booking
+    """
+
+
+class AlreadyCheckedIn(PortalError):
+    """
+    The passenger has checked in, so their details can't change
+    """
+
+
+class InvalidDetail(PortalError):
+    """
+    A passenger detail is missing or not valid
+    """
+
+
+class PortalService:
+    """
+    The portal's operations on one storage, with booking numbers given out
+    by one allocator
+    """
+
+    def __init__(self, storage=None, booking_nos=None):
+        # Storage chosen with PORTAL_STORAGE, unless one is passed
+        self.storage = storage or open_storage()
+        self.booking_nos = booking_nos or BookingNumberAllocator(self.storage)
+
+    def start(self):
+        """
+        Start connecting to storage without waiting for it
+        """
+        self.storage.connect_in_background()
+
+    def close(self, timeout=None):
+        """
+        Wait at most timeout seconds for writes to be saved. Returns the
+        number of writes not yet saved.
+        """
+        return self.storage.close(timeout)
+
+    def failed_writes(self):
+        """
+        Return a list of (operation, flight no, error) of changes that
+        could not be saved and won't be tried again
+        """
+        return self.storage.failed_writes()
+
+    def quota_usage(self):
+        """
+        Return a dict of the spreadsheet requests sent in the last minute
+        and the quotas they count towards, as RequestScheduler.usage()
+        """
+        return SCHEDULER.usage()
+
+    def quota_report(self):
+        """
+        Return a printable summary of quota_usage()
+        """
+        return SCHEDULER.report()
+
+    def near_quota(self):
+        """
+        Return True if the requests of the last minute are close to the
+        quota, so requests may be slowed down
+        """
+        return SCHEDULER.near_quota()
+
+    @timed("view flights")
+    def flights(self):
+        """
+        Return every flight as a Flight record
+        """
+        return self.storage.list_flights()
+
+    def flight(self, flight_no):
+        """
+        Return the Flight record with the passed flight number
+        """
+        for flight in self.storage.list_flights():
+            if flight.flight_no == flight_no:
+                return flight
+
+        raise FlightNotFound(f"No flight {flight_no}")
+
+    def destinations(self):
+        """
+        Return the destinations of every flight, in alphabetical order
+        """
+        return sorted({flight.destination
+                       for flight in self.storage.list_flights()})
+
+    def flights_to(self, destination):
+        """
+        Return the flights to the passed destination
+        """
+        return [flight for flight in self.storage.list_flights()
+                if flight.destination == destination]
+
+    def passengers(self, flight_no, waiting_only=False):
+        """
+        Yield the passengers on the flight as they are read. If
+        waiting_only is True, passengers who have checked in are left out.
+        """
+        for passenger in self.storage.iter_passengers(flight_no):
+            if waiting_only and passenger.checked_in:
+                continue
+
+            yield passenger
+
+    def validate_details(self, details, required=()):
+        """
+        Validate a dict of passenger detail -> value, and return a dict of
+        the details formatted as they are saved. Every detail in required
+        must be given.
+        """
+        missing = [detail for detail in required if detail not in details]
+        if missing:
+            raise InvalidDetail(f"{', '.join(missing)} missing")
+
+        validated = {}
+
+        for detail_type, data in details.items():
+            if detail_type not in BOOKING_DETAILS:
+                raise InvalidDetail(f"{detail_type} can't be changed")
+
+            validated_info = validate_passenger_detail(detail_type,
+                                                       str(data))
+
+            if not validated_info["validity"]:
+                raise InvalidDetail(f"{detail_type}: \
+{validated_info['error']}")
+
+            validated[detail_type] = validated_info["data"]
+
+        return validated
+
+    def new_passenger(self, details):
+        """
+        Validate every detail of a new passenger and give them an unused
+        booking number. Returns the Passenger record, not yet saved.
+        """
+        details = self.validate_details(details, BOOKING_DETAILS)
+
+        return Passenger(*[details[detail] for detail in BOOKING_DETAILS],
+                         self.booking_nos.allocate())
+
+    @timed("book")
+    def book(self, flight_no, details):
+        """
+        Add a passenger to the flight, with details given as a dict of
+        passenger detail -> value. Returns the new Passenger record.
+        """
+        flight_no = self.flight(flight_no).flight_no
+        passenger = self.new_passenger(details)
+
+        self.storage.add_booking(flight_no, passenger)
+
+        return passenger
+
+    def _location(self, booking_no):
+        """
+        Return the BookingLocation of the booking
+        """
+        location = self.storage.find_booking(booking_no)
+
+        if location is None:
+            raise BookingNotFound(f"Booking number {booking_no} not found")
+
+        return location
+
+    @timed("find booking")
+    def find_booking(self, booking_no, last_name=None):
+        """
+        Return the BookingLocation of the booking. If a last name is
+        passed, it must match the booking.
+        """
+        location = self._location(booking_no)
+
+        if last_name is not None and last_name != location.last_name:
+            raise LastNameMismatch("Last name does not match booking")
+
+        return location
+
+    @timed("search")
+    def search(self, query, limit=MAX_SEARCH_RESULTS):
+        """
+        Find passengers without a booking number: returns a list of
+        (booking no, BookingLocation) pairs, in name order and at most
+        limit long, of passengers whose passport number or last name is
+        the query, or whose name starts with it, whatever its case
+        """
+        query = " ".join(str(query).split())
+
+        if len(query) < MIN_SEARCH_LENGTH:
+            raise PortalError(f"Please enter at least {MIN_SEARCH_LENGTH} \
+letters or numbers")
+
+        return self.storage.search_bookings(query, limit)
+
+    @timed("read passenger")
+    def passenger(self, booking_no, fresh=False):
+        """
+        Return the Passenger record of the booking. If fresh is True, it is
+        read from storage rather than from memory, as it should be before
+        deciding whether the passenger can be changed.
+        """
+        location = self._location(booking_no)
+
+        return self.storage.get_passenger(location.flight_no, location.row,
+                                          fresh)
+
+    @timed("read passenger")
+    def edit(self, booking_no, passenger=None):
+        """
+        Start an EditSession for the passenger of the booking (passed in if
+        already read). Save it with save().
+        """
+        location = self._location(booking_no)
+
+        return EditSession(self.storage, location.flight_no, location.row,
+                           passenger)
+
+    def _edit_before_check_in(self, booking_no, details):
+        """
+        Start an EditSession with the passed details changed, refusing if
+        the passenger has already checked in
+        """
+        location = self._location(booking_no)
+        session = EditSession(self.storage, location.flight_no, location.row)
+
+        if session.original.checked_in:
+            raise AlreadyCheckedIn(f"{session.original.name} is already \
+checked in")
+
+        for detail_type, data in self.validate_details(details).items():
+            session.set(detail_type, data)
+
+        return session
+
+    def update_passenger(self, booking_no, details):
+        """
+        Change the passed details of a passenger who hasn't checked in.
+        Returns a list of (detail type, original value, new value).
+        """
+        return self.save(self._edit_before_check_in(booking_no, details))
+
+    def check_in(self, booking_no, details=None):
+        """
+        Check the passenger in, along with any changes to their details,
+        saved together. Returns a list of (detail type, original value,
+        new value).
+        """
+        session = self._edit_before_check_in(booking_no, details or {})
+        session.check_in()
+
+        return self.save(session)
+
+    def save(self, session):
+        """
+        Save the changes in an EditSession together, timed as a check in
+        if the passenger is being checked in. Returns a list of (detail
+        type, original value, new value).
+        """
+        if "checked in" in session.changes:
+            operation = "check in"
+        else:
+            operation = "update passenger"
+
+        with STATS.operation(operation):
+            return session.commit()
+
+    @timed("add luggage")
+    def add_luggage(self, booking_no, pieces):
+        """
+        Add pieces of checked luggage to the booking, up to MAX_LUGGAGE in
+        all. Returns the number of pieces now booked.
+        """
+        location = self._location(booking_no)
+        passenger = self.storage.get_passenger(location.flight_no,
+                                               location.row, fresh=True)
+        luggage = int(passenger.luggage or 0) + pieces
+
+        if pieces < 0 or luggage > MAX_LUGGAGE:
+            raise PortalError(f"A passenger can have between 0 and \
+{MAX_LUGGAGE} pieces of luggage")
+
+        if pieces:
+            self.storage.update_detail(location.flight_no, location.row,
+                                       "luggage", luggage)
+
+        return luggage
@@ -0,0 +1,328 @@
+import os
+import threading
+from time import monotonic
+
+from gspread.utils import absolute_range_name
+
+from change_feed import ChangeFeed
+from warm_cache import worksheet_stamp
+
+
+# Number of seconds the prefetched spreadsheet is kept before it is read
+# again. Can be set with the PORTAL_PREFETCH_TTL environment variable.
+PREFETCH_TTL = float(os.environ.get("PORTAL_PREFETCH_TTL", 300))
+
+# Number of seconds between checks for rows added to the spreadsheet, which
+# are read without reading the whole spreadsheet again. Can be set with the
+# PORTAL_SYNC_INTERVAL environment variable.
+SYNC_INTERVAL = float(os.environ.get("PORTAL_SYNC_INTERVAL", 30))
+
+
+def cell_text(value):
+    """
+    Convert a value written to the spreadsheet to the text read back from it
+    """
+    if value is True:
+        return "TRUE"
+    elif value is False:
+        return "FALSE"
+
+    return str(value)
+
+
+class SpreadsheetModel:
+    """
+    In-memory copy of the values of every worksheet in the spreadsheet.
+    All worksheets are read with a single values_batch_get request (after
+    one request for the list of worksheets), then reads are served from
+    memory and writes made by the portal are applied to the copy as well.
+    Rows added by other terminals are read from a ChangeFeed every
+    sync_interval seconds, and the whole copy is read again once older than
+    the TTL.
+    With a WarmCache, the copy saved by the last run can be loaded at start
+    up and used straight away, while revalidate() checks it against the
+    spreadsheet.
+    """
+
+    def __init__(self, get_spreadsheet, ttl=PREFETCH_TTL,
+                 sync_interval=SYNC_INTERVAL, list_worksheets=None,
+                 warm_cache=None):
+        # Function returning the opened spreadsheet
+        self._get_spreadsheet = get_spreadsheet
+        self.ttl = ttl
+        self.sync_interval = sync_interval
+
+        # Function reading the spreadsheet's worksheets, in order
+        self._list_worksheets = list_worksheets or \
+            (lambda: get_spreadsheet().worksheets())
+        self.change_feed = ChangeFeed(get_spreadsheet, self._list_worksheets)
+        self.warm_cache = warm_cache
+        self._titles = None
+        self._values = None
+        self._loaded_at = None
+        self._synced_at = None
+
+        # Title -> revision stamp of the values last read in full
+        self._stamps = {}
+
+        # Spreadsheet's revision when the copy was last read in full. Syncs
+        # move the change feed's revision on without reading rows changed
+        # in place, so only this revision is saved to the warm cache.
+        self._read_revision = None
+
+        # Number of writes applied to the copy, to find out whether it was
+        # written to while being read again in the background
+        self._writes = 0
+
+        # Held while prefetching, so that a prefetch started in the
+        # background isn't repeated by the main thread
+        self._lock = threading.RLock()
+
+    def _read_all(self, revision=None):
+        """
+        Read the values of every worksheet with one batch request. Returns
+        the spreadsheet's revision before reading (unless passed), the
+        worksheet titles and a dict of title -> rows.
+        """
+        spreadsheet = self._get_spreadsheet()
+        revision = revision or self.change_feed.current_revision()
+        titles = [ws.title for ws in self._list_worksheets()]
+
+        response = spreadsheet.values_batch_get(
+            [absolute_range_name(title) for title in titles]
+        )
+
+        values = {
+            title: self._padded(value_range.get("values", []))
+            for title, value_range in zip(titles, response["valueRanges"])
+        }
+
+        return revision, titles, values
+
+    def _load(self, revision, titles, values, stamps=None):
+        """
+        Replace the whole copy with values read at the passed revision
+        """
+        # Rows added after the revision are found by the next sync
+        self.change_feed.mark(revision)
+        self._read_revision = self.change_feed.revision
+
+        self._values = values
+        self._titles = titles
+        self._stamps = stamps or {title: worksheet_stamp(rows)
+                                  for title, rows in values.items()}
+        self._loaded_at = self._synced_at = monotonic()
+
+    def prefetch(self):
+        """
+        Read the values of every worksheet with one batch request
+        """
+        self._load(*self._read_all())
+
+    def load_warm_cache(self):
+        """
+        Load the copy saved by the last run, if there is one and nothing
+        has been read yet. Returns True if it was loaded.
+        """
+        cache = self.warm_cache.load() if self.warm_cache else None
+
+        if cache is None:
+            return False
+
+        with self._lock:
+            if self._loaded_at is not None:
+                return False
+
+            self._load(cache["revision"], cache["titles"],
+                       {title: self._padded(rows)
+                        for title, rows in cache["values"].items()},
+                       cache["stamps"])
+
+        return True
+
+    def revalidate(self):
+        """
+        Check the copy against the spreadsheet, reading it all again if the
+        spreadsheet has changed since the copy was read, and save it to the
+        warm cache. Returns the titles of worksheets whose values changed.
+        The requests are made without holding the lock, so the copy can be
+        used meanwhile.
+        """
+        revision = self.change_feed.current_revision()
+
+        if revision == self._read_revision:
+            with self._lock:
+                self._loaded_at = self._synced_at = monotonic()
+
+            return []
+
+        writes = self._writes
+        read = self._read_all(revision)
+
+        with self._lock:
+            stamps = self._stamps
+
+            # A write applied to the copy while reading may not be in the
+            # values read, so they are read again
+            if self._writes != writes:
+                self.prefetch()
+            else:
+                self._load(*read)
+
+            changed = [title for title in self._titles
+                       if stamps.get(title) != self._stamps[title]]
+
+        self.save_warm_cache()
+
+        return changed
+
+    def save_warm_cache(self):
+        """
+        Save the copy, with any writes applied to it, to the warm cache,
+        along with the revision it was last read in full at, so that the
+        next run reads it all again if anything has changed since
+        """
+        if self.warm_cache is None:
+            return
+
+        with self._lock:
+            if self._values is None:
+                return
+
+            titles = list(self._titles)
+            values = {title: [list(row) for row in self._values[title]]
+                      for title in titles}
+            revision = self._read_revision
+
+        self.warm_cache.save(revision, titles, values)
+
+    def sync(self):
+        """
+        Add the rows added to the spreadsheet since the last prefetch or
+        sync to the copy, along with any new worksheets
+        """
+        with self._lock:
+            if self._loaded_at is None:
+                self.prefetch()
+                return
+
+            row_counts = {title: len(rows)
+                          for title, rows in self._values.items()}
+            changes = self.change_feed.changes(row_counts)
+
+            for title, first_row, rows in changes:
+                if title in self._values:
+                    held = self._values[title]
+                    width = len(held[0]) if held else 0
+                    held.extend(self._padded(rows, width))
+                else:
+                    self._values[title] = self._padded(rows)
+
+            if changes:
+                self._titles = [title for title, first_row, rows in changes]
+
+            self._synced_at = monotonic()
+
+    def _padded(self, rows, width=0):
+        """
+        Pad rows so that every row has a value for every column (at least
+        width columns), as the API leaves out empty cells at the end of a
+        row
+        """
+        width = max([width] + [len(row) for row in rows])
+
+        return [row + [""] * (width - len(row)) for row in rows]
+
+    def _ensure_fresh(self):
+        """
+        Prefetch if never prefetched, or if the copy is older than the TTL.
+        Otherwise, sync if the last sync is older than the sync interval.
+        """
+        with self._lock:
+            if (self._loaded_at is None
+                    or monotonic() - self._loaded_at > self.ttl):
+                self.prefetch()
+            elif monotonic() - self._synced_at > self.sync_interval:
+                self.sync()
+
+    def titles(self):
+        """
+        List of worksheet titles, in spreadsheet order
+        """
+        self._ensure_fresh()
+
+        return list(self._titles)
+
+    def values(self, title):
+        """
+        Rows of values of the worksheet with the passed title, including
+        the heading row
+        """
+        self._ensure_fresh()
+
+        # A worksheet added since the prefetch (e.g. a new flight)
+        if title not in self._values:
+            self.sync()
+
+        return self._values[title]
+
+    def copy(self, titles):
+        """
+        Return a dict of title -> a copy of its rows for the passed titles,
+        taken while holding the lock so that no write is half applied
+        """
+        with self._lock:
+            return {title: [list(row) for row in self.values(title)]
+                    for title in titles}
+
+    def replace(self, title, rows):
+        """
+        Replace the copy of one worksheet with rows read from it
+        """
+        with self._lock:
+            self._ensure_fresh()
+            self._values[title] = self._padded(rows)
+            self._writes += 1
+
+    def set_row(self, title, row, row_values):
+        """
+        Write a whole row (e.g. one just appended) into the copy
+        """
+        with self._lock:
+            rows = self.values(title)
+
+            # Rows were added by another terminal before this one, so read
+            # them rather than leave a gap in the copy
+            if row > len(rows) + 1:
+                self.sync()
+                rows = self.values(title)
+
+            width = len(rows[0]) if rows else len(row_values)
+
+            while len(rows) < row:
+                rows.append([""] * width)
+
+            cells = [cell_text(value) for value in row_values]
+            rows[row - 1] = cells + [""] * (width - len(cells))
+            self._writes += 1
+
+    def append_row(self, title, row_values):
+        """
+        Add a row after the last row of the copy
+        """
+        with self._lock:
+            self.set_row(title, len(self.values(title)) + 1, row_values)
+
+    def set_cell(self, title, row, col, value):
+        """
+        Write one cell into the copy
+        """
+        with self._lock:
+            row_values = self.values(title)[row - 1]
+
+            # A column added since the prefetch
+            if len(row_values) < col:
+                row_values.extend([""] * (col - len(row_values)))
+
+            row_values[col - 1] = cell_text(value)
+            self._writes += 1
@@ -0,0 +1,1239 @@
+"""
+Storage backends for the passenger management portal.
+
+The portal reads and writes flights and passengers only through the
+operations of the Storage class, so the same program can run against the
+Google Sheets spreadsheet or a local SQLite database.
+
+Copy the spreadsheet into a SQLite database, or push the bookings made in a
+SQLite database back to the spreadsheet, with:
+
+    python3 storage.py import magnolia_airport.db
+    python3 storage.py sync magnolia_airport.db
+"""
+import argparse
+import os
+import sqlite3
+import threading
+
+from gspread.utils import ValueInputOption, rowcol_to_a1
+
+from booking_index import (BookingIndex, BookingLocation,
+                           row_from_append_response)
+from change_feed import ChangeFeed
+from connection import SheetsConnection
+from flights_cache import FlightsCache
+from parallel import run_in_parallel
+from records import Flight, Passenger
+from spreadsheet_model import SpreadsheetModel
+from warm_cache import WarmCache
+from worksheet_schema import get_schema
+
+
+# Number of times a passenger's row is looked for again when another
+# terminal has moved it
+CONFLICT_RETRIES = 3
+
+# Number of passengers read with each request by iter_passengers()
+PASSENGER_PAGE_SIZE = 50
+
+# Headings of the flights worksheet that the portal uses
+FLIGHT_HEADINGS = list(Flight.FIELDS)
+
+# Headings of each flight worksheet, in column order
+PASSENGER_HEADINGS = list(Passenger.FIELDS)
+
+
+class ConflictError(Exception):
+    """
+    Raised when a passenger can't be found again after another terminal
+    changed their flight worksheet
+    """
+
+
+class Storage:
+    """
+    Operations the portal needs from its data store.
+    Passengers are identified by flight number and row, where row numbers
+    start at 2 as they do in a flight worksheet (row 1 being the headings).
+    """
+
+    def connect_in_background(self):
+        """
+        Start any slow connection set-up without waiting for it to finish
+        """
+
+    def close(self, timeout=None):
+        """
+        Finish any outstanding writes before the program exits, waiting at
+        most timeout seconds. Returns the number of writes not yet saved.
+        """
+        return 0
+
+    def failed_writes(self):
+        """
+        Return a list of (operation, flight no, error) of writes that could
+        not be saved and won't be tried again
+        """
+        return []
+
+    def list_flights(self):
+        """
+        Return every flight as a Flight record
+        """
+        raise NotImplementedError
+
+    def list_passengers(self, flight_no):
+        """
+        Return every passenger on the flight as a Passenger record
+        """
+        raise NotImplementedError
+
+    def iter_passengers(self, flight_no, page_size=PASSENGER_PAGE_SIZE):
+        """
+        Yield every passenger on the flight as a Passenger record, reading
+        page_size passengers at a time so that the first can be shown
+        before the rest are read
+        """
+        yield from self.list_passengers(flight_no)
+
+    def list_all_passengers(self):
+        """
+        Return a dict of flight number -> list of passengers on the flight,
+        for every flight
+        """
+        return {
+            flight.flight_no: self.list_passengers(flight.flight_no)
+            for flight in self.list_flights()
+        }
+
+    def passenger_headings(self, flight_no):
+        """
+        Return the passenger detail headings of the flight, in column order
+        """
+        raise NotImplementedError
+
+    def find_booking(self, booking_no):
+        """
+        Return the BookingLocation of the booking number, or None
+        """
+        raise NotImplementedError
+
+    def expect_booking(self, flight_no, row, booking_no):
+        """
+        Record that the passed row held the booking when it was found, so
+        that a write to the row can check it still does (e.g. a write
+        queued before a restart). Does nothing where rows can't move.
+        """
+
+    def search_bookings(self, query, limit=None):
+        """
+        Return a list of (booking no, BookingLocation) pairs, in name order
+        and at most limit long, of passengers whose passport number or
+        last name is the query, or whose name (last name or first names)
+        starts with it, whatever its case
+        """
+        raise NotImplementedError
+
+    def get_passenger(self, flight_no, row, fresh=False):
+        """
+        Return the passenger in the passed row as a Passenger record, with
+        numbers converted as in list_passengers(). If fresh is True, the
+        row is read from storage rather than from values held in memory,
+        e.g. before checking whether the passenger can still be changed.
+        """
+        raise NotImplementedError
+
+    def get_detail(self, flight_no, row, detail_type):
+        """
+        Return one detail of the passenger in the passed row
+        """
+        raise NotImplementedError
+
+    def used_booking_nos(self):
+        """
+        Return a list of every booking number already given out
+        """
+        raise NotImplementedError
+
+    def claim_booking_no(self, booking_no):
+        """
+        Record a value (e.g. a terminal block's marker) with the used
+        booking numbers straight away. Returns True if it is the first
+        record of the value, or False if another terminal recorded it
+        first.
+        """
+        raise NotImplementedError
+
+    def add_booking(self, flight_no, passenger):
+        """
+        Record the passenger's booking number as used and add the passenger
+        (a Passenger record) to the flight.
+        Returns the row the passenger was added to, or None if the booking
+        is saved later and its row isn't known yet.
+        """
+        raise NotImplementedError
+
+    def add_bookings(self, flight_no, passengers):
+        """
+        Add several passengers (Passenger records) to the flight, as
+        add_booking() does. Returns the list of rows they were added to,
+        or None if the bookings are saved later.
+        """
+        return [self.add_booking(flight_no, passenger)
+                for passenger in passengers]
+
+    def update_detail(self, flight_no, row, detail_type, data):
+        """
+        Change one detail of the passenger in the passed row.
+        Returns the value before the change.
+        """
+        raise NotImplementedError
+
+    def set_checked_in(self, flight_no, row):
+        """
+        Mark the passenger in the passed row as checked in
+        """
+        raise NotImplementedError
+
+    def update_passenger(self, flight_no, row, changes):
+        """
+        Save several changes to the passenger in the passed row.
+        changes is a dict of heading -> new value, where a "checked in"
+        value checks the passenger in.
+        """
+        for detail_type, data in changes.items():
+            if detail_type == "checked in":
+                self.set_checked_in(flight_no, row)
+            else:
+                self.update_detail(flight_no, row, detail_type, data)
+
+    def update_passengers(self, flight_no, changes_by_row):
+        """
+        Save changes to several passengers on the flight, where
+        changes_by_row is a dict of row -> changes as passed to
+        update_passenger()
+        """
+        for row, changes in changes_by_row.items():
+            self.update_passenger(flight_no, row, changes)
+
+
+class EditSession:
+    """
+    Changes to one passenger, collected while the user makes them and then
+    saved together with a single update_passenger() call.
+    The passenger's details are read once when the session starts (unless
+    already read and passed in), to show the values before and after each
+    change.
+    """
+
+    def __init__(self, storage, flight_no, row, passenger=None):
+        self.storage = storage
+        self.flight_no = flight_no
+        self.row = row
+
+        # Details of the passenger before any changes, read from storage as
+        # they decide what can be changed
+        if passenger is None:
+            passenger = storage.get_passenger(flight_no, row, fresh=True)
+
+        self.original = passenger
+        self.changes = {}
+
+    def set(self, detail_type, data):
+        """
+        Change a detail (only saved when commit() is called)
+        """
+        self.changes[detail_type] = data
+
+    def check_in(self):
+        """
+        Check the passenger in along with the other changes
+        """
+        self.changes["checked in"] = True
+
+    def commit(self):
+        """
+        Save all changes and return a list of (detail type, original value,
+        new value) for each of them
+        """
+        if self.changes:
+            self.storage.update_passenger(self.flight_no, self.row,
+                                          self.changes)
+
+        saved = [
+            (detail_type, self.original.get(detail_type), data)
+            for detail_type, data in self.changes.items()
+        ]
+        self.changes = {}
+
+        return saved
+
+
+class SheetsStorage(Storage):
+    """
+    Storage in the magnolia_airport Google Sheets spreadsheet: a "flights"
+    worksheet, a "booking nos" worksheet, then one worksheet per flight.
+
+    In concurrent mode, several terminals can use the spreadsheet at once.
+    Before a passenger's row is read or written, the booking number in it
+    is checked against the booking that was found there. If another
+    terminal has moved the passenger, their new row is found and the
+    operation is retried there.
+    """
+
+    def __init__(self, connection, concurrent=False):
+        # Connection that opens the spreadsheet the first time it is used
+        self.connection = connection
+        self.concurrent = concurrent
+        self._flights_cache = None
+
+        # (flight no, row) -> booking number found there by find_booking()
+        # or add_booking(), used to check rows in concurrent mode
+        self._expected_bookings = {}
+
+        # Index of booking number -> flight, row and passenger names, built
+        # from the flight worksheets and kept up to date with the rows added
+        # to them, found through a change feed
+        self._index_feed = ChangeFeed(lambda: self.spreadsheet,
+                                      connection.refresh_worksheets)
+        self.booking_index = BookingIndex(self._read_flight_worksheets,
+                                          self._read_appended_flight_rows)
+
+    def connect_in_background(self):
+        self.connection.connect_in_background()
+
+    @property
+    def spreadsheet(self):
+        """
+        The project spreadsheet, connecting to it if not yet connected
+        """
+        return self.connection.spreadsheet
+
+    @property
+    def flights_cache(self):
+        """
+        In-memory copy of the flights worksheet, re-read after
+        FLIGHTS_CACHE_TTL seconds or when written to
+        """
+        if self._flights_cache is None:
+            self._flights_cache = FlightsCache(
+                self.connection.worksheet("flights")
+            )
+
+        return self._flights_cache
+
+    def _flight_ws(self, flight_no):
+        """
+        Get the worksheet of the passed flight
+        """
+        return self.connection.worksheet(flight_no)
+
+    def _read_flight_worksheets(self):
+        """
+        Return a (flight no, rows of values) pair for every flight worksheet
+        (all worksheets after "flights" and "booking nos")
+        """
+        # Rows added from now on are read by the next sync
+        self._index_feed.mark()
+        flight_worksheets = self.connection.refresh_worksheets()[2:]
+
+        # Read every flight worksheet at the same time
+        all_rows = run_in_parallel(
+            [flight_ws.get_all_values for flight_ws in flight_worksheets]
+        )
+
+        return [(flight_ws.title, rows)
+                for flight_ws, rows in zip(flight_worksheets, all_rows)]
+
+    def _read_appended_flight_rows(self, row_counts):
+        """
+        Return a (flight no, first row no, rows of values) triple for every
+        flight worksheet, with the rows after the row_counts[flight no]
+        rows already indexed. Nothing is read if the spreadsheet hasn't
+        changed since the last sync.
+        """
+        return self._index_feed.changes(row_counts, start=2)
+
+    def _reread_flight(self, ws, flight_no):
+        """
+        Read all rows of a flight worksheet again
+        """
+        return ws.get_all_values()
+
+    def _relocate(self, ws, flight_no, row, booking_no):
+        """
+        Read the flight's rows again and return the row now holding the
+        passed booking
+        """
+        self.booking_index.reindex_flight(flight_no,
+                                          self._reread_flight(ws, flight_no))
+        location = self.booking_index.lookup(booking_no)
+
+        if location is None or location.flight_no != flight_no:
+            raise ConflictError(f"Booking {booking_no} is no longer on \
+flight {flight_no}")
+
+        self._expected_bookings[(flight_no, location.row)] = booking_no
+
+        return location.row
+
+    def _check_columns(self, ws, flight_no, headings=None):
+        """
+        Check the heading row of a flight worksheet (read now unless its
+        values are passed) before writing to it. If its columns have been
+        moved, e.g. by hand in the spreadsheet, the flight's rows are read
+        and indexed again, so nothing is written or shown out of place.
+        """
+        if get_schema(ws).check(headings):
+            self.booking_index.reindex_flight(
+                flight_no, self._reread_flight(ws, flight_no)
+            )
+
+    def _current_row(self, ws, flight_no, row):
+        """
+        In concurrent mode, check that the passed row still holds the
+        booking found there, and return the row that holds it now
+        """
+        booking_no = self._expected_bookings.get((flight_no, row))
+
+        if not self.concurrent or booking_no is None:
+            return row
+
+        column = get_schema(ws).column("booking no")
+
+        for attempt in range(CONFLICT_RETRIES):
+            if ws.cell(row, column).value == booking_no:
+                return row
+
+            row = self._relocate(ws, flight_no, row, booking_no)
+
+        raise ConflictError(f"Booking {booking_no} keeps moving on flight \
+{flight_no}")
+
+    def list_flights(self):
+        return self.flights_cache.snapshot()
+
+    def list_passengers(self, flight_no):
+        rows = self._flight_ws(flight_no).get_all_values()
+
+        if not rows:
+            return []
+
+        # Numbers converted as get_all_records() does
+        decode = Passenger.decoder(rows[0], numericise=True)
+
+        # Rows left empty (e.g. by a deleted passenger) are skipped, as in
+        # iter_passengers()
+        return [decode(row) for row in rows[1:] if any(row)]
+
+    def iter_passengers(self, flight_no, page_size=PASSENGER_PAGE_SIZE):
+        ws = self._flight_ws(flight_no)
+        headings = get_schema(ws).headings
+        decode = Passenger.decoder(headings, numericise=True)
+
+        # Passengers start at row 2, after the heading row
+        start = 2
+
+        while True:
+            end = start + page_size - 1
+            rows = ws.get(f"A{start}:{rowcol_to_a1(end, len(headings))}")
+
+            for row in rows:
+                # Rows left empty (e.g. by a deleted passenger) are skipped
+                if row:
+                    yield decode(row)
+
+            # Empty rows at the end of the range aren't returned, so a short
+            # page may still have passengers after it. An empty page is the
+            # last one, as is the page with the grid's last row (its row
+            # count, which gspread keeps from the worksheet's properties).
+            if not rows or end >= ws.row_count:
+                return
+
+            start = end + 1
+
+    def list_all_passengers(self):
+        flight_nos = [flight.flight_no for flight in self.list_flights()]
+
+        # Open the spreadsheet once before starting the parallel reads
+        self.spreadsheet
+
+        # Read every flight worksheet at the same time
+        all_passengers = run_in_parallel([
+            lambda flight_no=flight_no: self.list_passengers(flight_no)
+            for flight_no in flight_nos
+        ])
+
+        return dict(zip(flight_nos, all_passengers))
+
+    def passenger_headings(self, flight_no):
+        return get_schema(self._flight_ws(flight_no)).headings
+
+    def find_booking(self, booking_no):
+        location = self.booking_index.lookup(booking_no)
+
+        if location:
+            self._expected_bookings[(location.flight_no,
+                                     location.row)] = booking_no
+
+        return location
+
+    def expect_booking(self, flight_no, row, booking_no):
+        self._expected_bookings[(flight_no, row)] = booking_no
+
+    def search_bookings(self, query, limit=None):
+        return self.booking_index.search(query, limit)
+
+    def get_passenger(self, flight_no, row, fresh=False):
+        # A passenger just found through the booking index was read with
+        # every other row, so their values don't need reading again for
+        # display. Rows held for longer than the index's held row TTL, rows
+        # asked for fresh (to check what can be changed) and rows in
+        # concurrent mode may have changed since, so they are read.
+        if not self.concurrent and not fresh:
+            passenger = self.booking_index.passenger(flight_no, row)
+
+            if passenger is not None:
+                return passenger
+
+        ws = self._flight_ws(flight_no)
+        booking_no = self._expected_bookings.get((flight_no, row))
+
+        for attempt in range(CONFLICT_RETRIES):
+            # Read only the heading row and the passenger's row, with one
+            # request, so the row is decoded with the columns as they are
+            # now. Numbers converted as get_all_records() does.
+            headings, values = [value_range[0] if value_range else []
+                                for value_range in ws.batch_get(
+                                    ["1:1", f"{row}:{row}"])]
+            self._check_columns(ws, flight_no, headings)
+            passenger = Passenger.decoder(headings, numericise=True)(values)
+
+            # The row read includes the booking number, so it can be
+            # checked without another request
+            if (not self.concurrent or booking_no is None
+                    or passenger.booking_no == booking_no):
+                return passenger
+
+            row = self._relocate(ws, flight_no, row, booking_no)
+
+        raise ConflictError(f"Booking {booking_no} keeps moving on flight \
+{flight_no}")
+
+    def get_detail(self, flight_no, row, detail_type):
+        ws = self._flight_ws(flight_no)
+        row = self._current_row(ws, flight_no, row)
+        column = get_schema(ws).column(detail_type)
+
+        return ws.cell(row, column).value
+
+    def used_booking_nos(self):
+        return self.connection.worksheet("booking nos").col_values(1)
+
+    def claim_booking_no(self, booking_no):
+        ws = self.connection.worksheet("booking nos")
+        row = row_from_append_response(ws.append_row([booking_no]))
+
+        # Appends are made in turn, so if another terminal recorded the
+        # value too, the first record of it is in an earlier row
+        values = [cells[0] if cells else ""
+                  for cells in ws.get(f"A1:A{row}")]
+
+        return values.index(booking_no) == row - 1
+
+    def add_booking(self, flight_no, passenger):
+        booking_no = passenger.booking_no
+
+        # Add booking number to worksheet of used numbers
+        self.connection.worksheet("booking nos").append_row([booking_no])
+
+        # Add the passenger details to a new row in the flight's worksheet
+        append_response = self._flight_ws(flight_no).append_row(
+            passenger.values()
+        )
+        row = row_from_append_response(append_response)
+
+        # Keep the booking index up to date with the new passenger's row
+        self.booking_index.add(booking_no, flight_no, row,
+                               passenger.last_name, passenger.first_names,
+                               passenger.passport_no)
+        self._expected_bookings[(flight_no, row)] = booking_no
+
+        return row
+
+    def add_bookings(self, flight_no, passengers):
+        # Add all booking numbers, then all passengers, with one request each
+        self.connection.worksheet("booking nos").append_rows(
+            [[passenger.booking_no] for passenger in passengers]
+        )
+        append_response = self._flight_ws(flight_no).append_rows(
+            [passenger.values() for passenger in passengers]
+        )
+
+        # The passengers are in consecutive rows from the first row written
+        first_row = row_from_append_response(append_response)
+        rows = list(range(first_row, first_row + len(passengers)))
+
+        for passenger, row in zip(passengers, rows):
+            self.booking_index.add(passenger.booking_no, flight_no, row,
+                                   passenger.last_name, passenger.first_names,
+                                   passenger.passport_no)
+            self._expected_bookings[(flight_no, row)] = passenger.booking_no
+
+        return rows
+
+    def update_detail(self, flight_no, row, detail_type, data):
+        ws = self._flight_ws(flight_no)
+        self._check_columns(ws, flight_no)
+        row = self._current_row(ws, flight_no, row)
+        column = get_schema(ws).column(detail_type)
+
+        # Get the original value to show user the change
+        original_value = ws.cell(row, column).value
+        ws.update_cell(row, column, data)
+        self.booking_index.forget(flight_no, row, {detail_type: data})
+
+        return original_value
+
+    def set_checked_in(self, flight_no, row):
+        ws = self._flight_ws(flight_no)
+        self._check_columns(ws, flight_no)
+        row = self._current_row(ws, flight_no, row)
+        ws.update_cell(row, get_schema(ws).column("checked in"), True)
+        self.booking_index.forget(flight_no, row)
+
+    def update_passenger(self, flight_no, row, changes):
+        self.update_passengers(flight_no, {row: changes})
+
+    def update_passengers(self, flight_no, changes_by_row):
+        self._write_passengers(flight_no, changes_by_row)
+
+    def _write_passengers(self, flight_no, changes_by_row):
+        """
+        Write changes to several passengers on the flight with one request,
+        and return the changes keyed by the rows they were written to,
+        which differ from the rows passed if another terminal has moved
+        the passengers
+        """
+        ws = self._flight_ws(flight_no)
+        self._check_columns(ws, flight_no)
+        schema = get_schema(ws)
+
+        # Row each passenger is in now -> changes
+        written = {}
+
+        for row, changes in changes_by_row.items():
+            current_row = self._current_row(ws, flight_no, row)
+            written.setdefault(current_row, {}).update(changes)
+
+        cells = [
+            {
+                "range": rowcol_to_a1(row, schema.column(detail_type)),
+                "values": [[data]]
+            }
+            for row, changes in written.items()
+            for detail_type, data in changes.items()
+        ]
+
+        # Write every changed cell of every passenger with one request
+        ws.batch_update(cells,
+                        value_input_option=ValueInputOption.user_entered)
+
+        for row, changes in written.items():
+            self.booking_index.forget(flight_no, row, changes)
+
+        return written
+
+
+class PrefetchedSheetsStorage(SheetsStorage):
+    """
+    SheetsStorage that reads the whole spreadsheet into a SpreadsheetModel
+    with one batch request, then answers reads from the model. Writes go
+    to the spreadsheet and are applied to the model too.
+    In concurrent mode, passenger rows are still read from the spreadsheet,
+    so that they can be checked.
+    With a WarmCache, the model is saved to disk on close, and loaded from
+    it at start up, so reads are answered at once while the spreadsheet is
+    checked for changes in the background.
+    """
+
+    def __init__(self, connection, concurrent=False, warm_cache=None):
+        super().__init__(connection, concurrent)
+
+        self.model = SpreadsheetModel(
+            lambda: self.spreadsheet,
+            list_worksheets=self.connection.refresh_worksheets,
+            warm_cache=warm_cache
+        )
+
+    def connect_in_background(self):
+        # Answer reads from the copy saved by the last run straight away
+        warm = self.model.load_warm_cache()
+
+        def prefetch():
+            # Errors are raised again when the model is next used
+            try:
+                if warm:
+                    self._revalidate()
+                else:
+                    self.model.titles()
+                    self.model.save_warm_cache()
+            except Exception:
+                pass
+
+        # Connect and read the whole spreadsheet (or check the saved copy)
+        # while the banner is shown
+        threading.Thread(target=prefetch, daemon=True).start()
+
+    def _revalidate(self):
+        """
+        Check the model loaded from the warm cache against the spreadsheet,
+        and index the bookings of any flight that has changed again
+        """
+        changed = self.model.revalidate()
+        flight_nos = self.model.titles()[2:]
+
+        # Runs in the background, so the rows are copied while the model is
+        # locked and indexed while the index is locked
+        self.booking_index.reindex_flights(
+            self.model.copy([title for title in changed
+                             if title in flight_nos])
+        )
+
+    def close(self, timeout=None):
+        # Save the model, with the writes made this run, for the next run
+        try:
+            self.model.save_warm_cache()
+        except OSError:
+            pass
+
+        return 0
+
+    def _read_flight_worksheets(self):
+        return [(title, self.model.values(title))
+                for title in self.model.titles()[2:]]
+
+    def _read_appended_flight_rows(self, row_counts):
+        # Bring the model up to date, then take the rows after those indexed
+        self.model.sync()
+
+        appended = []
+        for title in self.model.titles()[2:]:
+            indexed = row_counts.get(title, 0)
+            appended.append((title, indexed + 1,
+                             self.model.values(title)[indexed:]))
+
+        return appended
+
+    def _reread_flight(self, ws, flight_no):
+        rows = super()._reread_flight(ws, flight_no)
+        self.model.replace(flight_no, rows)
+
+        return rows
+
+    def _records(self, title, record_type, numericise):
+        """
+        Return the rows of a worksheet in the model as records of the
+        passed type, with numbers converted if numericise is True
+        """
+        rows = self.model.values(title)
+
+        if not rows:
+            return []
+
+        decode = record_type.decoder(rows[0], numericise)
+
+        # Rows left empty (e.g. by a deleted passenger) are skipped
+        return [decode(row) for row in rows[1:] if any(row)]
+
+    def list_flights(self):
+        return self._records("flights", Flight, False)
+
+    def list_passengers(self, flight_no):
+        # Numbers converted as get_all_records() does
+        return self._records(flight_no, Passenger, True)
+
+    def iter_passengers(self, flight_no, page_size=PASSENGER_PAGE_SIZE):
+        # Every passenger is already in memory
+        yield from self.list_passengers(flight_no)
+
+    def list_all_passengers(self):
+        return {flight_no: self._records(flight_no, Passenger, True)
+                for flight_no in self.model.titles()[2:]}
+
+    def passenger_headings(self, flight_no):
+        return list(self.model.values(flight_no)[0])
+
+    def get_passenger(self, flight_no, row, fresh=False):
+        if self.concurrent or fresh:
+            passenger = super().get_passenger(flight_no, row, fresh=True)
+
+            # Keep the copy's row in the worksheet's column order
+            headings = get_schema(self._flight_ws(flight_no)).headings
+            details = passenger.as_dict()
+            self.model.set_row(flight_no, row,
+                               [details.get(heading, "")
+                                for heading in headings])
+
+            return passenger
+
+        rows = self.model.values(flight_no)
+
+        return Passenger.decoder(rows[0], numericise=True)(rows[row - 1])
+
+    def get_detail(self, flight_no, row, detail_type):
+        if self.concurrent:
+            return super().get_detail(flight_no, row, detail_type)
+
+        rows = self.model.values(flight_no)
+
+        return rows[row - 1][rows[0].index(detail_type)]
+
+    def used_booking_nos(self):
+        return [row[0] for row in self.model.values("booking nos")]
+
+    def claim_booking_no(self, booking_no):
+        claimed = super().claim_booking_no(booking_no)
+        self.model.append_row("booking nos", [booking_no])
+
+        return claimed
+
+    def add_booking(self, flight_no, passenger):
+        row = super().add_booking(flight_no, passenger)
+
+        self.model.append_row("booking nos", [passenger.booking_no])
+        self.model.set_row(flight_no, row, passenger.values())
+
+        return row
+
+    def add_bookings(self, flight_no, passengers):
+        rows = super().add_bookings(flight_no, passengers)
+
+        for passenger, row in zip(passengers, rows):
+            self.model.append_row("booking nos", [passenger.booking_no])
+            self.model.set_row(flight_no, row, passenger.values())
+
+        return rows
+
+    def update_detail(self, flight_no, row, detail_type, data):
+        original_value = self.get_detail(flight_no, row, detail_type)
+        self.update_passenger(flight_no, row, {detail_type: data})
+
+        return original_value
+
+    def set_checked_in(self, flight_no, row):
+        self.update_passenger(flight_no, row, {"checked in": True})
+
+    def update_passengers(self, flight_no, changes_by_row):
+        written = self._write_passengers(flight_no, changes_by_row)
+
+        # Applied to the rows written to, with the columns as checked
+        # before writing (the model is read again if they had moved)
+        headings = get_schema(self._flight_ws(flight_no)).headings
+        for row, changes in written.items():
+            for detail_type, data in changes.items():
+                self.model.set_cell(flight_no, row,
+                                    headings.index(detail_type) + 1, data)
+
+
+# SQLite column names for each passenger heading, the same as the
+# Passenger record's attribute names
+PASSENGER_COLUMNS = Passenger.FIELDS
+
+# SQLite column names for each flight heading
+FLIGHT_COLUMNS = Flight.FIELDS
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS flights (
+    flight_no TEXT PRIMARY KEY,
+    destination TEXT NOT NULL,
+    date TEXT NOT NULL,
+    departure_time TEXT NOT NULL,
+    arrival_time TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS flights_by_destination ON flights (destination);
+
+CREATE TABLE IF NOT EXISTS passengers (
+    flight_no TEXT NOT NULL REFERENCES flights (flight_no),
+    row_no INTEGER NOT NULL,
+    first_names TEXT NOT NULL,
+    last_name TEXT NOT NULL,
+    date_of_birth TEXT NOT NULL,
+    passport_no TEXT NOT NULL,
+    nationality TEXT NOT NULL,
+    luggage INTEGER NOT NULL,
+    booking_no TEXT NOT NULL UNIQUE,
+    checked_in TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (flight_no, row_no)
+);
+CREATE INDEX IF NOT EXISTS passengers_by_passport_no
+    ON passengers (passport_no);
+CREATE INDEX IF NOT EXISTS passengers_by_last_name
+    ON passengers (last_name COLLATE NOCASE);
+
+CREATE TABLE IF NOT EXISTS booking_nos (
+    booking_no TEXT PRIMARY KEY
+);
+"""
+
+
+class SQLiteStorage(Storage):
+    """
+    Storage in a local SQLite database file, with the same tables as the
+    spreadsheet's worksheets. Passengers are indexed by flight and row and
+    by booking number.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SQLITE_SCHEMA)
+
+    def _passenger_record(self, values):
+        """
+        Turn a row of passenger column values into a Passenger record
+        """
+        return Passenger(*values)
+
+    def list_flights(self):
+        columns = ", ".join(FLIGHT_COLUMNS.values())
+        rows = self.connection.execute(
+            f"SELECT {columns} FROM flights ORDER BY rowid"
+        )
+
+        return [Flight(*row) for row in rows]
+
+    def list_passengers(self, flight_no):
+        columns = ", ".join(PASSENGER_COLUMNS.values())
+        rows = self.connection.execute(
+            f"SELECT {columns} FROM passengers WHERE flight_no = ? \
+ORDER BY row_no", (flight_no,)
+        )
+
+        return [self._passenger_record(row) for row in rows]
+
+    def iter_passengers(self, flight_no, page_size=PASSENGER_PAGE_SIZE):
+        columns = ", ".join(PASSENGER_COLUMNS.values())
+        cursor = self.connection.execute(
+            f"SELECT {columns} FROM passengers WHERE flight_no = ? \
+ORDER BY row_no", (flight_no,)
+        )
+
+        while True:
+            rows = cursor.fetchmany(page_size)
+
+            if not rows:
+                return
+
+            for row in rows:
+                yield self._passenger_record(row)
+
+    def passenger_headings(self, flight_no):
+        return list(PASSENGER_HEADINGS)
+
+    def find_booking(self, booking_no):
+        found = self.connection.execute(
+            "SELECT flight_no, row_no, last_name, first_names \
+FROM passengers WHERE booking_no = ?", (booking_no,)
+        ).fetchone()
+
+        if found:
+            return BookingLocation(*found)
+
+    def search_bookings(self, query, limit=None):
+        # Wildcards in the query are matched as themselves
+        prefix = " ".join(query.split()).replace("\\", "\\\\") \
+            .replace("%", "\\%").replace("_", "\\_") + "%"
+
+        found = self.connection.execute(
+            "SELECT booking_no, flight_no, row_no, last_name, first_names \
+FROM passengers WHERE passport_no = ? OR last_name = ? COLLATE NOCASE \
+OR last_name || ' ' || first_names LIKE ? ESCAPE '\\' \
+OR first_names || ' ' || last_name LIKE ? ESCAPE '\\' \
+ORDER BY last_name COLLATE NOCASE, first_names COLLATE NOCASE, booking_no \
+LIMIT ?",
+            ("".join(query.upper().split()), query.strip(), prefix, prefix,
+             -1 if limit is None else limit)
+        ).fetchall()
+
+        return [(booking_no, BookingLocation(*location))
+                for booking_no, *location in found]
+
+    def get_passenger(self, flight_no, row, fresh=False):
+        columns = ", ".join(PASSENGER_COLUMNS.values())
+        found = self.connection.execute(
+            f"SELECT {columns} FROM passengers \
+WHERE flight_no = ? AND row_no = ?", (flight_no, row)
+        ).fetchone()
+
+        return self._passenger_record(found) if found else None
+
+    def get_detail(self, flight_no, row, detail_type):
+        column = PASSENGER_COLUMNS[detail_type]
+        found = self.connection.execute(
+            f"SELECT {column} FROM passengers \
+WHERE flight_no = ? AND row_no = ?", (flight_no, row)
+        ).fetchone()
+
+        return found[0] if found else None
+
+    def used_booking_nos(self):
+        rows = self.connection.execute("SELECT booking_no FROM booking_nos")
+
+        return [row[0] for row in rows]
+
+    def claim_booking_no(self, booking_no):
+        try:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT INTO booking_nos (booking_no) VALUES (?)",
+                    (booking_no,)
+                )
+        except sqlite3.IntegrityError:
+            return False
+
+        return True
+
+    def add_booking(self, flight_no, passenger):
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO booking_nos (booking_no) VALUES (?)",
+                (passenger.booking_no,)
+            )
+
+            # Next row after the flight's last passenger, starting at row 2
+            row = self.connection.execute(
+                "SELECT COALESCE(MAX(row_no), 1) + 1 FROM passengers \
+WHERE flight_no = ?", (flight_no,)
+            ).fetchone()[0]
+
+            columns = ", ".join(PASSENGER_COLUMNS[heading] for heading
+                                in PASSENGER_HEADINGS[:7])
+            self.connection.execute(
+                f"INSERT INTO passengers (flight_no, row_no, {columns}) \
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (flight_no, row, *passenger.values()[:7])
+            )
+
+        return row
+
+    def update_detail(self, flight_no, row, detail_type, data):
+        original_value = self.get_detail(flight_no, row, detail_type)
+        column = PASSENGER_COLUMNS[detail_type]
+
+        with self.connection:
+            self.connection.execute(
+                f"UPDATE passengers SET {column} = ? \
+WHERE flight_no = ? AND row_no = ?", (data, flight_no, row)
+            )
+
+        return original_value
+
+    def set_checked_in(self, flight_no, row):
+        # Stored as the spreadsheet shows a True cell
+        self.update_detail(flight_no, row, "checked in", "TRUE")
+
+    def update_passenger(self, flight_no, row, changes):
+        changes = dict(changes)
+        if "checked in" in changes:
+            changes["checked in"] = "TRUE"
+
+        assignments = ", ".join(f"{PASSENGER_COLUMNS[detail_type]} = ?"
+                                for detail_type in changes)
+
+        with self.connection:
+            self.connection.execute(
+                f"UPDATE passengers SET {assignments} \
+WHERE flight_no = ? AND row_no = ?",
+                (*changes.values(), flight_no, row)
+            )
+
+    def import_from(self, source):
+        """
+        Replace the contents of the database with the flights, passengers
+        and booking numbers of another storage
+        """
+        flight_columns = ", ".join(FLIGHT_COLUMNS.values())
+        passenger_columns = ", ".join(PASSENGER_COLUMNS.values())
+
+        all_passengers = source.list_all_passengers()
+
+        with self.connection:
+            self.connection.execute("DELETE FROM passengers")
+            self.connection.execute("DELETE FROM flights")
+            self.connection.execute("DELETE FROM booking_nos")
+
+            for flight in source.list_flights():
+                self.connection.execute(
+                    f"INSERT INTO flights ({flight_columns}) \
+VALUES (?, ?, ?, ?, ?)",
+                    flight.values()
+                )
+
+                # Booking numbers are unique, so a row without one (e.g.
+                # one only partly cleared by hand) can't be imported
+                passengers = [passenger for passenger
+                              in all_passengers[flight.flight_no]
+                              if passenger.booking_no]
+                for row, passenger in enumerate(passengers, start=2):
+                    self.connection.execute(
+                        f"INSERT INTO passengers \
+(flight_no, row_no, {passenger_columns}) \
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (flight.flight_no, row,
+                         *[str(value) for value in passenger.values()])
+                    )
+
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO booking_nos (booking_no) VALUES (?)",
+                [(booking_no,) for booking_no in source.used_booking_nos()]
+            )
+
+
+def sync_bookings(source, target):
+    """
+    Copy the bookings in source to target: passengers missing from target
+    are added, and details that differ are updated.
+    Every flight of target is read once and compared in memory, and the
+    changes to each flight are saved with one update_passengers() call.
+    Returns the number of passengers added and details updated.
+    """
+    added = 0
+    updated = 0
+
+    # Booking no -> passenger, for every passenger already in target
+    current_passengers = {
+        passenger.booking_no: passenger
+        for passengers in target.list_all_passengers().values()
+        for passenger in passengers
+    }
+
+    # Flight no -> row -> changes to save
+    changes_by_flight = {}
+
+    for flight_no, passengers in source.list_all_passengers().items():
+        for passenger in passengers:
+            current = current_passengers.get(passenger.booking_no)
+
+            if current is None:
+                # Added first, then checked in with the other changes
+                row = target.add_booking(
+                    flight_no, passenger.replace({"checked in": ""})
+                )
+                added += 1
+
+                if not passenger.checked_in:
+                    continue
+
+                # A queued booking's row is known once it is saved
+                if row is None:
+                    row = target.find_booking(passenger.booking_no).row
+
+                changes_by_flight.setdefault(flight_no, {})[row] = \
+                    {"checked in": True}
+                continue
+
+            changes = {
+                heading: passenger.get(heading)
+                for heading in PASSENGER_HEADINGS[:6]
+                if str(current.get(heading)) != str(passenger.get(heading))
+            }
+
+            if passenger.checked_in and not current.checked_in:
+                changes["checked in"] = True
+
+            if changes:
+                location = target.find_booking(passenger.booking_no)
+                changes_by_flight.setdefault(
+                    location.flight_no, {}
+                )[location.row] = changes
+                updated += len(changes)
+
+    for flight_no, changes_by_row in changes_by_flight.items():
+        target.update_passengers(flight_no, changes_by_row)
+
+    return added, updated
+
+
+def open_sheets_storage(connection=None):
+    """
+    Storage in the magnolia_airport spreadsheet, using the service account
+    in creds.json (or the passed SheetsConnection). Nothing is sent over
+    the network until first use.
+    Set PORTAL_CONCURRENT to "on" when several terminals share the
+    spreadsheet, and PORTAL_PREFETCH to "on" to read the whole spreadsheet
+    in one request. The prefetched spreadsheet is kept in a warm cache
+    file (PORTAL_WARM_CACHE_PATH) between runs, unless PORTAL_WARM_CACHE
+    is set to "off".
+    """
+    concurrent = os.environ.get("PORTAL_CONCURRENT", "off") == "on"
+    connection = connection or SheetsConnection()
+
+    if os.environ.get("PORTAL_PREFETCH", "off") == "on":
+        warm_cache = None
+        if os.environ.get("PORTAL_WARM_CACHE", "on") == "on":
+            warm_cache = WarmCache(connection.spreadsheet_name)
+
+        return PrefetchedSheetsStorage(connection, concurrent, warm_cache)
+
+    return SheetsStorage(connection, concurrent)
+
+
+def open_storage(connection=None):
+    """
+    Open the storage chosen with the PORTAL_STORAGE environment variable:
+    "sheets" (default) or "sqlite", which uses the database file in
+    PORTAL_SQLITE_PATH (default magnolia_airport.db).
+    Writes to the spreadsheet go through a local write queue (journal file
+    in PORTAL_WRITE_QUEUE_PATH) unless PORTAL_WRITE_QUEUE is set to "off".
+    A SheetsConnection can be passed to use instead of the default one.
+    """
+    backend = os.environ.get("PORTAL_STORAGE", "sheets")
+
+    if backend == "sheets":
+        if os.environ.get("PORTAL_WRITE_QUEUE", "on") == "off":
+            return open_sheets_storage(connection)
+
+        # Imported here as write_queue builds on this module
+        from write_queue import QueuedStorage
+
+        return QueuedStorage(
+            open_sheets_storage(connection),
+            os.environ.get("PORTAL_WRITE_QUEUE_PATH", "write_queue.db")
+        )
+    elif backend == "sqlite":
+        return SQLiteStorage(
+            os.environ.get("PORTAL_SQLITE_PATH", "magnolia_airport.db")
+        )
+    else:
+        raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def main():
+    """
+    Copy data between the spreadsheet and a SQLite database
+    """
+    parser = argparse.ArgumentParser(
+        description="Copy data between the spreadsheet and a SQLite database"
+    )
+    parser.add_argument(
+        "command", choices=["import", "sync"],
+        help="import: copy the spreadsheet into the database, \
+sync: add/update the database's bookings in the spreadsheet"
+    )
+    parser.add_argument("database", help="path of the SQLite database file")
+    args = parser.parse_args()
+
+    sheets = open_sheets_storage()
+    database = SQLiteStorage(args.database)
+
+    if args.command == "import":
+        database.import_from(sheets)
+        print(f"Spreadsheet copied to {args.database}")
+    else:
+        added, updated = sync_bookings(database, sheets)
+        print(f"{added} passengers added, {updated} details updated")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+from datetime import datetime
+
+# To check nationalities against the world's countries
+from country_index import COUNTRY_INDEX
+
+
+def validate_passenger_detail(detail_type, data):
+    """
+    Formats input data and then checks that it is of the expected type.
+    Returns a dict with the validity of the data, the formatted data and,
+    if invalid, the reason why.
+    """
+
+    # Create a dictionary with values to return to where function was called
+    # Validity of data, formatted data and the reason for invalid data are
+    # returned at the same time
+    validated_info = {"validity": False, "data": None, "error": None}
+
+    # For each detail type, check that the input matches the expected data type
+    try:
+        if detail_type == "first name(s)" or detail_type == "last name":
+            formatted_info = data.title().strip()
+
+            # Check that names contain at least one letter
+            contains_letter = False
+            for i in formatted_info:
+                if i.isalpha():
+                    contains_letter = True
+
+            if not contains_letter:
+                raise ValueError("name must contain at least one letter")
+            # Check that names only include allowed characters
+            elif not all(ch.isalpha() or ch.isspace() or ch == "-"
+                         or ch == "'" for ch in formatted_info):
+                raise ValueError("name must consist of letters, spaces, \
+apostrophes (') or dashes (-) only")
+
+        elif detail_type == "date of birth":
+            # Check that the input can be parsed to a datetime object
+            input_date = datetime.strptime(data, '%Y-%m-%d').date()
+
+            # Check that birth date is in the past
+            today = datetime.now().date()
+            if today <= input_date:
+                raise ValueError("date of birth must be in the past")
+
+            formatted_info = data
+
+        elif detail_type == "passport no":
+            formatted_info = data.upper()
+
+            if not formatted_info.isalnum():
+                raise ValueError("passport number must be letters and \
+numbers only")
+
+        elif detail_type == "nationality":
+            # Save the country's name, whichever way it was written
+            formatted_info = COUNTRY_INDEX.lookup(data)
+
+            if formatted_info is None:
+                suggestions = COUNTRY_INDEX.suggest(data)
+
+                if suggestions:
+                    suggestion = " or ".join(name.title()
+                                             for name in suggestions)
+                    raise ValueError(f"must be a country name (did you \
+mean {suggestion}?)")
+
+                raise ValueError("must be a country name")
+
+        elif detail_type == "luggage":
+            formatted_info = int(data)
+
+            if not (0 <= formatted_info <= 2):
+                raise ValueError("number of luggage items must be between \
+0 and 2")
+
+        # In case a new passenger detail type gets added in future,
+        # this will run before validation added
+        else:
+            print("Validation not yet available. Returning original value.")
+            formatted_info = data
+
+    except ValueError as e:
+        validated_info["error"] = str(e)
+
+    else:
+        # If not errors, set validity to True and add formatted data
+        # to return value
+        validated_info["validity"] = True
+        validated_info["data"] = formatted_info
+
+    return validated_info
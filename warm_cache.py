@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+
+
+# Version of the cache file's layout. A file saved with another version is
+# ignored, and replaced the next time the cache is saved.
+CACHE_VERSION = 1
+
+# File the prefetched spreadsheet is saved to between runs. Can be set with
+# the PORTAL_WARM_CACHE_PATH environment variable.
+WARM_CACHE_PATH = os.environ.get("PORTAL_WARM_CACHE_PATH", "warm_cache.json")
+
+
+def worksheet_stamp(rows):
+    """
+    Return the revision stamp of a worksheet's values: its number of rows
+    and a digest of every value, which changes whenever any value does
+    """
+    digest = hashlib.sha256(
+        json.dumps(rows, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+    return f"{len(rows)}-{digest[:16]}"
+
+
+class WarmCache:
+    """
+    Copy of every worksheet's values kept in a local JSON file, so that a
+    restarted portal can answer reads straight away instead of waiting to
+    read the whole spreadsheet. Along with the values, the file holds:
+    - the spreadsheet's modified time when they were read, to find out
+      whether anything has changed since
+    - a revision stamp per worksheet, to find out which worksheets changed
+      once they have been read again, and to check that the values loaded
+      are the values saved
+    """
+
+    def __init__(self, spreadsheet_name, path=WARM_CACHE_PATH):
+        self.spreadsheet_name = spreadsheet_name
+        self.path = path
+
+    def load(self):
+        """
+        Return a dict with the "revision", "titles", "values" (title ->
+        rows) and "stamps" (title -> revision stamp) saved, or None if the
+        file is missing, from another version or spreadsheet, or damaged
+        """
+        try:
+            with open(self.path, encoding="utf-8") as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+        if (not isinstance(cache, dict)
+                or cache.get("version") != CACHE_VERSION
+                or cache.get("spreadsheet") != self.spreadsheet_name):
+            return None
+
+        try:
+            titles = [worksheet["title"] for worksheet in cache["worksheets"]]
+            values = {worksheet["title"]: worksheet["values"]
+                      for worksheet in cache["worksheets"]}
+            stamps = {worksheet["title"]: worksheet["stamp"]
+                      for worksheet in cache["worksheets"]}
+        except (KeyError, TypeError):
+            return None
+
+        # A worksheet whose values don't match their stamp was damaged
+        for title in titles:
+            if worksheet_stamp(values[title]) != stamps[title]:
+                return None
+
+        return {"revision": cache.get("revision"), "titles": titles,
+                "values": values, "stamps": stamps}
+
+    def save(self, revision, titles, values):
+        """
+        Save the values of every worksheet (title -> rows, for each of the
+        titles), read at the passed revision of the spreadsheet
+        """
+        cache = {
+            "version": CACHE_VERSION,
+            "spreadsheet": self.spreadsheet_name,
+            "revision": revision,
+            "saved at": datetime.now(timezone.utc).isoformat(),
+            "worksheets": [
+                {"title": title, "stamp": worksheet_stamp(values[title]),
+                 "values": values[title]}
+                for title in titles
+            ]
+        }
+
+        # Written to another file first, then moved over the cache, so a
+        # portal starting meanwhile never reads half a file
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+
+        with open(temp_path, "w", encoding="utf-8") as cache_file:
+            json.dump(cache, cache_file, separators=(",", ":"))
+
+        os.replace(temp_path, self.path)
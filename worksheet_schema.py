@@ -0,0 +1,114 @@
+class WorksheetSchema:
+    """
+    Column headings of a worksheet, read from row 1 once and kept as
+    heading -> column number and column number -> heading maps.
+    Column order can still be changed or new columns added: if a heading
+    is asked for that isn't in the maps, row 1 is read again, and check()
+    compares the maps with row 1 before a write, so a column moved in the
+    spreadsheet is written to where it is now.
+    """
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self._columns = None
+        self._headings = None
+
+    def refresh(self, headings=None):
+        """
+        Read row 1 of the worksheet (unless its values are passed) and
+        rebuild both maps
+        """
+        if headings is None:
+            headings = self.worksheet.row_values(1)
+
+        self._columns = {
+            heading: col for col, heading in enumerate(headings, start=1)
+        }
+        self._headings = {
+            col: heading for heading, col in self._columns.items()
+        }
+
+    def check(self, headings=None):
+        """
+        Compare the maps with row 1 of the worksheet, read now unless its
+        values are passed, and rebuild them if the headings have changed.
+        Returns True if they had (False if row 1 hadn't been read before).
+        """
+        if headings is None:
+            headings = self.worksheet.row_values(1)
+
+        if self._columns is None:
+            self.refresh(headings)
+            return False
+
+        if headings == self.headings:
+            return False
+
+        self.refresh(headings)
+
+        return True
+
+    def _ensure_loaded(self):
+        """
+        Read row 1 if it hasn't been read yet
+        """
+        if self._columns is None:
+            self.refresh()
+
+    @property
+    def headings(self):
+        """
+        List of headings in column order
+        """
+        self._ensure_loaded()
+
+        return [self._headings[col] for col in sorted(self._headings)]
+
+    def column(self, heading):
+        """
+        Get the column number (starting at 1) of the passed heading
+        """
+        self._ensure_loaded()
+
+        # Heading not found: the headings may have changed, so read again
+        if heading not in self._columns:
+            self.refresh()
+
+        if heading not in self._columns:
+            raise KeyError(f"No '{heading}' column in worksheet \
+{self.worksheet.title}")
+
+        return self._columns[heading]
+
+    def heading(self, column):
+        """
+        Get the heading of the passed column number
+        """
+        self._ensure_loaded()
+
+        if column not in self._headings:
+            self.refresh()
+
+        return self._headings[column]
+
+
+# Schemas already read in this session, keyed by worksheet title
+_SCHEMAS = {}
+
+
+def get_schema(worksheet):
+    """
+    Get the schema of the passed worksheet, reading its headings only the
+    first time it is asked for
+    """
+    if worksheet.title not in _SCHEMAS:
+        _SCHEMAS[worksheet.title] = WorksheetSchema(worksheet)
+
+    return _SCHEMAS[worksheet.title]
+
+
+def clear_schemas():
+    """
+    Forget every schema read, e.g. when a different spreadsheet is opened
+    """
+    _SCHEMAS.clear()
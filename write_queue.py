@@ -0,0 +1,661 @@
+import json
+import random
+import sqlite3
+import threading
+import uuid
+from time import sleep
+
+from gspread.exceptions import APIError, WorksheetNotFound
+
+from records import Passenger
+from scheduler import RATE_LIMITED, SERVER_ERRORS
+from storage import PASSENGER_PAGE_SIZE, ConflictError, Storage
+
+
+# Number of queued writes read from the journal each time the flusher
+# wakes up. Consecutive writes of the same kind to the same flight among
+# them are saved together.
+FLUSH_BATCH_SIZE = 20
+
+# Kind of each queued operation. Consecutive writes of the same kind to
+# the same flight are saved with one add_bookings() or update_passengers()
+# call.
+WRITE_KINDS = {
+    "add_booking": "bookings",
+    "add_bookings": "bookings",
+    "update_detail": "changes",
+    "set_checked_in": "changes",
+    "update_passenger": "changes",
+    "update_passengers": "changes"
+}
+
+# Longest wait in seconds between retries of a failing write
+MAX_RETRY_DELAY = 60
+
+# Longest wait in seconds for queued writes before a read goes ahead anyway
+READ_WAIT_TIMEOUT = 30
+
+
+def is_permanent(error):
+    """
+    Return True if a write that failed with the passed error can never
+    succeed, so sending it again would only hold up the writes after it:
+    the request was refused for a reason other than the rate limit or a
+    server problem, the flight or column is gone, or the passenger moved
+    """
+    if isinstance(error, APIError):
+        status = error.response.status_code
+
+        return status != RATE_LIMITED and status not in SERVER_ERRORS
+
+    return isinstance(error, (ConflictError, WorksheetNotFound, LookupError,
+                              ValueError))
+
+
+def row_changes(operation, args):
+    """
+    Return the changes made by a queued change write as a list of (row,
+    changes, booking no) triples, where changes is a dict of heading ->
+    new value and booking no is the booking found in the row when the
+    change was queued (None for writes queued without one)
+    """
+    if operation == "update_detail":
+        flight_no, row, detail_type, data, *booking_no = args
+        return [(row, {detail_type: data}, (booking_no or [None])[0])]
+    elif operation == "set_checked_in":
+        flight_no, row, *booking_no = args
+        return [(row, {"checked in": True}, (booking_no or [None])[0])]
+    elif operation == "update_passenger":
+        flight_no, row, changes, *booking_no = args
+        return [(row, changes, (booking_no or [None])[0])]
+
+    flight_no, all_changes, *bookings = args
+    booking_nos = dict(bookings[0]) if bookings else {}
+
+    return [(row, changes, booking_nos.get(row))
+            for row, changes in all_changes]
+
+
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending_writes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    operation TEXT NOT NULL,
+    flight_no TEXT NOT NULL,
+    args TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    failed INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+class WriteQueue:
+    """
+    Append-only journal of writes waiting to be sent to storage, kept in a
+    local SQLite file so that queued writes survive a crash or restart.
+    Each write has an idempotency key, so replaying a write that may
+    already have reached storage doesn't apply it twice.
+    """
+
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(JOURNAL_SCHEMA)
+
+        # Guards the journal and wakes up threads waiting for a flush
+        self._condition = threading.Condition()
+
+    def append(self, key, operation, flight_no, args):
+        """
+        Add a write to the end of the journal. A write with a key that is
+        already queued is ignored.
+        """
+        with self._condition, self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO pending_writes \
+(key, operation, flight_no, args) VALUES (?, ?, ?, ?)",
+                (key, operation, flight_no, json.dumps(args))
+            )
+            self._condition.notify_all()
+
+    def pending(self, limit=None, flight_no=None):
+        """
+        Return queued writes, oldest first, as (id, key, operation,
+        flight_no, args, attempts) tuples
+        """
+        query = "SELECT id, key, operation, flight_no, args, attempts \
+FROM pending_writes WHERE failed = 0"
+        params = []
+
+        if flight_no is not None:
+            query += " AND flight_no = ?"
+            params.append(flight_no)
+
+        query += " ORDER BY id"
+
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        with self._condition:
+            rows = self._connection.execute(query, params).fetchall()
+
+        return [(id, key, operation, flight, json.loads(args), attempts)
+                for id, key, operation, flight, args, attempts in rows]
+
+    def is_queued(self, key):
+        """
+        Check if a write with the passed key is still waiting
+        """
+        with self._condition:
+            return self._connection.execute(
+                "SELECT 1 FROM pending_writes WHERE key = ? AND failed = 0",
+                (key,)
+            ).fetchone() is not None
+
+    def remove(self, id):
+        """
+        Remove a write that has reached storage
+        """
+        with self._condition, self._connection:
+            self._connection.execute(
+                "DELETE FROM pending_writes WHERE id = ?", (id,)
+            )
+            self._condition.notify_all()
+
+    def record_failure(self, id, error):
+        """
+        Count a failed attempt at a write and keep its error message
+        """
+        with self._condition, self._connection:
+            self._connection.execute(
+                "UPDATE pending_writes SET attempts = attempts + 1, \
+last_error = ? WHERE id = ?", (str(error), id)
+            )
+
+    def mark_failed(self, id, error):
+        """
+        Stop retrying a write that can never succeed. It is kept in the
+        journal, with its error, to be looked at. Its key is changed, so
+        the same write can be queued again.
+        """
+        with self._condition, self._connection:
+            self._connection.execute(
+                "UPDATE pending_writes SET failed = 1, last_error = ?, \
+key = key || ':failed:' || id WHERE id = ?",
+                (f"{type(error).__name__}: {error}", id)
+            )
+            self._condition.notify_all()
+
+    def failed(self):
+        """
+        Return the writes that failed for good, oldest first, as (id,
+        operation, flight_no, args, error) tuples
+        """
+        with self._condition:
+            rows = self._connection.execute(
+                "SELECT id, operation, flight_no, args, last_error \
+FROM pending_writes WHERE failed = 1 ORDER BY id"
+            ).fetchall()
+
+        return [(id, operation, flight_no, json.loads(args), error)
+                for id, operation, flight_no, args, error in rows]
+
+    def wait(self, predicate, timeout=None):
+        """
+        Wait until predicate() is true, checking again whenever the journal
+        changes. Returns the last result of predicate().
+        """
+        with self._condition:
+            return self._condition.wait_for(predicate, timeout)
+
+    def last_id(self):
+        """
+        Return the id of the last write in the journal, or 0 if it is empty
+        """
+        with self._condition:
+            return self._connection.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM pending_writes"
+            ).fetchone()[0]
+
+    def wait_for_write(self, timeout=None):
+        """
+        Wait until a write is appended or timeout seconds pass
+        """
+        with self._condition:
+            self._condition.wait(timeout)
+
+
+class QueuedStorage(Storage):
+    """
+    Storage that acknowledges writes as soon as they are in the local write
+    queue, while a background thread replays them to the wrapped storage in
+    order, retrying with backoff when it fails. Consecutive bookings, or
+    consecutive changes, to the same flight are saved together, with one
+    request each for the booking numbers and the passenger rows (or the
+    changed cells).
+    Reads go to the wrapped storage. A read of a passenger or flight that
+    has queued writes waits for those writes, or is answered from the queue.
+    """
+
+    def __init__(self, storage, journal_path):
+        self.storage = storage
+        self.queue = WriteQueue(journal_path)
+        self._flusher = None
+
+        # (flight no, row) -> booking number found there, saved with each
+        # change queued for the row so that it is written to the same
+        # passenger, wherever they are when it is replayed
+        self._found_bookings = {}
+
+        # Writes up to this id were queued by an earlier run, which may
+        # have ended after saving them but before removing them
+        self._recovered_id = self.queue.last_id()
+
+    def _start_flusher(self):
+        """
+        Start the background thread that replays queued writes, if it
+        isn't already running
+        """
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_forever,
+                                             daemon=True)
+            self._flusher.start()
+
+    def _flush_forever(self):
+        """
+        Replay queued writes in batches for as long as the program runs
+        """
+        while True:
+            batch = self.queue.pending(limit=FLUSH_BATCH_SIZE)
+
+            if not batch:
+                self.queue.wait_for_write(timeout=5)
+                continue
+
+            for writes in self._runs(batch):
+                # Keep writes in order: retry these before the rest
+                if not self._replay(writes):
+                    break
+
+    def _runs(self, batch):
+        """
+        Split a batch of queued writes into runs of consecutive writes of
+        the same kind (bookings or changes) to the same flight, which can
+        be saved together
+        """
+        runs = []
+        last = None
+
+        for write in batch:
+            operation, flight_no = write[2], write[3]
+            run = (flight_no, WRITE_KINDS.get(operation, operation))
+
+            if runs and run == last:
+                runs[-1].append(write)
+            else:
+                runs.append([write])
+
+            last = run
+
+        return runs
+
+    def _replay(self, writes):
+        """
+        Send a run of writes to the wrapped storage, together if there are
+        several, and remove them from the queue. Returns False if they
+        failed and must be tried again after a wait.
+        """
+        if len(writes) > 1:
+            try:
+                self._apply_together(writes)
+            except Exception as e:
+                if not is_permanent(e):
+                    return self._retry_later(writes[0], e)
+
+                # One of the writes can never succeed, so send them one at
+                # a time to find it, and save the others
+            else:
+                for write in writes:
+                    self.queue.remove(write[0])
+
+                return True
+
+        for write in writes:
+            id, key, operation, flight_no, args, attempts = write
+
+            try:
+                self._apply(operation, args, self._may_be_saved(write))
+            except Exception as e:
+                # Retrying can't help, so let the writes after it go
+                if is_permanent(e):
+                    self.queue.mark_failed(id, e)
+                    continue
+
+                return self._retry_later(write, e)
+            else:
+                self.queue.remove(id)
+
+        return True
+
+    def _retry_later(self, write, error):
+        """
+        Count a failed attempt at a write, then wait before it is tried
+        again. Returns False.
+        """
+        id, attempts = write[0], write[5]
+        self.queue.record_failure(id, error)
+
+        # Wait before trying again, doubling the wait after each failure,
+        # with jitter so terminals don't retry together
+        delay = min(2 ** attempts, MAX_RETRY_DELAY)
+        sleep(delay * random.uniform(0.5, 1))
+
+        return False
+
+    def _may_be_saved(self, write):
+        """
+        Return True if the write may already have reached storage: it was
+        tried before, or queued by an earlier run that may have ended
+        after saving it but before removing it from the queue
+        """
+        return write[5] > 0 or write[0] <= self._recovered_id
+
+    def _apply_together(self, writes):
+        """
+        Send a run of writes of the same kind to one flight as a single
+        add_bookings() or update_passengers() call
+        """
+        flight_no = writes[0][3]
+
+        if WRITE_KINDS[writes[0][2]] == "bookings":
+            all_values = []
+            for id, key, operation, flight, args, attempts in writes:
+                if operation == "add_booking":
+                    all_values.append(args[1])
+                else:
+                    all_values += args[1]
+
+            self._apply("add_bookings", [flight_no, all_values],
+                        any(self._may_be_saved(write) for write in writes))
+            return
+
+        # Later changes to the same detail replace earlier ones
+        changes_by_row = {}
+        for id, key, operation, flight, args, attempts in writes:
+            for row, changes, booking_no in row_changes(operation, args):
+                self._expect_booking(flight_no, row, booking_no)
+                changes_by_row.setdefault(row, {}).update(changes)
+
+        self.storage.update_passengers(flight_no, changes_by_row)
+
+    def _expect_booking(self, flight_no, row, booking_no):
+        """
+        Tell the wrapped storage which booking a queued change was made
+        to, so that it checks the row still holds it, and finds the
+        passenger's new row if it doesn't
+        """
+        if booking_no is not None:
+            self.storage.expect_booking(flight_no, row, booking_no)
+
+    def _apply(self, operation, args, may_be_saved=True):
+        """
+        Send one queued write to the wrapped storage. If the write may
+        already have reached storage, bookings are only added if they
+        aren't there yet.
+        """
+        if operation == "add_booking":
+            flight_no, values = args
+            passenger = Passenger(*values)
+
+            if may_be_saved and self.storage.find_booking(
+                    passenger.booking_no):
+                return
+
+            self.storage.add_booking(flight_no, passenger)
+        elif operation == "add_bookings":
+            flight_no, all_values = args
+            passengers = [Passenger(*values) for values in all_values]
+
+            # Leave out passengers already added before a failure or crash
+            if may_be_saved:
+                passengers = [
+                    passenger for passenger in passengers
+                    if not self.storage.find_booking(passenger.booking_no)
+                ]
+
+            if passengers:
+                self.storage.add_bookings(flight_no, passengers)
+        elif operation in WRITE_KINDS:
+            flight_no = args[0]
+            changes_by_row = {}
+
+            for row, changes, booking_no in row_changes(operation, args):
+                self._expect_booking(flight_no, row, booking_no)
+                changes_by_row[row] = changes
+
+            if operation == "update_detail":
+                self.storage.update_detail(*args[:4])
+            elif operation == "set_checked_in":
+                self.storage.set_checked_in(*args[:2])
+            else:
+                self.storage.update_passengers(flight_no, changes_by_row)
+        else:
+            raise ValueError(f"Unknown queued operation: {operation}")
+
+    def _wait_for_flight(self, flight_no):
+        """
+        Wait until there are no queued writes for the passed flight
+        """
+        self._start_flusher()
+        self.queue.wait(lambda: not self.queue.pending(flight_no=flight_no),
+                        READ_WAIT_TIMEOUT)
+
+    def connect_in_background(self):
+        self.storage.connect_in_background()
+
+        # Replay any writes left in the queue by a previous run
+        self._start_flusher()
+
+    def close(self, timeout=None):
+        # Give queued writes a chance to reach storage before exiting
+        self._start_flusher()
+        self.queue.wait(lambda: not self.queue.pending(limit=1), timeout)
+
+        # Writes not yet replayed stay in the journal for the next run
+        self.storage.close(timeout=0)
+
+        return len(self.queue.pending())
+
+    def failed_writes(self):
+        return [(operation, flight_no, error)
+                for id, operation, flight_no, args, error
+                in self.queue.failed()]
+
+    def list_flights(self):
+        return self.storage.list_flights()
+
+    def list_passengers(self, flight_no):
+        self._wait_for_flight(flight_no)
+
+        return self.storage.list_passengers(flight_no)
+
+    def iter_passengers(self, flight_no, page_size=PASSENGER_PAGE_SIZE):
+        self._wait_for_flight(flight_no)
+
+        yield from self.storage.iter_passengers(flight_no, page_size)
+
+    def passenger_headings(self, flight_no):
+        return self.storage.passenger_headings(flight_no)
+
+    def _queued_booking_key(self, booking_no):
+        """
+        Return the key of the queued write that adds the passed booking,
+        or None if it isn't queued
+        """
+        key = f"add_booking:{booking_no}"
+        if self.queue.is_queued(key):
+            return key
+
+        # Bookings added together are queued as one write
+        for id, key, operation, flight_no, args, attempts \
+                in self.queue.pending():
+            if operation == "add_bookings" and any(
+                    Passenger(*values).booking_no == booking_no
+                    for values in args[1]):
+                return key
+
+        return None
+
+    def find_booking(self, booking_no):
+        # A booking still in the queue has no row yet, so wait for it
+        key = self._queued_booking_key(booking_no)
+        if key is not None:
+            self._start_flusher()
+            self.queue.wait(lambda: not self.queue.is_queued(key),
+                            READ_WAIT_TIMEOUT)
+
+        location = self.storage.find_booking(booking_no)
+
+        if location:
+            self._found_bookings[(location.flight_no,
+                                  location.row)] = booking_no
+
+        return location
+
+    def _bookings_queued(self):
+        """
+        Return True if any booking is still in the queue
+        """
+        return any(write[2] in ("add_booking", "add_bookings")
+                   for write in self.queue.pending())
+
+    def search_bookings(self, query, limit=None):
+        # Bookings still in the queue have no row yet, so wait for them
+        if self._bookings_queued():
+            self._start_flusher()
+            self.queue.wait(lambda: not self._bookings_queued(),
+                            READ_WAIT_TIMEOUT)
+
+        return self.storage.search_bookings(query, limit)
+
+    def _queued_changes(self, flight_no, row):
+        """
+        Return a dict of heading -> value of the queued changes to the
+        passenger in the passed row, oldest first so newer values win.
+        Changes queued with a booking number are matched by it, as the
+        passenger may have been in another row when they were queued.
+        """
+        found = self._found_bookings.get((flight_no, row))
+        changes = {}
+
+        for write in self.queue.pending(flight_no=flight_no):
+            operation, args = write[2], write[4]
+
+            if WRITE_KINDS.get(operation) != "changes":
+                continue
+
+            for changed_row, new_values, booking_no in row_changes(
+                    operation, args):
+                if (booking_no == found if found and booking_no
+                        else changed_row == row):
+                    changes.update(new_values)
+
+        # A check in is read back from storage as TRUE
+        if "checked in" in changes:
+            changes["checked in"] = "TRUE"
+
+        return changes
+
+    def get_passenger(self, flight_no, row, fresh=False):
+        passenger = self.storage.get_passenger(flight_no, row, fresh)
+
+        return passenger.replace(self._queued_changes(flight_no, row))
+
+    def get_detail(self, flight_no, row, detail_type):
+        # A queued change of this detail is its current value
+        changes = self._queued_changes(flight_no, row)
+        if detail_type in changes:
+            return changes[detail_type]
+
+        return self.storage.get_detail(flight_no, row, detail_type)
+
+    def _queued_booking_nos(self):
+        """
+        Booking numbers of the bookings waiting in the queue
+        """
+        queued_booking_nos = []
+
+        for id, key, operation, flight_no, args, attempts \
+                in self.queue.pending():
+            if operation == "add_booking":
+                queued_booking_nos.append(Passenger(*args[1]).booking_no)
+            elif operation == "add_bookings":
+                queued_booking_nos += [Passenger(*values).booking_no
+                                       for values in args[1]]
+
+        return queued_booking_nos
+
+    def used_booking_nos(self):
+        return self.storage.used_booking_nos() + self._queued_booking_nos()
+
+    def claim_booking_no(self, booking_no):
+        # Not queued, as the answer is needed straight away
+        return self.storage.claim_booking_no(booking_no)
+
+    def add_booking(self, flight_no, passenger):
+        # The record is queued as its list of values
+        self.queue.append(f"add_booking:{passenger.booking_no}",
+                          "add_booking", flight_no,
+                          [flight_no, passenger.values()])
+        self._start_flusher()
+
+        # The row is only known once the write reaches storage
+        return None
+
+    def add_bookings(self, flight_no, passengers):
+        # Queued as one write, so they are saved with one request
+        self.queue.append(f"add_bookings:{uuid.uuid4()}", "add_bookings",
+                          flight_no,
+                          [flight_no, [passenger.values()
+                                       for passenger in passengers]])
+        self._start_flusher()
+
+        return None
+
+    def update_detail(self, flight_no, row, detail_type, data):
+        original_value = self.get_detail(flight_no, row, detail_type)
+
+        # Each change gets its own key, as the same detail can be changed
+        # more than once
+        key = f"update_detail:{uuid.uuid4()}"
+        self.queue.append(key, "update_detail", flight_no,
+                          [flight_no, row, detail_type, data,
+                           self._found_bookings.get((flight_no, row))])
+        self._start_flusher()
+
+        return original_value
+
+    def set_checked_in(self, flight_no, row):
+        self.queue.append(f"set_checked_in:{flight_no}:{row}",
+                          "set_checked_in", flight_no,
+                          [flight_no, row,
+                           self._found_bookings.get((flight_no, row))])
+        self._start_flusher()
+
+    def update_passenger(self, flight_no, row, changes):
+        self.queue.append(f"update_passenger:{uuid.uuid4()}",
+                          "update_passenger", flight_no,
+                          [flight_no, row, changes,
+                           self._found_bookings.get((flight_no, row))])
+        self._start_flusher()
+
+    def update_passengers(self, flight_no, changes_by_row):
+        # Rows are saved as lists of pairs, as JSON keys must be strings
+        booking_nos = [[row, self._found_bookings.get((flight_no, row))]
+                       for row in changes_by_row]
+        self.queue.append(f"update_passengers:{uuid.uuid4()}",
+                          "update_passengers", flight_no,
+                          [flight_no, list(changes_by_row.items()),
+                           booking_nos])
+        self._start_flusher()